@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+
+"""Synthetic EnCase Listing Generator.
+
+listing_generator writes tab delimited file listings in the format
+path_analyzer reads: a header line with Item_Path, Category and
+Logical_Size fields, then a line per folder and file.
+
+The folder tree, name lengths and outlier rates are configurable, and the
+output only depends on the seed, so listings can stand in for case data
+when measuring path_analyzer.
+
+"""
+
+import getopt
+import random
+import sys
+from textwrap import dedent
+
+__author__ = "Danny Cheun"
+__credits__ = ["Danny Cheun"]
+__version__ = "1.0.0"
+__maintainer__ = "Danny Cheun"
+__email__ = "dcheun@gmail.com"
+
+
+# Export on *
+__all__ = ['ListingGenerator']
+
+# Globals
+# Store script_args passed to script.
+script_args = {}
+
+
+class ListingGenerator(object):
+    
+    """Generates a synthetic EnCase listing."""
+    
+    # Characters of the folder and file names.
+    ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789_-'
+    # Size of the pool of random characters names are cut from.
+    POOL_SIZE = 1 << 20
+    
+    def __init__(self, lines, max_depth=None, fan_out=None,
+                 files_per_folder=None, folder_name_length=None,
+                 file_name_length=None, outlier1_rate=None,
+                 outlier2_rate=None, outlier3_rate=None,
+                 max_file_length=None, max_parent_file_length=None,
+                 max_path_length=None, folders=True,
+                 root_folder=None, seed=None):
+        """Constructs a new ListingGenerator object.
+        
+        @param lines: The number of lines to write, not counting the header.
+        @keyword max_depth: The depth of the deepest folders.
+                Defaults to 8.
+        @keyword fan_out: (min, max) number of sub folders per folder.
+                Defaults to (1, 4).
+        @keyword files_per_folder: (min, max) number of files per folder.
+                Defaults to (0, 12).
+        @keyword folder_name_length: (min, max) length of the folder names.
+                Defaults to (4, 24).
+        @keyword file_name_length: (min, max) length of the file names,
+                including the extension.
+                Defaults to (5, 40).
+        @keyword outlier1_rate: The fraction of files with a file name
+                longer than max_file_length.
+                Defaults to 0.001.
+        @keyword outlier2_rate: The fraction of files in a folder whose name
+                makes the folder and file name longer than
+                max_parent_file_length.  These files get a folder of their
+                own.
+                Defaults to 0.001.
+        @keyword outlier3_rate: The fraction of files under a chain of
+                extra folders long enough to make the path longer than
+                max_path_length.  The folder and file names stay within
+                max_parent_file_length and max_file_length.
+                Defaults to 0.001.
+        @keyword max_file_length: The max_file_length of path_analyzer.
+                Defaults to 190.
+        @keyword max_parent_file_length: The max_parent_file_length of
+                path_analyzer.
+                Defaults to 250.
+        @keyword max_path_length: The max_path_length of path_analyzer.
+                Defaults to 250.
+        @keyword folders: Writes a line per folder as well.
+        @keyword root_folder: The EnCase root folder prefixed to the paths.
+                Defaults to 'Case'.
+        @keyword seed: The seed of the random generator.
+                Defaults to 0.
+        
+        """
+        self.lines = int(lines)
+        self.max_depth = int(max_depth) if max_depth is not None else 8
+        self.fan_out = tuple(fan_out) if fan_out else (1, 4)
+        self.files_per_folder = (tuple(files_per_folder) if files_per_folder
+                                 else (0, 12))
+        self.folder_name_length = (tuple(folder_name_length)
+                                   if folder_name_length else (4, 24))
+        self.file_name_length = (tuple(file_name_length) if file_name_length
+                                 else (5, 40))
+        self.outlier1_rate = (float(outlier1_rate)
+                              if outlier1_rate is not None else 0.001)
+        self.outlier2_rate = (float(outlier2_rate)
+                              if outlier2_rate is not None else 0.001)
+        self.outlier3_rate = (float(outlier3_rate)
+                              if outlier3_rate is not None else 0.001)
+        self.max_file_length = (int(max_file_length)
+                                if max_file_length is not None else 190)
+        self.max_parent_file_length = (int(max_parent_file_length)
+                                       if max_parent_file_length is not None
+                                       else 250)
+        self.max_path_length = (int(max_path_length)
+                                if max_path_length is not None else 250)
+        self.folders = folders
+        self.root_folder = root_folder if root_folder else 'Case'
+        self.random = random.Random(seed if seed is not None else 0)
+        self._pool = ''.join(self.random.choice(self.ALPHABET)
+                             for i in xrange(self.POOL_SIZE))
+        # Counters of the last generated listing.
+        self.counts = {}
+    
+    def name(self, length):
+        """Returns a random name of the given length."""
+        start = self.random.randint(0, self.POOL_SIZE - length)
+        return self._pool[start:start + length]
+    
+    def file_name(self, length):
+        """Returns a random file name with an extension."""
+        if length < 5:
+            return self.name(length)
+        return '%s.%s' % (self.name(length - 4), self.name(3))
+    
+    def size(self):
+        """Returns a random Logical_Size, about log-normal around 40KB."""
+        return int(self.random.lognormvariate(10.6, 2.0))
+    
+    def generate(self, f):
+        """Writes the listing to an open file.
+        
+        @param f: The file object to write to.
+        @return: The counters of the listing.
+        
+        """
+        self.counts = {'lines':0, 'folders':0, 'files':0, 'outliers1':0,
+                       'outliers2':0, 'outliers3':0, 'max_path_length':0}
+        f.write('\tItem_Path\tCategory\tLogical_Size\n')
+        top = 0
+        while self.counts['lines'] < self.lines:
+            self.generate_folder(f, ['top%d' % top], 1)
+            top += 1
+        return self.counts
+    
+    def generate_folder(self, f, path_list, depth):
+        """Writes a folder, its files and its sub folders, until enough
+        lines are written.
+        
+        @param f: The file object to write to.
+        @param path_list: The folder path, as a list of folder names.
+        @param depth: The depth of the folder.
+        
+        """
+        counts = self.counts
+        rand = self.random
+        if self.folders:
+            self.write_line(f, path_list, 'Folder', 0)
+            counts['folders'] += 1
+        for i in xrange(rand.randint(*self.files_per_folder)):
+            if counts['lines'] >= self.lines:
+                return
+            roll = rand.random()
+            if roll < self.outlier1_rate:
+                length = self.max_file_length + rand.randint(1, 40)
+                self.write_line(f, path_list + [self.file_name(length)],
+                                'File', self.size())
+                counts['outliers1'] += 1
+            elif roll < self.outlier1_rate + self.outlier2_rate:
+                self.generate_outlier2(f, path_list)
+            elif roll < (self.outlier1_rate + self.outlier2_rate +
+                         self.outlier3_rate):
+                self.generate_outlier3(f, path_list)
+            else:
+                length = rand.randint(*self.file_name_length)
+                path_length = self.write_line(
+                    f, path_list + [self.file_name(length)], 'File',
+                    self.size())
+                # Name lengths and deep trees make outliers by chance too,
+                # counted in the order path_analyzer checks them.
+                if length > self.max_file_length:
+                    counts['outliers1'] += 1
+                elif (len(path_list[-1]) + 1 + length >
+                      self.max_parent_file_length):
+                    counts['outliers2'] += 1
+                elif path_length > self.max_path_length:
+                    counts['outliers3'] += 1
+            counts['files'] += 1
+        if depth >= self.max_depth:
+            return
+        for i in xrange(rand.randint(*self.fan_out)):
+            if counts['lines'] >= self.lines:
+                return
+            length = rand.randint(*self.folder_name_length)
+            self.generate_folder(f, path_list + [self.name(length)], depth + 1)
+    
+    def generate_outlier2(self, f, path_list):
+        """Writes a file in a folder of its own, whose names together are
+        longer than max_parent_file_length.
+        
+        """
+        rand = self.random
+        length = min(rand.randint(*self.file_name_length),
+                     self.max_file_length)
+        _file = self.file_name(length)
+        # The separator between the folder and file counts too.
+        folder_length = max(1, self.max_parent_file_length - length +
+                            rand.randint(0, 20))
+        path_list = path_list + [self.name(folder_length)]
+        if self.folders and self.counts['lines'] < self.lines - 1:
+            self.write_line(f, path_list, 'Folder', 0)
+            self.counts['folders'] += 1
+        self.write_line(f, path_list + [_file], 'File', self.size())
+        self.counts['outliers2'] += 1
+    
+    def generate_outlier3(self, f, path_list):
+        """Writes a file under a chain of folders, whose path is longer
+        than max_path_length.
+        
+        The folders and the file are short enough not to be outliers1 or
+        outliers2, so path_analyzer can shorten the path.
+        
+        """
+        rand = self.random
+        length = min(rand.randint(*self.file_name_length),
+                     self.max_file_length)
+        _file = self.file_name(length)
+        # Longest folder name, so the folder and file are not an outlier2.
+        max_folder_length = max(1, self.max_parent_file_length - length - 1)
+        target = self.max_path_length + rand.randint(1, 40)
+        # The separators between the names count too.
+        path_length = len('\\'.join(path_list)) + 1 + length
+        path_list = list(path_list)
+        # At least one folder, so the file's parent is one of the chain.
+        while True:
+            folder_length = min(rand.randint(*self.folder_name_length),
+                                max_folder_length)
+            path_list.append(self.name(max(1, folder_length)))
+            path_length += len(path_list[-1]) + 1
+            if self.folders and self.counts['lines'] < self.lines - 1:
+                self.write_line(f, path_list, 'Folder', 0)
+                self.counts['folders'] += 1
+            if path_length > target:
+                break
+        self.write_line(f, path_list + [_file], 'File', self.size())
+        self.counts['outliers3'] += 1
+    
+    def write_line(self, f, path_list, category, size):
+        """Writes a line of the listing.
+        
+        @return: The length of the path, without the root folder.
+        
+        """
+        path = '\\'.join(path_list)
+        if self.counts['max_path_length'] < len(path):
+            self.counts['max_path_length'] = len(path)
+        f.write('%d\t%s\\%s\t%s\t%d\n' % (self.counts['lines'],
+                                           self.root_folder, path, category,
+                                           size))
+        self.counts['lines'] += 1
+        return len(path)
+
+
+def usage():
+    """Print usage info."""
+    program_name = sys.argv[0].split('/')[-1]
+    message = ['Usage: %s <options>...' % program_name]
+    message.append(dedent('''
+    Required argument(s):
+      -o <FILE_PATH>, --output=<FILE_PATH>
+            The listing file to write.
+      -n <LINES>, --lines=<LINES>
+            The number of lines to write, not counting the header.
+    
+    Optional argument(s):
+      --max-depth=<DEPTH>
+            The depth of the deepest folders.
+            Defaults to 8.
+      --fan-out=<MIN>,<MAX>
+            The number of sub folders per folder.
+            Defaults to 1,4.
+      --files-per-folder=<MIN>,<MAX>
+            The number of files per folder.
+            Defaults to 0,12.
+      --folder-name-length=<MIN>,<MAX>
+            The length of the folder names.
+            Defaults to 4,24.
+      --file-name-length=<MIN>,<MAX>
+            The length of the file names.
+            Defaults to 5,40.
+      --outlier1-rate=<RATE>
+            The fraction of files with a file name over MAX_FILE_LENGTH.
+            Defaults to 0.001.
+      --outlier2-rate=<RATE>
+            The fraction of files whose folder and file name together are
+            over MAX_PARENT_FILE_LENGTH.
+            Defaults to 0.001.
+      --outlier3-rate=<RATE>
+            The fraction of files under a chain of folders that makes the
+            path over MAX_PATH_LENGTH.
+            Defaults to 0.001.
+      --max-file-length=<MAX_FILE_LENGTH>
+            As for path_analyzer.
+            Defaults to 190.
+      --max-pf-length=<MAX_PARENT_FILE_LENGTH>
+            As for path_analyzer.
+            Defaults to 250.
+      --max-path-length=<MAX_PATH_LENGTH>
+            As for path_analyzer.
+            Defaults to 250.
+      --no-folders
+            Only writes the file lines.
+      --seed=<SEED>
+            The seed of the random generator.
+            Defaults to 0.
+      -h, --help
+            Displays this help screen.
+    '''))
+    print '\n'.join(message)
+
+
+def parse_range(option, value):
+    """Parses a <MIN>,<MAX> option value."""
+    try:
+        (low, high) = [int(v) for v in value.split(',')]
+    except ValueError:
+        print >>sys.stderr, 'ERROR: %s must be <MIN>,<MAX>.' % option
+        sys.exit(2)
+    if low < 0 or high < low:
+        print >>sys.stderr, 'ERROR: %s must have 0 <= MIN <= MAX.' % option
+        sys.exit(2)
+    return (low, high)
+
+
+def handle_args():
+    """Handle script's command line script_args."""
+    global script_args
+    
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:n:h',
+                                   ['output=','lines=','max-depth=',
+                                    'fan-out=','files-per-folder=',
+                                    'folder-name-length=',
+                                    'file-name-length=','outlier1-rate=',
+                                    'outlier2-rate=','outlier3-rate=',
+                                    'max-file-length=','max-pf-length=',
+                                    'max-path-length=','no-folders','seed=',
+                                    'help'])
+    except getopt.GetoptError as e:
+        # Print usage info and exit.
+        print str(e)
+        usage()
+        sys.exit(2)
+    
+    for o, a in opts:
+        if o == '-o' or o == '--output':
+            script_args['output'] = a
+        elif o == '-n' or o == '--lines':
+            script_args['lines'] = a
+        elif o in ('--fan-out', '--files-per-folder', '--folder-name-length',
+                   '--file-name-length'):
+            script_args[o[2:]] = parse_range(o, a)
+        elif o in ('--max-depth', '--outlier1-rate', '--outlier2-rate',
+                   '--outlier3-rate', '--max-file-length', '--max-pf-length',
+                   '--max-path-length', '--seed'):
+            script_args[o[2:]] = a
+        elif o == '--no-folders':
+            script_args['no-folders'] = True
+        elif o == '-h' or o == '--help':
+            script_args['help'] = a
+        else:
+            assert False, 'Unhandled option %s' % o
+    
+    # Check for help.
+    if 'help' in script_args:
+        usage()
+        sys.exit(0)
+    # Check if required arguments are set.
+    if 'output' not in script_args or 'lines' not in script_args:
+        print >>sys.stderr, 'ERROR: Missing argument(s).'
+        usage()
+        sys.exit(2)
+    try:
+        script_args['lines'] = int(script_args['lines'])
+        for name in ('max-depth', 'max-file-length', 'max-pf-length',
+                     'max-path-length', 'seed'):
+            if name in script_args:
+                script_args[name] = int(script_args[name])
+        for name in ('outlier1-rate', 'outlier2-rate', 'outlier3-rate'):
+            if name in script_args:
+                script_args[name] = float(script_args[name])
+    except ValueError as e:
+        print >>sys.stderr, 'ERROR: %s' % e
+        sys.exit(2)
+
+
+def main():
+    global script_args
+    handle_args()
+    
+    generator = ListingGenerator(script_args['lines'],
+        max_depth=script_args.get('max-depth'),
+        fan_out=script_args.get('fan-out'),
+        files_per_folder=script_args.get('files-per-folder'),
+        folder_name_length=script_args.get('folder-name-length'),
+        file_name_length=script_args.get('file-name-length'),
+        outlier1_rate=script_args.get('outlier1-rate'),
+        outlier2_rate=script_args.get('outlier2-rate'),
+        outlier3_rate=script_args.get('outlier3-rate'),
+        max_file_length=script_args.get('max-file-length'),
+        max_parent_file_length=script_args.get('max-pf-length'),
+        max_path_length=script_args.get('max-path-length'),
+        folders=not script_args.get('no-folders', False),
+        seed=script_args.get('seed'))
+    with open(script_args['output'], 'wb') as f:
+        counts = generator.generate(f)
+    message = ['Wrote %s' % script_args['output']]
+    for name in ('lines', 'folders', 'files', 'outliers1', 'outliers2',
+                 'outliers3', 'max_path_length'):
+        message.append('%s: %s' % (name, counts[name]))
+    print '\n'.join(message)
+
+if __name__ == '__main__':
+    main()
@@ -24,19 +24,50 @@ Output Requested:
 """
 
 from abc import ABCMeta, abstractmethod
+from array import array
+import atexit
+from bisect import bisect_left
 import chardet
 import codecs
-from collections import defaultdict
+from collections import deque
+import cProfile
+from contextlib import contextmanager
+import cPickle as pickle
 import csv
-import _ctypes
 from datetime import datetime
 from itertools import islice
+import gc
 import getopt
+import heapq
+import json
+import mmap
+import multiprocessing
 import os
 import re
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
 import time
 from textwrap import dedent
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 __author__ = "Danny Cheun"
 __credits__ = ["Danny Cheun"]
@@ -51,6 +82,28 @@ __all__ = []
 # Globals
 # Store script_args passed to script.
 script_args = {}
+# Item_Path prefix ("root folder") and the path after it.
+_ROOT_FOLDER_RE = re.compile(r'[^\\]+(.*)')
+# Encodings (codecs names) read as raw bytes by Analyzer.ingest.
+_RAW_ENCODINGS = ('utf-8', 'ascii', 'iso8859-1')
+# Snapshot file signature and format version.
+SNAPSHOT_MAGIC = 'PATHSNAP'
+SNAPSHOT_VERSION = 2
+# Number of node paths kept by PathCache.
+PATH_CACHE_SIZE = 65536
+# Number of tracemalloc top allocators kept by RunMetrics.
+METRICS_TOP_ALLOCATORS = 10
+# Number of object types kept by the memory snapshots of RunMetrics.
+MEMORY_CENSUS_TYPES = 50
+# Directory scans are split into about this many subtrees per worker, going
+# at most SCAN_SPLIT_DEPTH folders down.
+SCAN_TASKS_PER_WORKER = 4
+SCAN_SPLIT_DEPTH = 3
+# Values of the Change column of a delta listing.
+DELTA_ADDED = 'Added'
+DELTA_REMOVED = 'Removed'
+# Column of the file sizes in bytes (EnCase Logical Size).
+DEFAULT_SIZE_COLUMN = 'Logical_Size'
 
 class Item(object):
     
@@ -100,87 +153,70 @@ class Item(object):
     print_attr = print_attributes
 
 
+class _Column(object):
+    
+    """Node attribute stored in a NodeStore column.
+    
+    None is stored as -1 for columns that default to None.
+    
+    """
+    
+    def __init__(self, name, typecode, default):
+        self.name = name
+        self.nullable = default is None
+        self.boolean = typecode == 'b'
+    
+    def __get__(self, node, owner):
+        if node is None:
+            return self
+        value = node._store.columns[self.name][node.id]
+        if self.nullable and value == -1:
+            return None
+        if self.boolean:
+            return value == 1
+        return value
+    
+    def __set__(self, node, value):
+        if value is None:
+            value = -1
+        node._store.columns[self.name][node.id] = value
+
+
+class _Flag(object):
+    
+    """Boolean Node attribute stored as a bit of the NodeStore flags."""
+    
+    def __init__(self, bit):
+        self.mask = 1 << bit
+    
+    def __get__(self, node, owner):
+        if node is None:
+            return self
+        return bool(node._store.flags[node.id] & self.mask)
+    
+    def __set__(self, node, value):
+        if value:
+            node._store.flags[node.id] |= self.mask
+        else:
+            node._store.flags[node.id] &= ~self.mask
+
+
 class Node(object):
     
     """Structure to hold tree nodes attributes.
     
     These nodes will NOT be on the tree implementation itself, but serve
-    as a lookup for its attributes.
+    as a lookup for its attributes.  A Node is only a view of one row of
+    a NodeStore, so it is cheap to create and holds no data itself.
     
     """
     
-    # Global counter of nodes created.
-    _COUNT = 0
+    __slots__ = ('_store', 'id')
     
-    def __init__(self, data=None):
-        """Constructs a new Node and increments it attributes."""
-        self.init_attributes()
-        Node._COUNT += 1
-        self._data.update({'id':Node._COUNT})
-        if data:
-            self._data.update(data)
-        self.dict_to_attrs(self._data)
-    
-    def init_attributes(self):
-        self._data = {# local_cnt = num local files, excluding folders.
-                      'local_cnt':0,
-                      # subdir_cnt = total num files in sub-folders, excluding folders.
-                      'subdir_cnt':0,
-                      # total_cnt = local_cnt + subdir_cnt (excludes folders).
-                      'total_cnt':0,
-                      #############################
-                      # The following are for counts with folders included.
-                      'child_node_cnt':None,
-                      'local_plus_child_cnt':None,
-                      'subdir_plus_child_cnt':None,
-                      'total_plus_child_cnt':None,
-                      #############################
-                      # Length of the local path.
-                      'local_path_length':0,
-                      # longest file length = longest filename found including sub-folders.
-                      # This will recurse up the tree.
-                      'longest_fn_length':0,
-                      # longest file length = longest filepath found including sub-folders.
-                      # This will recurse up the tree.
-                      'longest_fp_length':0,
-                      # Number of outliers at the current level.
-                      'num_local_outliers1':0,
-                      'num_local_outliers2':0,
-                      'num_local_outliers3':0,
-                      # If current or sub-folders have outliers.
-                      # TODO: Phase these out.
-                      'has_outliers1':False,
-                      'has_outliers2':False,
-                      'has_outliers3':False,
-                      # Total number of in subdirs.
-                      'num_subdir_outliers1':0,
-                      'num_subdir_outliers2':0,
-                      'num_subdir_outliers3':0,
-                      'num_unable_to_shorten':0,
-                      # For batching purposes.
-                      'batchable':None,
-                      # If Node path has been shortened.
-                      'shortened':False,
-                      'unable_to_shorten':False,
-                      # For trimming purposes if path is over file limit.
-                      'can_shorten':False,
-                      'trimmable':False,
-                      'trimmed':False,
-                      # If warning was already written to csv.
-                      'wrote_over_limit':False,
-                      'depth':None,
-                      'batch':0,
-                      }
-    
-    def dict_to_attrs(self, d):
-        """Helper procedure to unpack dictionary items and convert them into
-        class instance attributes.
-        
-        @param d: Dictionary containing attributes to unpack.
-        
-        """
-        for k,v in d.iteritems():
-            setattr(self, k, v)
+    def __init__(self, store, node_id):
+        """Constructs a view of the node_id row in store."""
+        self._store = store
+        self.id = node_id
     
     def update(self, data):
         """Updates instance with the data provided.
@@ -188,11 +224,15 @@ class Node(object):
         @param data: The update data. Must be a dictionary.
         
         """
-        self._data.update(data)
-        self.dict_to_attrs(data)
+        for k,v in data.iteritems():
+            setattr(self, k, v)
+    
+    def as_dict(self):
+        """Returns the node attributes as a dictionary."""
+        return dict((k, getattr(self, k)) for k in self._store.attributes)
     
     def print_attributes(self):
-        message = '\n'.join("%s: %s" % item for item in self._data.items())
+        message = '\n'.join("%s: %s" % item for item in self.as_dict().items())
         log('INFO', logfile, message, print_stdout=True)
     
     def __repr__(self):
@@ -202,6 +242,192 @@ class Node(object):
     print_attr = print_attributes
 
 
+class NodeStore(object):
+    
+    """Columnar storage of Node attributes.
+    
+    Every attribute is kept in its own typed array indexed by node id,
+    rather than in a dictionary per node.  Boolean attributes share the
+    bits of the flags column.
+    
+    """
+    
+    # (attribute, typecode, default)
+    COLUMNS = (# local_cnt = num local files, excluding folders.
+               ('local_cnt', 'i', 0),
+               # subdir_cnt = total num files in sub-folders, excluding folders.
+               ('subdir_cnt', 'i', 0),
+               # total_cnt = local_cnt + subdir_cnt (excludes folders).
+               ('total_cnt', 'i', 0),
+               # local_bytes = size of the local files counted in local_cnt,
+               # when sizes are read.  Doubles hold exact byte counts up to
+               # 2**53 on every platform, unlike the 'l' typecode.
+               ('local_bytes', 'd', 0),
+               # total_bytes = local_bytes + size of the files in sub-folders.
+               ('total_bytes', 'd', 0),
+               #############################
+               # The following are for counts with folders included.
+               # child_node_cnt = num folders in the whole subtree.
+               ('child_node_cnt', 'i', None),
+               # direct_child_cnt = num immediate sub-folders.
+               ('direct_child_cnt', 'i', None),
+               ('local_plus_child_cnt', 'i', None),
+               ('subdir_plus_child_cnt', 'i', None),
+               ('total_plus_child_cnt', 'i', None),
+               #############################
+               # Length of the local path.
+               ('local_path_length', 'i', 0),
+               # longest file length = longest filename found including sub-folders.
+               # This will recurse up the tree.
+               ('longest_fn_length', 'i', 0),
+               # longest file length = longest filepath found including sub-folders.
+               # This will recurse up the tree.
+               ('longest_fp_length', 'i', 0),
+               # Number of outliers at the current level.
+               ('num_local_outliers1', 'i', 0),
+               ('num_local_outliers2', 'i', 0),
+               ('num_local_outliers3', 'i', 0),
+               # Total number of in subdirs.
+               ('num_subdir_outliers1', 'i', 0),
+               ('num_subdir_outliers2', 'i', 0),
+               ('num_subdir_outliers3', 'i', 0),
+               ('num_unable_to_shorten', 'i', 0),
+               ('depth', 'i', None),
+               ('batch', 'i', 0),
+               # If folder has no sub-folders on the tree.
+               ('is_leaf', 'b', None),
+               # For batching purposes.
+               ('batchable', 'b', None),
+               )
+    # Boolean attributes, stored as bits of the flags column.
+    FLAGS = (# If current or sub-folders have outliers.
+             # TODO: Phase these out.
+             'has_outliers1',
+             'has_outliers2',
+             'has_outliers3',
+             # If Node path has been shortened.
+             'shortened',
+             'unable_to_shorten',
+             # For trimming purposes if path is over file limit.
+             'can_shorten',
+             'trimmable',
+             'trimmed',
+             # If warning was already written to csv.
+             'wrote_over_limit',
+             )
+    
+    def __init__(self):
+        self.columns = {}
+        self._defaults = []
+        for (name, typecode, default) in self.COLUMNS:
+            column = array(typecode)
+            self.columns[name] = column
+            self._defaults.append((column, -1 if default is None else default))
+        self.flags = array('H')
+        self.columns['flags'] = self.flags
+        self.attributes = [c[0] for c in self.COLUMNS] + list(self.FLAGS)
+    
+    def __len__(self):
+        return len(self.flags)
+    
+    def __contains__(self, node_id):
+        return 0 <= node_id < len(self.flags)
+    
+    def __getitem__(self, node_id):
+        if node_id not in self:
+            raise KeyError(node_id)
+        return Node(self, node_id)
+    
+    # Ingest counters combined by merge_row.
+    MERGE_SUM = ('local_cnt', 'total_cnt', 'local_bytes', 'total_bytes',
+                 'num_local_outliers1', 'num_local_outliers2',
+                 'num_local_outliers3')
+    MERGE_MAX = ('longest_fn_length', 'longest_fp_length',
+                 'num_unable_to_shorten')
+    
+    def merge_row(self, node_id, other, other_id):
+        """Merges the ingest counters of a row of another store.
+        
+        @param node_id: The row to update.
+        @param other: The other NodeStore.
+        @param other_id: The row of the other store.
+        
+        """
+        for name in self.MERGE_SUM:
+            self.columns[name][node_id] += other.columns[name][other_id]
+        for name in self.MERGE_MAX:
+            value = other.columns[name][other_id]
+            if self.columns[name][node_id] < value:
+                self.columns[name][node_id] = value
+        self.flags[node_id] |= other.flags[other_id]
+    
+    def flag_mask(self, *names):
+        """Returns the bit mask of the named flags in the flags column."""
+        mask = 0
+        for name in names:
+            mask |= 1 << self.FLAGS.index(name)
+        return mask
+    
+    def reset(self, *names):
+        """Sets the named attributes of every row back to their default."""
+        defaults = dict((c[0], -1 if c[2] is None else c[2])
+                        for c in self.COLUMNS)
+        mask = 0
+        for name in names:
+            if name in defaults:
+                column = self.columns[name]
+                column[:] = array(column.typecode, [defaults[name]]) * len(column)
+            else:
+                mask |= self.flag_mask(name)
+        if mask:
+            flags = self.flags
+            for node_id in xrange(len(flags)):
+                if flags[node_id] & mask:
+                    flags[node_id] &= ~mask
+    
+    def fill(self):
+        """Pads the columns shorter than the flags column with their
+        default, eg: columns missing from an older snapshot.
+        
+        """
+        size = len(self.flags)
+        for (column, default) in self._defaults:
+            if len(column) < size:
+                column.extend(array(column.typecode, [default]) *
+                              (size - len(column)))
+    
+    def numpy_column(self, name):
+        """Returns a NumPy array sharing memory with a column.
+        
+        @attention: The array is only valid until rows are added.
+        
+        """
+        column = self.columns[name]
+        return np.frombuffer(column, dtype=column.typecode)
+    
+    def add(self, data=None):
+        """Appends a row of default attributes.
+        
+        @keyword data: Dictionary of attributes to initialize.
+        @return: The Node of the new row.
+        
+        """
+        for (column, default) in self._defaults:
+            column.append(default)
+        self.flags.append(0)
+        node = Node(self, len(self.flags) - 1)
+        if data:
+            node.update(data)
+        return node
+
+
+for (_name, _typecode, _default) in NodeStore.COLUMNS:
+    setattr(Node, _name, _Column(_name, _typecode, _default))
+for (_bit, _name) in enumerate(NodeStore.FLAGS):
+    setattr(Node, _name, _Flag(_bit))
+del _name, _typecode, _default, _bit
+
+
 class Outlier(object):
     
     """Abstract Base Class to hold outlier attributes and functions."""
@@ -260,35 +486,923 @@ class Outlier(object):
     print_attr = print_attributes
 
 
-class Outlier1(Outlier):
+class Outlier3(Outlier):
     
-    """Filename over limit."""
+    """Paths over limit, shortened."""
     
     _COUNT = 0
     
     def get_init_attributes(self):
-        return {'filename':None}
+        return {'shortened':None,
+                '_file':None}
 
 
-class Outlier2(Outlier):
+class OutlierSpill(object):
     
-    """Parent + filename over limit."""
+    """Append-only file of (node id, filename) outlier records.
     
-    _COUNT = 0
+    Outliers are written to the file as they are found, and streamed back
+    when the results are written, so they take no memory while the tree is
+    built.  Each record is the node id of the file's directory, the byte
+    length of the utf-8 encoded filename and the filename itself.
     
-    def get_init_attributes(self):
-        return {'parent_file':None}
+    """
+    
+    _RECORD = struct.Struct('<iI')
+    
+    def __init__(self, directory=None, prefix='outliers'):
+        """Creates an empty spill file.
+        
+        @keyword directory: The directory of the spill file.
+                Defaults to the system temporary directory.
+        @keyword prefix: Prefix of the spill file name.
+        
+        """
+        self.directory = directory
+        (fd, self.path) = tempfile.mkstemp(prefix='%s_' % prefix,
+                                           suffix='.spill', dir=directory)
+        self._fp = os.fdopen(fd, 'wb')
+        self.count = 0
+    
+    def __len__(self):
+        return self.count
+    
+    def __getstate__(self):
+        """Pickles the file name, so a worker's spill can be read back by
+        the parent process.
+        
+        """
+        if self._fp is not None:
+            self._fp.flush()
+        return {'directory':self.directory, 'path':self.path,
+                'count':self.count}
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._fp = open(self.path, 'ab')
+    
+    def add(self, node_id, name):
+        """Appends an outlier record.
+        
+        @param node_id: The node id of the file's directory.
+        @param name: The filename.
+        
+        """
+        data = name.encode('utf-8')
+        self._fp.write(self._RECORD.pack(node_id, len(data)))
+        self._fp.write(data)
+        self.count += 1
+    
+    def __iter__(self):
+        """Generator of the (node_id, filename) records, in the order they
+        were added.
+        
+        """
+        self._fp.flush()
+        record = self._RECORD
+        with open(self.path, 'rb') as f:
+            for i in xrange(self.count):
+                (node_id, size) = record.unpack(f.read(record.size))
+                yield (node_id, f.read(size).decode('utf-8'))
+    
+    def extend(self, other, id_map=None):
+        """Appends the records of another spill.
+        
+        @param other: The other OutlierSpill.
+        @keyword id_map: Maps the node ids of the other spill to the node
+                ids of this one.
+        
+        """
+        for (node_id, name) in other:
+            if id_map is not None:
+                node_id = id_map[node_id]
+            self.add(node_id, name)
+    
+    def discard(self, records=(), node_ids=()):
+        """Removes records, rewriting the spill file.
+        
+        @keyword records: (node id, filename) records to remove, each once.
+        @keyword node_ids: Node ids to remove all the records of.
+        @return: List of the removed (node id, filename) records.
+        
+        """
+        pending = {}
+        for record in records:
+            pending[record] = pending.get(record, 0) + 1
+        removed = []
+        count = 0
+        with open(self.path + '.tmp', 'wb') as f:
+            for (node_id, name) in self:
+                record = (node_id, name)
+                if node_id in node_ids:
+                    removed.append(record)
+                    continue
+                if pending.get(record):
+                    pending[record] -= 1
+                    removed.append(record)
+                    continue
+                data = name.encode('utf-8')
+                f.write(self._RECORD.pack(node_id, len(data)))
+                f.write(data)
+                count += 1
+        self._fp.close()
+        os.rename(self.path + '.tmp', self.path)
+        self._fp = open(self.path, 'ab')
+        self.count = count
+        return removed
+    
+    def nbytes(self):
+        """Returns the size of the records in bytes."""
+        self._fp.flush()
+        return os.path.getsize(self.path)
+    
+    def dump(self, f):
+        """Copies the records to an open file."""
+        self._fp.flush()
+        with open(self.path, 'rb') as src:
+            shutil.copyfileobj(src, f)
+    
+    def load(self, f, count, size):
+        """Replaces the records with ones copied by dump.
+        
+        @param f: The open file, positioned at the records.
+        @param count: The number of records.
+        @param size: The number of bytes of the records.
+        
+        """
+        self._fp.seek(0)
+        self._fp.truncate()
+        while size > 0:
+            data = f.read(min(size, 1 << 20))
+            if not data:
+                raise ValueError('Truncated outlier records.')
+            self._fp.write(data)
+            size -= len(data)
+        self.count = count
+    
+    def close(self):
+        """Closes and removes the spill file."""
+        if self._fp is None:
+            return
+        self._fp.close()
+        self._fp = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
 
 
-class Outlier3(Outlier):
+class PathTrie(object):
     
-    """Paths over limit, shortened."""
+    """Compact trie of directory paths.
     
-    _COUNT = 0
+    Every path component is stored once in an interned component table,
+    and nodes are plain integer ids linked to their parent, children and
+    component through typed arrays.  Id 0 is the nameless root.  Full paths
+    are not kept in memory but rebuilt on demand by get_path.
     
-    def get_init_attributes(self):
-        return {'shortened':None,
-                '_file':None}
+    Only nodes leading to a file are flagged in_tree.  These make up the
+    tree walked for the batch results.  Folders only seen as a Folder item
+    can still be looked up by path.
+    
+    """
+    
+    # Node structure columns, saved in snapshots.
+    ARRAYS = ('parent', 'component', 'first_child', 'last_child',
+              'next_sibling')
+    
+    def __init__(self):
+        # Interned component table.
+        self.components = []
+        self.component_ids = {}
+        # Node structure, indexed by node id.
+        self.parent = array('i', [-1])
+        self.component = array('i', [-1])
+        self.first_child = array('i', [-1])
+        self.last_child = array('i', [-1])
+        self.next_sibling = array('i', [-1])
+        self.in_tree = bytearray(1)
+        # Child lookup, keyed by (parent id << 32 | component id).
+        self.edges = {}
+    
+    def __len__(self):
+        """Returns the number of nodes, excluding the root."""
+        return len(self.parent) - 1
+    
+    def __getstate__(self):
+        """Pickles without the lookup tables, they are rebuilt on load."""
+        state = self.__dict__.copy()
+        del state['component_ids']
+        del state['edges']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rebuild_index()
+    
+    def rebuild_index(self):
+        """Rebuilds the component and child lookup tables from the arrays."""
+        self.component_ids = dict((name, comp_id) for (comp_id, name)
+                                  in enumerate(self.components))
+        self.edges = {}
+        for node_id in xrange(1, len(self.parent)):
+            self.edges[self.parent[node_id] << 32 | self.component[node_id]] = node_id
+    
+    def intern(self, name):
+        """Returns the component id of name, adding it if needed."""
+        try:
+            return self.component_ids[name]
+        except KeyError:
+            comp_id = len(self.components)
+            self.components.append(name)
+            self.component_ids[name] = comp_id
+            return comp_id
+    
+    def child(self, parent_id, name):
+        """Returns the id of the named child of parent_id, or -1."""
+        comp_id = self.component_ids.get(name)
+        if comp_id is None:
+            return -1
+        return self.edges.get(parent_id << 32 | comp_id, -1)
+    
+    def add_child(self, parent_id, name):
+        """Creates a child node under parent_id and returns its id."""
+        node_id = len(self.parent)
+        comp_id = self.intern(name)
+        self.parent.append(parent_id)
+        self.component.append(comp_id)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.in_tree.append(0)
+        if self.first_child[parent_id] == -1:
+            self.first_child[parent_id] = node_id
+        else:
+            self.next_sibling[self.last_child[parent_id]] = node_id
+        self.last_child[parent_id] = node_id
+        self.edges[parent_id << 32 | comp_id] = node_id
+        return node_id
+    
+    def find(self, path_list):
+        """Returns the node id of the path, or -1 if not found.
+        
+        @param path_list: A list of the path structure.
+        
+        """
+        node_id = 0
+        for name in path_list:
+            node_id = self.child(node_id, name)
+            if node_id == -1:
+                break
+        return node_id
+    
+    def name(self, node_id):
+        """Returns the last path component of the node."""
+        return self.components[self.component[node_id]]
+    
+    def get_path(self, node_id, path_sep):
+        """Rebuilds the full path of the node.
+        
+        @param node_id: The node id.
+        @param path_sep: The path separator to join components with.
+        
+        """
+        names = []
+        while node_id > 0:
+            names.append(self.components[self.component[node_id]])
+            node_id = self.parent[node_id]
+        names.reverse()
+        return path_sep.join(names)
+    
+    def mark_tree(self, node_id):
+        """Flags the node and its ancestors as part of the tree."""
+        while node_id > 0 and not self.in_tree[node_id]:
+            self.in_tree[node_id] = 1
+            node_id = self.parent[node_id]
+    
+    def tree_children(self, node_id):
+        """Generator of the child ids of a node that are part of the tree."""
+        child_id = self.first_child[node_id]
+        while child_id != -1:
+            if self.in_tree[child_id]:
+                yield child_id
+            child_id = self.next_sibling[child_id]
+    
+    def walk(self, node_id=0):
+        """Depth First Search tree walk (pre-order) of the nodes below
+        node_id that are part of the tree.
+        
+        """
+        stack = list(self.tree_children(node_id))
+        stack.reverse()
+        while stack:
+            node_id = stack.pop()
+            yield node_id
+            children = list(self.tree_children(node_id))
+            children.reverse()
+            stack.extend(children)
+
+
+class PathCache(object):
+    
+    """Cache of the full paths of PathTrie nodes, approximately least
+    recently used.
+    
+    Paths are kept in two generations of up to size / 2 paths each.  When
+    the new generation is full it becomes the old one, and the previous
+    old generation is dropped.  A path found in the old generation is
+    moved back to the new one.
+    
+    Only the paths asked for are cached.  A path is rebuilt from the
+    trie, or joined to the cached path of its parent.
+    
+    """
+    
+    def __init__(self, paths, path_sep, size=PATH_CACHE_SIZE):
+        """Constructs an empty cache.
+        
+        @param paths: The PathTrie.
+        @param path_sep: The path separator to join components with.
+        @keyword size: The maximum number of paths kept.
+        
+        """
+        self.paths = paths
+        self.path_sep = path_sep
+        self.size = size
+        self._new = {}
+        self._old = {}
+    
+    def __len__(self):
+        return len(self._new) + len(self._old)
+    
+    def clear(self):
+        self._new = {}
+        self._old = {}
+    
+    def put(self, node_id, path):
+        """Caches the path of a node."""
+        if len(self._new) >= self.size // 2:
+            self._old = self._new
+            self._new = {}
+        self._new[node_id] = path
+    
+    def lookup(self, node_id):
+        """Returns the cached path of a node, or None."""
+        path = self._new.get(node_id)
+        if path is None:
+            path = self._old.get(node_id)
+            if path is not None:
+                self.put(node_id, path)
+        return path
+    
+    def get(self, node_id):
+        """Returns the full path of a node.
+        
+        @param node_id: The node id.  The root (0) has an empty path.
+        
+        """
+        path = self._new.get(node_id)
+        if path is not None:
+            return path
+        path = self.lookup(node_id)
+        if path is not None:
+            return path
+        if node_id <= 0:
+            return ''
+        # Sibling directories share the parent path.
+        parent_path = self.lookup(self.paths.parent[node_id])
+        if parent_path:
+            path = self.path_sep.join([parent_path,self.paths.name(node_id)])
+        else:
+            path = self.paths.get_path(node_id, self.path_sep)
+        self.put(node_id, path)
+        return path
+
+
+class NodeDatabase(object):
+    
+    """SQLite database of the tree nodes and outliers.
+    
+    The nodes table has a row per node with its parent id, name, full
+    path, in_tree flag and the NodeStore columns.  The rollups of
+    depth_first_reverse_update and update_node_child_cnts run in it as
+    one batched update per depth level.  The database is left in place
+    after the run, to be queried for follow-up questions.
+    
+    """
+    
+    # Indexed node columns.
+    INDEXES = ('parent_id', 'depth', 'total_cnt', 'local_plus_child_cnt',
+               'total_plus_child_cnt')
+    
+    def __init__(self, path):
+        """Opens the database, replacing any tables of an earlier run.
+        
+        @param path: The database file path.
+        
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode = OFF')
+        self.conn.execute('PRAGMA synchronous = OFF')
+        self.columns = [c[0] for c in NodeStore.COLUMNS] + ['flags']
+        for table in ('nodes', 'outliers1', 'outliers2', 'outliers3'):
+            self.conn.execute('DROP TABLE IF EXISTS %s' % table)
+        self.conn.execute('CREATE TABLE nodes (id INTEGER PRIMARY KEY, '
+                          'parent_id INTEGER, name TEXT, path TEXT, '
+                          'in_tree INTEGER, %s)' %
+                          ', '.join('%s INTEGER' % c for c in self.columns))
+        self.conn.execute('CREATE TABLE outliers1 (node_id INTEGER, '
+                          'filename TEXT)')
+        self.conn.execute('CREATE TABLE outliers2 (node_id INTEGER, '
+                          'filename TEXT)')
+        self.conn.execute('CREATE TABLE outliers3 (node_id INTEGER PRIMARY '
+                          'KEY, shortened TEXT, filename TEXT)')
+    
+    def write_nodes(self, analyzer):
+        """Inserts the nodes of an Analyzer.
+        
+        @param analyzer: The Analyzer, after the file has been read.
+        
+        """
+        paths = analyzer.paths
+        columns = [analyzer.nodes.columns[c] for c in self.columns]
+        
+        def rows():
+            yield (0, -1, None, '', 0) + tuple(c[0] for c in columns)
+            for node_id in xrange(1, len(paths.parent)):
+                yield ((node_id, paths.parent[node_id], paths.name(node_id),
+                        analyzer.path_cache.get(node_id),
+                        paths.in_tree[node_id]) +
+                       tuple(c[node_id] for c in columns))
+        
+        self.conn.executemany('INSERT INTO nodes VALUES (%s)' %
+                              ', '.join(['?'] * (len(self.columns) + 5)),
+                              rows())
+        for column in self.INDEXES:
+            self.conn.execute('CREATE INDEX nodes_%s ON nodes (%s)' %
+                              (column, column))
+        self.conn.commit()
+    
+    def write_outliers(self, analyzer):
+        """Inserts the outliers of an Analyzer.
+        
+        @param analyzer: The Analyzer, after the file has been read.
+        
+        """
+        self.conn.executemany('INSERT INTO outliers1 VALUES (?, ?)',
+                              analyzer.outliers1)
+        self.conn.executemany('INSERT INTO outliers2 VALUES (?, ?)',
+                              analyzer.outliers2)
+        self.conn.executemany('INSERT INTO outliers3 VALUES (?, ?, ?)',
+                              ((v.node_id, v.shortened, v._file) for v
+                               in analyzer.outliers3.itervalues()))
+        self.conn.commit()
+    
+    def rollup(self, outlier_flags):
+        """Rolls up the node counters into the parents, lowest depth first,
+        then counts the folders of the tree nodes.
+        
+        Same results as depth_first_reverse_update followed by
+        update_node_child_cnts.
+        
+        @param outlier_flags: Tuple of the bit masks of the has_outliers
+                flags.
+        
+        """
+        execute = self.conn.execute
+        (max_depth,) = execute('SELECT MAX(depth) FROM nodes').fetchone()
+        flags = ' | '.join('MAX(flags & %d)' % mask for mask in outlier_flags)
+        execute('CREATE TEMP TABLE children (id INTEGER PRIMARY KEY, '
+                'cnt INTEGER, bytes INTEGER, unable INTEGER, fn INTEGER, '
+                'fp INTEGER, flags INTEGER)')
+        # Top level nodes have no parent to update.
+        for depth in xrange(max_depth or 0, 1, -1):
+            execute('DELETE FROM children')
+            execute('INSERT INTO children SELECT parent_id, SUM(total_cnt), '
+                    'SUM(total_bytes), SUM(num_unable_to_shorten), MAX(longest_fn_length), '
+                    'MAX(longest_fp_length), %s FROM nodes WHERE depth = ? '
+                    'GROUP BY parent_id' % flags, (depth,))
+            execute('UPDATE nodes SET '
+                    'subdir_cnt = subdir_cnt + (SELECT cnt FROM children c '
+                    'WHERE c.id = nodes.id), '
+                    'total_cnt = total_cnt + (SELECT cnt FROM children c '
+                    'WHERE c.id = nodes.id), '
+                    'total_bytes = total_bytes + (SELECT bytes FROM '
+                    'children c WHERE c.id = nodes.id), '
+                    'num_unable_to_shorten = num_unable_to_shorten + '
+                    '(SELECT unable FROM children c WHERE c.id = nodes.id), '
+                    'longest_fn_length = MAX(longest_fn_length, (SELECT fn '
+                    'FROM children c WHERE c.id = nodes.id)), '
+                    'longest_fp_length = MAX(longest_fp_length, (SELECT fp '
+                    'FROM children c WHERE c.id = nodes.id)), '
+                    'flags = flags | (SELECT flags FROM children c '
+                    'WHERE c.id = nodes.id) '
+                    'WHERE id IN (SELECT id FROM children)')
+        # Folder counts, over the nodes that are part of the tree.
+        execute('CREATE TEMP TABLE folders (id INTEGER PRIMARY KEY, '
+                'cnt INTEGER, direct INTEGER)')
+        execute('UPDATE nodes SET child_node_cnt = 0, direct_child_cnt = 0 '
+                'WHERE in_tree = 1')
+        for depth in xrange(max_depth or 0, 1, -1):
+            execute('DELETE FROM folders')
+            execute('INSERT INTO folders SELECT parent_id, '
+                    'SUM(child_node_cnt + 1), COUNT(*) FROM nodes '
+                    'WHERE depth = ? AND in_tree = 1 GROUP BY parent_id',
+                    (depth,))
+            execute('UPDATE nodes SET '
+                    'child_node_cnt = (SELECT cnt FROM folders f '
+                    'WHERE f.id = nodes.id), '
+                    'direct_child_cnt = (SELECT direct FROM folders f '
+                    'WHERE f.id = nodes.id) '
+                    'WHERE id IN (SELECT id FROM folders)')
+        execute('UPDATE nodes SET is_leaf = direct_child_cnt = 0, '
+                'local_plus_child_cnt = local_cnt + child_node_cnt, '
+                'subdir_plus_child_cnt = subdir_cnt + child_node_cnt, '
+                'total_plus_child_cnt = local_cnt + subdir_cnt + '
+                '2 * child_node_cnt WHERE in_tree = 1')
+        execute('DROP TABLE children')
+        execute('DROP TABLE folders')
+        self.conn.commit()
+    
+    def read_nodes(self, nodes):
+        """Copies the node columns back into a NodeStore.
+        
+        @param nodes: The NodeStore the rows were written from.
+        
+        """
+        columns = [nodes.columns[c] for c in self.columns]
+        cursor = self.conn.execute('SELECT %s FROM nodes ORDER BY id' %
+                                   ', '.join(self.columns))
+        for (node_id, row) in enumerate(cursor):
+            for (column, value) in zip(columns, row):
+                column[node_id] = value
+    
+    def close(self):
+        self.conn.close()
+
+
+class ExternalSorter(object):
+    
+    """Sorts (key, value) records with bounded memory.
+    
+    Records are buffered in a dictionary by key.  When the buffer goes
+    over the memory budget it is sorted and written to a run file, and
+    the runs are k-way merged when the records are read back.  Values
+    with the same key are combined, in the buffer and in the merge, with
+    the combine function.  Values of a key are combined in the order they
+    were added.
+    
+    """
+    
+    # Maximum number of runs merged at once.
+    FAN_IN = 64
+    
+    def __init__(self, budget, directory=None, combine=None, factory=None):
+        """Constructs an empty sorter.
+        
+        @param budget: The approximate number of bytes of records to
+                buffer before writing a run.
+        @keyword directory: The directory of the run files.
+                Defaults to the system temporary directory.
+        @keyword combine: Function combining two values of a key into one.
+                Defaults to keeping the first.
+        @keyword factory: Function returning a new value for setdefault.
+        
+        """
+        self.budget = budget
+        self.directory = directory
+        self.combine = combine if combine else lambda a, b: a
+        self.factory = factory
+        self.runs = []
+        self._buffer = {}
+        self._nbytes = 0
+        self.count = 0
+    
+    def setdefault(self, key, size=0):
+        """Returns the buffered value of key, adding a new one if needed.
+        
+        The value may be changed in place until the next new key is added.
+        
+        @param key: The record key.
+        @keyword size: The approximate size of the record in bytes.
+        
+        """
+        value = self._buffer.get(key)
+        if value is None:
+            value = self.factory()
+            self.add(key, value, size)
+        return value
+    
+    def add(self, key, value, size=0):
+        """Adds a record.
+        
+        @param key: The record key.
+        @param value: The record value.
+        @keyword size: The approximate size of the record in bytes.
+        
+        """
+        if key in self._buffer:
+            self._buffer[key] = self.combine(self._buffer[key], value)
+            return
+        if self._buffer and self._nbytes + size > self.budget:
+            self.flush()
+        self._buffer[key] = value
+        self._nbytes += size
+        self.count += 1
+    
+    def flush(self):
+        """Writes the buffered records to a sorted run file."""
+        if not self._buffer:
+            return
+        self.runs.append(self.write_run(sorted(self._buffer.iteritems())))
+        self._buffer = {}
+        self._nbytes = 0
+    
+    def write_run(self, records):
+        """Writes records to a new run file and returns its path."""
+        (fd, path) = tempfile.mkstemp(prefix='run_', suffix='.spill',
+                                      dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            for record in records:
+                pickler.dump(record)
+                # Records are not referenced again.
+                pickler.clear_memo()
+        return path
+    
+    def read_run(self, path, order):
+        """Generator of the (key, order, value) records of a run file."""
+        with open(path, 'rb') as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    (key, value) = unpickler.load()
+                except EOFError:
+                    return
+                yield (key, order, value)
+    
+    def merge(self, runs):
+        """Generator of the combined records of runs, in key order."""
+        merged = heapq.merge(*[self.read_run(path, order)
+                               for (order, path) in enumerate(runs)])
+        combine = self.combine
+        (key, value) = (None, None)
+        for (k, order, v) in merged:
+            if value is not None and k == key:
+                value = combine(value, v)
+                continue
+            if value is not None:
+                yield (key, value)
+            (key, value) = (k, v)
+        if value is not None:
+            yield (key, value)
+    
+    def __iter__(self):
+        """Generator of the combined records, in key order."""
+        if not self.runs:
+            for record in sorted(self._buffer.iteritems()):
+                yield record
+            return
+        self.flush()
+        # Merge down to FAN_IN runs first, keeping runs in order.
+        while len(self.runs) > self.FAN_IN:
+            runs = []
+            for i in xrange(0, len(self.runs), self.FAN_IN):
+                group = self.runs[i:i + self.FAN_IN]
+                runs.append(self.write_run(self.merge(group)))
+                for path in group:
+                    os.remove(path)
+            self.runs = runs
+        for record in self.merge(self.runs):
+            yield record
+    
+    def close(self):
+        """Removes the run files and drops the buffer."""
+        for path in self.runs:
+            if os.path.exists(path):
+                os.remove(path)
+        self.runs = []
+        self._buffer = {}
+        self._nbytes = 0
+
+
+class RunMetrics(object):
+    
+    """Timings and memory figures of the phases of a run.
+    
+    Each phase records its wall time, CPU time of this process and of the
+    worker processes it waited for, and the peak RSS at its end.  Callers
+    may add their own figures (eg: lines) to the record of a phase.
+    
+    Peak RSS comes from getrusage, where available.  The top allocators
+    are only collected when tracemalloc is available and tracing.
+    
+    With profiling on (see set_profiling), each phase also writes a cProfile
+    .pstats file and/or a memory snapshot of its own.
+    
+    """
+    
+    def __init__(self):
+        # [{'name':name, 'wall_seconds':seconds, ...}, ...]
+        self.phases = []
+        self._start = (time.time(), self.cpu_times())
+        self.directory = None
+        self.suffix = None
+        self.profile = False
+        self.profile_memory = False
+    
+    def set_profiling(self, directory, suffix, profile=False,
+                      profile_memory=False):
+        """Turns on profiling of the phases.
+        
+        @param directory: The directory of the profile files.
+        @param suffix: Suffix of the profile file names.  Eg: a timestamp
+        @keyword profile: Runs each phase under cProfile and writes its
+                stats to <directory>/profile_<phase>_<suffix>.pstats.
+        @keyword profile_memory: Writes a memory snapshot at the end of each
+                phase.  With tracemalloc, this is a tracemalloc snapshot in
+                memory_<phase>_<suffix>.tracemalloc (tracing starts here).
+                Otherwise it is a census of live objects by type, as JSON in
+                memory_<phase>_<suffix>.json.
+        
+        """
+        self.directory = directory
+        self.suffix = suffix
+        self.profile = profile
+        self.profile_memory = profile_memory
+        if (profile_memory and tracemalloc is not None and
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+    
+    def cpu_times(self):
+        """Returns the CPU seconds of this process and of its waited for
+        children, as (self_seconds, children_seconds).
+        
+        """
+        if resource is None:
+            times = os.times()
+            return (times[0] + times[1], times[2] + times[3])
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return (own.ru_utime + own.ru_stime,
+                children.ru_utime + children.ru_stime)
+    
+    def peak_rss(self):
+        """Returns the peak RSS of this process and of its largest waited
+        for child, in kilobytes, as (self_kb, children_kb).  Both are None
+        without getrusage.
+        
+        """
+        if resource is None:
+            return (None, None)
+        # ru_maxrss is in bytes on OS X, kilobytes elsewhere.
+        scale = 1024 if sys.platform == 'darwin' else 1
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+    
+    @contextmanager
+    def phase(self, name):
+        """Context manager that records a phase.
+        
+        @param name: The name of the phase.  Eg: 'ingest'
+        @return: The record of the phase, for the caller to add figures to.
+        
+        """
+        record = {'name':name}
+        self.phases.append(record)
+        profiler = cProfile.Profile() if self.profile else None
+        wall = time.time()
+        cpu = self.cpu_times()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            end = self.cpu_times()
+            record['wall_seconds'] = round(time.time() - wall, 3)
+            record['cpu_seconds'] = round(end[0] - cpu[0], 3)
+            record['children_cpu_seconds'] = round(end[1] - cpu[1], 3)
+            (record['peak_rss_kb'],
+             record['children_peak_rss_kb']) = self.peak_rss()
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                (current, peak) = tracemalloc.get_traced_memory()
+                record['traced_kb'] = current // 1024
+                record['traced_peak_kb'] = peak // 1024
+            if 'lines' in record and record['wall_seconds']:
+                record['lines_per_second'] = round(record['lines'] /
+                                                   record['wall_seconds'], 1)
+            if profiler is not None:
+                record['profile'] = self.profile_path('profile', name,
+                                                      'pstats')
+                profiler.dump_stats(record['profile'])
+            if self.profile_memory:
+                record['memory_snapshot'] = self.write_memory_snapshot(name)
+    
+    def profile_path(self, kind, name, extension):
+        """Returns the path of a profile file of a phase."""
+        return os.path.join(self.directory, '%s_%s_%s.%s' %
+                            (kind, name, self.suffix, extension))
+    
+    def write_memory_snapshot(self, name):
+        """Writes a memory snapshot for a phase.
+        
+        @param name: The name of the phase.
+        @return: The path of the snapshot file.
+        
+        """
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            path = self.profile_path('memory', name, 'tracemalloc')
+            tracemalloc.take_snapshot().dump(path)
+            return path
+        path = self.profile_path('memory', name, 'json')
+        snapshot = {'phase':name,
+                    'peak_rss_kb':self.peak_rss()[0],
+                    'types':self.heap_census()}
+        with open(path, 'w') as f:
+            json.dump(snapshot, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
+        return path
+    
+    def heap_census(self, limit=MEMORY_CENSUS_TYPES):
+        """Counts the live objects by type.
+        
+        Covers the objects tracked by the garbage collector and the objects
+        they refer to, which takes in strings, numbers and arrays.
+        
+        @keyword limit: The number of types to return.
+        @return: List of {'type', 'count', 'size_kb'} dicts, largest first.
+        
+        """
+        seen = set()
+        # {type: [count, bytes], ...}
+        census = {}
+        def add(objs):
+            """Counts the objects not seen yet, and returns the ones whose
+            referents are not found through the garbage collector.
+            
+            """
+            expand = []
+            for obj in objs:
+                if id(obj) in seen:
+                    continue
+                seen.add(id(obj))
+                entry = census.setdefault(type(obj), [0, 0])
+                entry[0] += 1
+                entry[1] += sys.getsizeof(obj, 0)
+                if not gc.is_tracked(obj):
+                    expand.append(obj)
+            return expand
+        objects = gc.get_objects()
+        add(objects)
+        # Untracked containers (eg: dicts of arrays) hide their items.
+        while objects:
+            expand = []
+            for i in xrange(0, len(objects), 10000):
+                expand.extend(add(gc.get_referents(*objects[i:i + 10000])))
+            objects = expand
+        stats = sorted(census.iteritems(), key=lambda item: -item[1][1])
+        return [{'type':'%s.%s' % (_type.__module__, _type.__name__),
+                 'count':count, 'size_kb':size // 1024}
+                for (_type, (count, size)) in stats[:limit]]
+    
+    def top_allocators(self, limit=METRICS_TOP_ALLOCATORS):
+        """Returns the source lines holding the most traced memory, or None
+        if tracemalloc is not tracing.
+        
+        @keyword limit: The number of allocators to return.
+        
+        """
+        if tracemalloc is None or not tracemalloc.is_tracing():
+            return None
+        stats = tracemalloc.take_snapshot().statistics('lineno')
+        return [{'location':'%s:%s' % (stat.traceback[0].filename,
+                                       stat.traceback[0].lineno),
+                 'size_kb':stat.size // 1024,
+                 'count':stat.count} for stat in stats[:limit]]
+    
+    def write(self, path, summary):
+        """Writes the metrics to a JSON file.
+        
+        @param path: The path of the JSON file.
+        @param summary: Dict of run wide figures (eg: node and outlier
+                counts) written along with the phases.
+        
+        """
+        end = self.cpu_times()
+        metrics = dict(summary)
+        metrics['wall_seconds'] = round(time.time() - self._start[0], 3)
+        metrics['cpu_seconds'] = round(end[0] - self._start[1][0], 3)
+        metrics['children_cpu_seconds'] = round(end[1] - self._start[1][1], 3)
+        (metrics['peak_rss_kb'],
+         metrics['children_peak_rss_kb']) = self.peak_rss()
+        metrics['phases'] = self.phases
+        metrics['top_allocators'] = self.top_allocators()
+        with open(path, 'w') as f:
+            json.dump(metrics, f, indent=2, sort_keys=True,
+                      separators=(',', ': '))
+            f.write('\n')
 
 
 class Analyzer(object):
@@ -303,16 +1417,50 @@ class Analyzer(object):
     _trimmed = 0
     _unable_to_shorten = 0
     _debug = False
+    # Bits returned by the walk_tree visit functions.
+    EMIT = 1
+    DESCEND = 2
+    # Headers of the batch and outliers results.
+    BATCH_HEADER = ['Depth',
+                    'File Limit',
+                    'Directory Path',
+                    'Num Local Files',
+                    'Num Sub-directory Files',
+                    'Total Files',
+                    'Local Path Length',
+                    'Longest Filename',
+                    'Longest Filepath',
+                    'Has Outliers 1',
+                    'Has Outliers 2',
+                    'Has Shortened Paths',
+                    'Num Local Outliers 1',
+                    'Num Local Outliers 2'
+                    ]
+    # Extra batch results columns when sizes are read.
+    BYTES_HEADER = ['Byte Limit',
+                    'Local Bytes',
+                    'Sub-directory Bytes',
+                    'Total Bytes'
+                    ]
+    OUTLIERS1_HEADER = ['Depth','Filename Length','Filename','Directory Path']
+    OUTLIERS2_HEADER = ['Depth','Parent File Path Length','Parent File Path',
+                        'Directory Path']
     
     def __init__(self, _file, encoding=None, delimiter=None, path_sep=None,
                  file_limit=None, max_path_length=None,
                  max_parent_file_length=None, max_file_length=None,
-                 search_local=False):
+                 search_local=False, use_numpy=False, workers=None,
+                 load_snapshot=None, save_snapshot=None, file_limits=None,
+                 target_batches=None, spill_dir=None, database=None,
+                 profile=False, profile_memory=False, scan_dir=None,
+                 delta=None, byte_limit=None, size_column=None,
+                 worker=False):
         """Constructs a new Analyzer object.
         
-        @param _file: The file path to analyze.
-        @keyword encoding: The encoding of the file.
-                If None, tries to guess encoding type.
+        @param _file: The file path to analyze, or a list of file paths
+                (eg: one listing per custodian) to analyze as one tree.
+        @keyword encoding: The encoding of the file(s).
+                If None, tries to guess encoding type of each file.
                 Eg: utf-8
         @keyword delimiter: The field delimiter that appears in the file.
                 Defaults to '\t'.
@@ -331,20 +1479,109 @@ class Analyzer(object):
                 Defaults to 190.
         @keyword search_local: Searches the local count instead of total for
                 file_limit.
+        @keyword use_numpy: Aggregates subtree totals with NumPy, one
+                vectorized update per depth level.
+        @keyword workers: The number of processes that read the file.
+                Defaults to 1.
+        @keyword load_snapshot: Path of a snapshot written by a previous run.
+                The tree is loaded from it instead of reading _file, which
+                may then be None.  Unset delimiter, path_sep and max_*
+                lengths are taken from the snapshot.
+        @keyword save_snapshot: Path to save a snapshot of the tree to, once
+                it has been read and aggregated.
+        @keyword file_limits: List of file limits to sweep instead of the
+                single file_limit.  Eg: [10000, 20000, 30000]
+        @keyword target_batches: Tunes file_limit for about this number of
+                batches before writing the results.
+        @keyword spill_dir: The directory of the outlier spill files.
+                Defaults to the output directory.
+        @keyword database: Path of a SQLite database to write the nodes and
+                outliers to.  The counters are then rolled up with SQL.
+        @keyword profile: Runs each phase under cProfile, writing a .pstats
+                file per phase to the output directory.
+        @keyword profile_memory: Writes a memory snapshot per phase to the
+                output directory.
+        @keyword scan_dir: A directory (eg: a mounted image) to scan instead
+                of reading _file, which may then be None.  The encoding
+                defaults to the file system encoding, path_sep to os.sep,
+                and the output directory is made in the current directory.
+        @keyword delta: Path of a delta listing of added and removed paths
+                to apply to the tree loaded from load_snapshot, see
+                apply_delta.  Only the changes to the batch and outliers
+                results are written.  Cannot be used with search_local.
+        @keyword byte_limit: The search limit in bytes, checked along with
+                file_limit.  Batches must satisfy both.  Requires sizes.
+        @keyword size_column: The column of the file sizes in bytes, which
+                are rolled up alongside the file counts.
+                Defaults to DEFAULT_SIZE_COLUMN if byte_limit is given,
+                otherwise sizes are not read.  With load_snapshot, taken
+                from the snapshot if None.
+        @keyword worker: Internal use only. Constructs a worker that only
+                ingests part of the file and has no output directory.
         
         """
+        if isinstance(_file, (list, tuple)):
+            self.files = list(_file)
+            _file = self.files[0] if self.files else None
+        else:
+            self.files = [_file] if _file else []
         self._file = _file
+        self.scan_dir = scan_dir
+        self.load_snapshot = load_snapshot
+        if delta and (not load_snapshot or search_local):
+            raise ValueError('delta requires load_snapshot, and cannot be '
+                             'used with search_local.')
+        self.delta = delta
+        # The encoding of the delta listing, detected if None.
+        self.delta_encoding = encoding
+        # {'lines':lines, 'added':paths, 'removed':paths, ...}
+        self.delta_counts = {}
+        self.save_snapshot = save_snapshot
+        # Arguments checked against a loaded snapshot.
+        self._snapshot_args = {'path_sep':path_sep,
+                               'max_path_length':max_path_length,
+                               'max_parent_file_length':max_parent_file_length,
+                               'max_file_length':max_file_length,
+                               'size_column':size_column}
         # For encoding detection.
-        if encoding is None:
+        if load_snapshot:
+            self.encoding = encoding
+        elif encoding is None and scan_dir:
+            self.encoding = sys.getfilesystemencoding() or 'utf-8'
+        elif encoding is None:
             self.detect_encoding()
         else:
             self.encoding = encoding
+        # {file path: encoding, ...}
+        self.encodings = dict.fromkeys(self.files, self.encoding)
+        if encoding is None and not load_snapshot and len(self.files) > 1:
+            for source in self.files[1:]:
+                self._file = source
+                self.detect_encoding()
+                self.encodings[source] = self.encoding
+            self.set_source(self.files[0])
+        # Counters of each file read, in order.
+        # [{'file':path, 'encoding':encoding, 'lines':lines, ...}, ...]
+        self.source_counts = []
         self.delimiter = delimiter if delimiter else '\t'
-        self.path_sep = path_sep if path_sep else '\\'
+        if path_sep:
+            self.path_sep = path_sep
+        else:
+            self.path_sep = os.sep if scan_dir else '\\'
         try:
             self.file_limit = int(file_limit)
         except (ValueError,TypeError):
             self.file_limit = 30000
+        self.file_limits = [int(limit) for limit in file_limits or []]
+        self.byte_limit = int(byte_limit) if byte_limit is not None else None
+        if size_column is None and byte_limit is not None and not load_snapshot:
+            size_column = DEFAULT_SIZE_COLUMN
+        # None if sizes are not read.
+        self.size_column = size_column
+        try:
+            self.target_batches = int(target_batches)
+        except (ValueError,TypeError):
+            self.target_batches = None
         try:
             self.max_path_length = int(max_path_length)
         except (ValueError,TypeError):
@@ -358,40 +1595,56 @@ class Analyzer(object):
         except (ValueError,TypeError):
             self.max_file_length = 190
         self.search_local = search_local
-        # For holding file counts of each directory.
-        # {dir_path: {'local_cnt': 0,
-        #             'subdir_cnt': 0,
-        #             'total_cnt': 0,
-        #             'long_file_cnt': 0,
-        #             'long_file_parent_cnt':0,
-        #             'longest_file_length': 0,
-        #             'batch':0
-        #             }, ...
-        #  '_total':0
-        #  }
-        self.dir_file_cnts = {'_total':0}
+        self.database = database
+        if use_numpy and np is None:
+            raise ImportError('use_numpy requires the numpy package.')
+        self.use_numpy = use_numpy
+        try:
+            self.workers = max(1, int(workers))
+        except (ValueError,TypeError):
+            self.workers = 1
         # For constructing file directory structure.
-        self.dir_tree = Tree()
-        # Lookup table for tree nodes, one via path, one via id.
-        self.nodes_path = {}
-        self.nodes_id = {}
-        # Lookup table for id -> path
-        self.nodes_id_path_ptr = {}
+        # Node ids on the trie are shared with the Node lookup table.
+        self.paths = PathTrie()
+        self.path_cache = PathCache(self.paths, self.path_sep)
+        # Node attributes, indexed by node id.
+        # Row 0 is the root of the path trie.
+        self.nodes = NodeStore()
+        self.nodes.add({'depth':0})
+        # Last directory a file was added to, as (dir_path, node).
+        self._last_dir = (None, None)
+        # Last directory an over length path was shortened in, as
+        # (node_id, path offsets, number of folders marked can_shorten).
+        self._shorten_cache = (None, None, 0)
         # nodes_depth = {depth: [node_id, ...], ...}
         self.nodes_depth = {}
         # Outliers.
-        # {id: Outlier, ...}
-        self.outliers1 = {}
-        self.outliers2 = {}
+        # Outliers 1 and 2 are spilled to disk, see open_spills.
+        self.outliers1 = None
+        self.outliers2 = None
+        # {node_id: Outlier3, ...}
         self.outliers3 = {}
         # For keeping track of path names greater than max_path_length.
         self.max_path_length_cnts = {}
+        self.metrics = RunMetrics()
+        if worker:
+            self.open_spills(spill_dir)
+            return
         # Make top level directory
-        curdir = os.path.sep.join(self._file.split(os.path.sep)[:-1])
+        if scan_dir:
+            # Do not write into the scanned directory.
+            curdir = os.getcwd()
+        else:
+            source = self._file if self._file else load_snapshot
+            curdir = os.path.sep.join(source.split(os.path.sep)[:-1])
         self.top_dir = os.path.join(curdir,str(int(time.time())))
         if not os.path.exists(self.top_dir):
             os.makedirs(self.top_dir)
         self.timestamp = datetime.now().strftime('ts%Y%m%dT%H%M%S')
+        self.open_spills(spill_dir if spill_dir else self.top_dir)
+        if profile or profile_memory:
+            self.metrics.set_profiling(self.top_dir, self.timestamp, profile,
+                                       profile_memory)
         
      
     def process(self):
@@ -404,41 +1657,1128 @@ class Analyzer(object):
         4. Update node attributes, including counters.
         
         """
-        curdir = os.path.sep.join(self._file.split(os.path.sep)[:-1])
-        top_dir = os.path.join(curdir,str(int(time.time())))
-        if not os.path.exists(top_dir):
-            os.makedirs(top_dir)
-        message = 'Starting Process'
+        message = 'Starting Process'
+        log('INFO', logfile, message, print_stdout=True)
+        try:
+            self.analyze()
+        finally:
+            self.close_spills()
+            self.write_metrics()
+        message = 'Finished processing.'
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def analyze(self):
+        """Reads or loads the tree and writes the results."""
+        if self.load_snapshot:
+            message = 'Loading snapshot %s...' % (self.load_snapshot)
+            log('INFO', logfile, message, print_stdout=True)
+            with self.metrics.phase('read_snapshot'):
+                self.read_snapshot(self.load_snapshot)
+            message = ['Loaded %s lines from snapshot.' % (self._file_line_cnt)]
+            message.append('Number of nodes: %s' % (len(self.paths)))
+            log('INFO', logfile, '\n'.join(message), print_stdout=True)
+        else:
+            self.build_tree()
+        if self.delta:
+            message = 'Applying delta %s...' % (self.delta)
+            log('INFO', logfile, message, print_stdout=True)
+            with self.metrics.phase('apply_delta') as phase:
+                self.apply_delta()
+                phase['lines'] = self.delta_counts['lines']
+        if self.save_snapshot and (self.delta or not self.load_snapshot):
+            message = 'Saving snapshot %s...' % (self.save_snapshot)
+            log('INFO', logfile, message, print_stdout=True)
+            with self.metrics.phase('write_snapshot'):
+                self.write_snapshot(self.save_snapshot)
+        if self.delta:
+            with self.metrics.phase('write_delta_results'):
+                self.write_delta_results()
+            return
+        message = 'Preparing results...'
+        log('INFO', logfile, message, print_stdout=True)
+        if len(self.source_counts) > 1:
+            self.write_source_results()
+        if self.file_limits:
+            with self.metrics.phase('sweep_file_limits'):
+                self.sweep_file_limits()
+        else:
+            if self.target_batches is not None:
+                message = 'Tuning file limit for %s batches...' % (self.target_batches)
+                log('INFO', logfile, message, print_stdout=True)
+                with self.metrics.phase('tune_file_limit'):
+                    self.file_limit = self.tune_file_limit(self.target_batches)
+            with self.metrics.phase('prepare_batch_results'):
+                self.prepare_batch_results()
+    
+    def write_source_results(self):
+        """Writes the counters of each file read to a sources file."""
+        sources_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                    ('sources',self.timestamp))
+        with open(sources_file,'w') as sources_fp:
+            sources_writer = csv.writer(sources_fp, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            header = ['Source File',
+                      'Encoding',
+                      'Num Lines',
+                      'Num Outliers 1',
+                      'Num Outliers 2'
+                      ]
+            self.writerow(sources_writer, header)
+            for counts in self.source_counts:
+                source = counts['file']
+                if isinstance(source, str):
+                    source = source.decode(sys.getfilesystemencoding() or
+                                           'utf-8', 'replace')
+                self.writerow(sources_writer, [source,
+                                               counts['encoding'],
+                                               counts['lines'],
+                                               counts['outliers1'],
+                                               counts['outliers2']])
+        message = 'Source counters saved to file: %s' % sources_file
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def write_metrics(self):
+        """Writes the run metrics to a JSON file in the output directory."""
+        metrics_file = os.path.join(self.top_dir,'%s_%s.json' %
+                                    ('metrics',self.timestamp))
+        self.metrics.write(metrics_file, self.get_run_counts())
+        message = 'Metrics saved to file: %s' % metrics_file
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def get_run_counts(self):
+        """Returns a dict of the run wide counters, for the metrics."""
+        return {'file':self._file,
+                'scan_dir':self.scan_dir,
+                'snapshot':self.load_snapshot,
+                'workers':self.workers,
+                'lines':self._file_line_cnt,
+                'nodes':len(self.paths),
+                'outliers1':len(self.outliers1),
+                'outliers2':len(self.outliers2),
+                'outliers3':len(self.outliers3),
+                'batches':self._dirs_within_limit,
+                'trimmed':self._trimmed,
+                'dirs_over_limit':self._dirs_over_limit,
+                'unable_to_shorten':self._unable_to_shorten,
+                'sources':self.source_counts,
+                'delta':self.delta_counts}
+    
+    def open_spills(self, directory=None):
+        """Creates the spill files of outliers 1 and 2.
+        
+        @keyword directory: The directory of the spill files.
+        
+        """
+        self.outliers1 = OutlierSpill(directory, 'outliers1')
+        self.outliers2 = OutlierSpill(directory, 'outliers2')
+    
+    def close_spills(self):
+        """Removes the spill files.  The outlier counts are kept."""
+        self.outliers1.close()
+        self.outliers2.close()
+    
+    def build_tree(self):
+        """Reads the file and aggregates the counters up the tree."""
+        with self.metrics.phase('ingest') as phase:
+            if self.scan_dir:
+                self.scan()
+            else:
+                self.ingest_files()
+            phase['lines'] = self._file_line_cnt
+        message = 'Done reading %s lines.' % (self._file_line_cnt)
+        log('INFO', logfile, message, print_stdout=True)
+        if self.database:
+            with self.metrics.phase('rollup_database'):
+                self.rollup_database()
+            return
+        # Update tree node attributes.
+        message = ['Number of nodes: %s' % (len(self.paths))]
+        message.append('Updating parent node attributes lowest depth up...')
+        log('INFO', logfile, '\n'.join(message), print_stdout=True)
+        with self.metrics.phase('depth_first_reverse_update'):
+            self.depth_first_reverse_update()
+        
+        # Update child (folder) counters.
+        message = 'Updating child (folder) counters...'
+        log('INFO', logfile, message, print_stdout=True)
+        with self.metrics.phase('update_node_child_cnts'):
+            self.update_node_child_cnts()
+    
+    def rollup_database(self):
+        """Writes the nodes and outliers to the database, rolls up the
+        counters there and reads them back.
+        
+        """
+        message = ['Number of nodes: %s' % (len(self.paths))]
+        message.append('Writing nodes to database %s...' % (self.database))
+        log('INFO', logfile, '\n'.join(message), print_stdout=True)
+        db = NodeDatabase(self.database)
+        try:
+            db.write_nodes(self)
+            db.write_outliers(self)
+            message = 'Rolling up node attributes in database...'
+            log('INFO', logfile, message, print_stdout=True)
+            db.rollup([self.nodes.flag_mask(name) for name in
+                       ('has_outliers1', 'has_outliers2', 'has_outliers3')])
+            db.read_nodes(self.nodes)
+        finally:
+            db.close()
+    
+    def write_snapshot(self, path):
+        """Saves the aggregated tree to a binary snapshot file.
+        
+        The file starts with SNAPSHOT_MAGIC and the length of a pickled
+        header, which holds the settings, counters, outliers 3 and the
+        layout of the trie and NodeStore arrays written raw after it.
+        The outlier 1 and 2 spill records are copied after the arrays.
+        
+        @param path: The snapshot file path.
+        
+        """
+        arrays = [('paths.%s' % name, getattr(self.paths, name))
+                  for name in PathTrie.ARRAYS]
+        arrays.extend(('nodes.%s' % name, self.nodes.columns[name])
+                      for name in sorted(self.nodes.columns))
+        meta = {'version':SNAPSHOT_VERSION,
+                'byteorder':sys.byteorder,
+                'file':self._file,
+                'sources':self.source_counts,
+                'encoding':self.encoding,
+                'delimiter':self.delimiter,
+                'path_sep':self.path_sep,
+                'max_path_length':self.max_path_length,
+                'max_parent_file_length':self.max_parent_file_length,
+                'max_file_length':self.max_file_length,
+                'size_column':self.size_column,
+                'file_line_cnt':self._file_line_cnt,
+                'root_in_tree':0 in self.nodes_depth,
+                'components':self.paths.components,
+                'in_tree':str(self.paths.in_tree),
+                'spills':[(len(spill), spill.nbytes()) for spill
+                          in (self.outliers1, self.outliers2)],
+                'outliers3':[(v.id, v.node_id, v.shortened, v._file) for v
+                             in self.outliers3.itervalues()],
+                'arrays':[(name, a.typecode, len(a)) for (name, a) in arrays]
+                }
+        data = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(struct.pack('<Q', len(data)))
+            f.write(data)
+            for (name, a) in arrays:
+                a.tofile(f)
+            self.outliers1.dump(f)
+            self.outliers2.dump(f)
+    
+    def read_snapshot(self, path):
+        """Loads a tree saved by write_snapshot.
+        
+        @param path: The snapshot file path.
+        @raise ValueError: If the file is not a snapshot, has an unknown
+                version, was built with other path_sep, max_* lengths or
+                size_column, or without sizes when byte_limit is set.
+        
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise ValueError('%s is not a snapshot file.' % path)
+            (size,) = struct.unpack('<Q', f.read(8))
+            meta = pickle.loads(f.read(size))
+            if meta['version'] != SNAPSHOT_VERSION:
+                raise ValueError('Unsupported snapshot version %s.' %
+                                 meta['version'])
+            # Outliers, shortened paths and byte counters depend on these
+            # settings.
+            for (name, value) in sorted(self._snapshot_args.iteritems()):
+                if value is None:
+                    setattr(self, name, meta.get(name))
+                elif str(value) != str(meta.get(name)):
+                    raise ValueError('Snapshot was built with %s=%r, '
+                                     'got %r.' % (name, meta.get(name), value))
+            if self.byte_limit is not None and not self.size_column:
+                raise ValueError('Snapshot was built without sizes, '
+                                 'byte_limit cannot be used.')
+            arrays = dict(('paths.%s' % name, getattr(self.paths, name))
+                          for name in PathTrie.ARRAYS)
+            arrays.update(('nodes.%s' % name, column) for (name, column)
+                          in self.nodes.columns.iteritems())
+            for (name, typecode, length) in meta['arrays']:
+                a = arrays[name]
+                if a.typecode != typecode:
+                    raise ValueError('Snapshot column %s has type %s.' %
+                                     (name, typecode))
+                del a[:]
+                a.fromfile(f, length)
+                if meta['byteorder'] != sys.byteorder:
+                    a.byteswap()
+            for (spill, (count, size)) in zip((self.outliers1, self.outliers2),
+                                              meta['spills']):
+                spill.load(f, count, size)
+        self.nodes.fill()
+        if self._file is None:
+            self._file = meta['file']
+        self.source_counts = meta.get('sources', [])
+        self.encoding = meta['encoding']
+        self.delimiter = meta['delimiter']
+        self._file_line_cnt = meta['file_line_cnt']
+        self.paths.components = meta['components']
+        self.paths.in_tree = bytearray(meta['in_tree'])
+        self.paths.rebuild_index()
+        # path_sep may have been taken from the snapshot.
+        self.path_cache = PathCache(self.paths, self.path_sep)
+        self.nodes_depth = {}
+        if meta['root_in_tree']:
+            self.nodes_depth[0] = [0]
+        depth = self.nodes.columns['depth']
+        for node_id in xrange(1, len(depth)):
+            self.nodes_depth.setdefault(depth[node_id], []).append(node_id)
+        # Restore the outliers under their original ids.
+        self.outliers3.clear()
+        for record in meta['outliers3']:
+            outlier = Outlier3(data=dict(zip(('id','node_id','shortened','_file'),
+                                             record)))
+            self.outliers3[outlier.node_id] = outlier
+            Outlier3._COUNT = max(Outlier3._COUNT, outlier.id)
+    
+    def apply_delta(self):
+        """Applies the delta listing to the loaded tree.
+        
+        The delta listing has the columns of a listing plus a Change column
+        of Added or Removed.  A removed folder takes its whole subtree off
+        the tree.  Removed paths are applied before added ones, so a folder
+        can be replaced by removing it and adding its new files.  The
+        entries are trusted: adding a file already on the tree counts it
+        twice.
+        
+        Only the nodes on the paths changed, and their ancestors, are
+        marked dirty and have their counters and outlier flags worked out
+        again, from their own counters and those of their children.  The
+        longest filename and filepath lengths are maximums, so removing
+        files does not lower them until a full run.  Likewise the shortened
+        path of a folder is only dropped once its last over length file is
+        removed.  The outlier 1 and 2 spills are rewritten once if
+        outliers were removed.  If the tree has sizes, the delta listing
+        must have the size_column too, and the sizes of the added and
+        removed files go on and off the byte counters.
+        
+        """
+        # {node id: (in_tree, total_plus_child_cnt, total_bytes) before the
+        # delta, ...}
+        self._delta_before = {}
+        # {node id: [dirty child node id, ...], ...}
+        self._dirty_children = {}
+        # Changes to the outliers, as (change, node id, filename).
+        self._delta_outliers1 = []
+        self._delta_outliers2 = []
+        self._last_dir = (None, None)
+        counts = dict.fromkeys(('lines', 'added', 'removed', 'missing'), 0)
+        self.delta_counts = counts
+        # The delta listing is read like a listing, then the snapshot
+        # source is put back.
+        (source, encoding) = (self._file, self.encoding)
+        self._file = self.delta
+        if self.delta_encoding:
+            self.encoding = self.delta_encoding
+        else:
+            self.detect_encoding()
+        self.delta_encoding = self.encoding
+        try:
+            changes = {DELTA_ADDED:[], DELTA_REMOVED:[]}
+            file_gen = self.file_generator()
+            header = file_gen.next()
+            counts['lines'] += 1
+            fields = self.parse_header(header)
+            if 'Change' not in fields:
+                raise ValueError('Change column not found in delta header.')
+            if self.size_column and self.size_column not in fields:
+                raise ValueError('%s column not found in delta header.' %
+                                 self.size_column)
+            self._header = None
+            for line in file_gen:
+                counts['lines'] += 1
+                item = self.get_line_item(line, header)
+                change = item.get('Change')
+                if change not in changes:
+                    message = ('WARNING: Unknown change \'%s\'. Item_Path=\'%s\'' %
+                               (change, item.get('Item_Path')))
+                    log('INFO', logfile, message, print_stdout=True)
+                    continue
+                path = self.extract_path(item.get('Item_Path') or u'')
+                size = None
+                if self.size_column:
+                    size = self.parse_size(item.get(self.size_column) or u'')
+                if path:
+                    changes[change].append((path, item.get('Category') == 'Folder',
+                                            size))
+        finally:
+            (self._file, self.encoding) = (source, encoding)
+            self._header = None
+        # Removed paths.
+        discard1 = []
+        discard2 = []
+        removed_nodes = set()
+        for (path, folder, size) in changes[DELTA_REMOVED]:
+            result = self.remove_path(path, folder, size)
+            if (result is None and not folder and
+                    self.split_file_path(path)[0] in removed_nodes):
+                # Already removed with its folder.
+                result = []
+            if result is None:
+                counts['missing'] += 1
+                message = 'WARNING: Removed path not found: %s' % path
+                log('INFO', logfile, message, print_stdout=True)
+                continue
+            counts['removed'] += 1
+            if folder:
+                removed_nodes.update(result)
+            elif result == 'num_local_outliers1':
+                discard1.append(self.split_file_path(path))
+            elif result == 'num_local_outliers2':
+                discard2.append(self.split_file_path(path))
+        for (spill, discard, changed) in ((self.outliers1, discard1,
+                                           self._delta_outliers1),
+                                          (self.outliers2, discard2,
+                                           self._delta_outliers2)):
+            if discard or removed_nodes:
+                changed.extend((DELTA_REMOVED, node_id, _file) for
+                               (node_id, _file) in
+                               spill.discard(discard, removed_nodes))
+        # Added paths.
+        for (path, folder, size) in changes[DELTA_ADDED]:
+            counts['added'] += 1
+            if folder:
+                self.add_path(path, folder)
+                continue
+            (node_id, _file) = self.split_file_path(path, insert=True)
+            self.mark_dirty(node_id)
+            spill_counts = (len(self.outliers1), len(self.outliers2))
+            self.add_path(path, size=size)
+            if len(self.outliers1) > spill_counts[0]:
+                self._delta_outliers1.append((DELTA_ADDED, node_id, _file))
+            elif len(self.outliers2) > spill_counts[1]:
+                self._delta_outliers2.append((DELTA_ADDED, node_id, _file))
+        message = ('Applied %s added and %s removed paths, %s dirty nodes.' %
+                   (counts['added'], counts['removed'],
+                    len(self._delta_before)))
+        log('INFO', logfile, message, print_stdout=True)
+        self.update_dirty_nodes()
+    
+    def split_file_path(self, path, insert=False):
+        """Looks up the directory of a file path.
+        
+        @param path: The file path.
+        @keyword insert: Creates the directory nodes if needed.
+        @return: Tuple of (directory node id, filename).  The node id is -1
+                if the directory is not found.
+        
+        """
+        (dir_path, sep, _file) = path.rpartition(self.path_sep)
+        dir_path_list = dir_path.split(self.path_sep) if sep else []
+        if insert:
+            return (self.insert_nodes(dir_path_list).id, _file)
+        return (self.paths.find(dir_path_list), _file)
+    
+    def mark_dirty(self, node_id):
+        """Marks a node and its ancestors dirty, keeping the state the
+        batch results of the loaded tree were worked out from.
+        
+        @param node_id: The node id, before it is changed.
+        
+        """
+        before = self._delta_before
+        in_tree = self.paths.in_tree
+        total_plus_child_cnt = self.nodes.columns['total_plus_child_cnt']
+        total_bytes = self.nodes.columns['total_bytes']
+        parent = self.paths.parent
+        while node_id not in before:
+            before[node_id] = (in_tree[node_id], total_plus_child_cnt[node_id],
+                               total_bytes[node_id])
+            if node_id == 0:
+                break
+            parent_id = parent[node_id]
+            self._dirty_children.setdefault(parent_id, []).append(node_id)
+            node_id = parent_id
+    
+    def remove_path(self, path, folder=False, size=None):
+        """Removes a file or folder path from the tree.
+        
+        The local counters of the node are taken down, and the node marked
+        dirty.  The rolled up counters are worked out by update_dirty_nodes.
+        
+        @param path: The path, without the root folder.
+        @keyword folder: True if the path is a folder.
+        @keyword size: The size of the file in bytes, if sizes are read.
+        @return: None if the path is not on the tree.  For a folder, the
+                list of the node ids removed.  For a file, the name of the
+                local counter taken down.
+        
+        """
+        if folder:
+            node_id = self.paths.find(path.split(self.path_sep))
+            if node_id <= 0:
+                return None
+            if not self.paths.in_tree[node_id]:
+                # An empty folder, the results do not change.
+                return []
+            self.mark_dirty(node_id)
+            return self.remove_subtree(node_id)
+        (node_id, _file) = self.split_file_path(path)
+        if node_id == -1:
+            return None
+        # Same order of checks as find_outliers.
+        parent_file = self.path_sep.join(path.rsplit(self.path_sep, 2)[-2:])
+        if len(_file) > self.max_file_length:
+            name = 'num_local_outliers1'
+        elif len(parent_file) > self.max_parent_file_length:
+            name = 'num_local_outliers2'
+        elif len(path) > self.max_path_length:
+            name = 'num_local_outliers3'
+        else:
+            name = 'local_cnt'
+        column = self.nodes.columns[name]
+        if column[node_id] <= 0:
+            return None
+        self.mark_dirty(node_id)
+        column[node_id] -= 1
+        node = self.nodes[node_id]
+        if name == 'local_cnt':
+            node.total_cnt -= 1
+            if not node.local_cnt:
+                node.local_bytes = 0
+            elif size:
+                node.local_bytes = max(0, node.local_bytes - size)
+        elif name == 'num_local_outliers3' and not node.num_local_outliers3:
+            node.update({'shortened':False,
+                         'unable_to_shorten':False})
+            self.outliers3.pop(node_id, None)
+        return name
+    
+    def remove_subtree(self, node_id):
+        """Clears the local counters of a node and all the nodes below it.
+        
+        @param node_id: The node id, already marked dirty.
+        @return: List of the node ids cleared.
+        
+        """
+        before = self._delta_before
+        in_tree = self.paths.in_tree
+        total_plus_child_cnt = self.nodes.columns['total_plus_child_cnt']
+        total_bytes = self.nodes.columns['total_bytes']
+        first_child = self.paths.first_child
+        next_sibling = self.paths.next_sibling
+        flags = self.nodes.flags
+        mask = self.nodes.flag_mask('has_outliers1', 'has_outliers2',
+                                    'has_outliers3', 'shortened',
+                                    'unable_to_shorten', 'can_shorten')
+        removed = []
+        stack = [node_id]
+        while stack:
+            parent_id = stack.pop()
+            removed.append(parent_id)
+            child_id = first_child[parent_id]
+            while child_id != -1:
+                if child_id not in before:
+                    before[child_id] = (in_tree[child_id],
+                                        total_plus_child_cnt[child_id],
+                                        total_bytes[child_id])
+                    self._dirty_children.setdefault(parent_id, []).append(child_id)
+                stack.append(child_id)
+                child_id = next_sibling[child_id]
+        for removed_id in removed:
+            self.nodes[removed_id].update({'local_cnt':0,
+                                           'total_cnt':0,
+                                           'local_bytes':0,
+                                           'total_bytes':0,
+                                           'longest_fn_length':0,
+                                           'longest_fp_length':0,
+                                           'num_local_outliers1':0,
+                                           'num_local_outliers2':0,
+                                           'num_local_outliers3':0,
+                                           'num_unable_to_shorten':0})
+            flags[removed_id] &= ~mask
+            self.outliers3.pop(removed_id, None)
+        return removed
+    
+    def update_dirty_nodes(self):
+        """Works out the rolled up counters of the dirty nodes again.
+        
+        The nodes are updated lowest first, each from its local counters
+        and the counters of its children on the tree, which are either
+        clean or already updated.  A node stays on the tree if it has a
+        file or a child on the tree.
+        
+        """
+        in_tree = self.paths.in_tree
+        depth = self.nodes.columns['depth']
+        for node_id in sorted(self._delta_before, key=lambda i: depth[i],
+                              reverse=True):
+            node = self.nodes[node_id]
+            data = {'has_outliers1':node.num_local_outliers1 > 0,
+                    'has_outliers2':node.num_local_outliers2 > 0,
+                    'has_outliers3':node.num_local_outliers3 > 0}
+            num_unable_to_shorten = 1 if node.unable_to_shorten else 0
+            if node_id == 0:
+                # Files without a directory are not rolled up any further.
+                data.update({'total_cnt':node.local_cnt,
+                             'total_bytes':node.local_bytes,
+                             'num_unable_to_shorten':num_unable_to_shorten})
+                node.update(data)
+                continue
+            children = [self.nodes[child_id] for child_id
+                        in self.paths.tree_children(node_id)]
+            if not children and not (node.local_cnt or
+                                     node.num_local_outliers1 or
+                                     node.num_local_outliers2 or
+                                     node.num_local_outliers3):
+                in_tree[node_id] = 0
+                data.update({'subdir_cnt':0,
+                             'total_cnt':0,
+                             'local_bytes':0,
+                             'total_bytes':0,
+                             'num_unable_to_shorten':0,
+                             'longest_fn_length':0,
+                             'longest_fp_length':0,
+                             'child_node_cnt':-1,
+                             'direct_child_cnt':-1,
+                             'is_leaf':-1,
+                             'local_plus_child_cnt':-1,
+                             'subdir_plus_child_cnt':-1,
+                             'total_plus_child_cnt':-1})
+                node.update(data)
+                continue
+            in_tree[node_id] = 1
+            subdir_cnt = 0
+            subdir_bytes = 0
+            child_node_cnt = 0
+            longest_fn_length = node.longest_fn_length
+            longest_fp_length = node.longest_fp_length
+            for child in children:
+                subdir_cnt += child.total_cnt
+                subdir_bytes += child.total_bytes
+                child_node_cnt += child.child_node_cnt + 1
+                num_unable_to_shorten += child.num_unable_to_shorten
+                longest_fn_length = max(longest_fn_length, child.longest_fn_length)
+                longest_fp_length = max(longest_fp_length, child.longest_fp_length)
+                for name in ('has_outliers1', 'has_outliers2', 'has_outliers3'):
+                    data[name] = data[name] or getattr(child, name)
+            local_plus_child_cnt = node.local_cnt + child_node_cnt
+            subdir_plus_child_cnt = subdir_cnt + child_node_cnt
+            data.update({'subdir_cnt':subdir_cnt,
+                         'total_cnt':node.local_cnt + subdir_cnt,
+                         'total_bytes':node.local_bytes + subdir_bytes,
+                         'num_unable_to_shorten':num_unable_to_shorten,
+                         'longest_fn_length':longest_fn_length,
+                         'longest_fp_length':longest_fp_length,
+                         'child_node_cnt':child_node_cnt,
+                         'direct_child_cnt':len(children),
+                         'is_leaf':not children,
+                         'local_plus_child_cnt':local_plus_child_cnt,
+                         'subdir_plus_child_cnt':subdir_plus_child_cnt,
+                         'total_plus_child_cnt':(local_plus_child_cnt +
+                                                 subdir_plus_child_cnt)})
+            node.update(data)
+    
+    def diff_batches(self):
+        """Compares the batches of the tree before and after the delta.
+        
+        The batch search is walked down the dirty nodes only, as the
+        batches below a clean node are the same if both searches reach
+        it.  Where a dirty node is a batch on one side only, the batches
+        below it on the other side are searched.
+        
+        @return: Generator of (change, path, node id) for the batches
+                Added, Removed, or Updated (a batch on both sides with
+                other counters), in pre-order.
+        
+        """
+        before = self._delta_before
+        dirty_children = self._dirty_children
+        in_tree = self.paths.in_tree
+        total_plus_child_cnt = self.nodes.columns['total_plus_child_cnt']
+        total_bytes = self.nodes.columns['total_bytes']
+        within_limits = self.within_limits
+        # Stack of (node id, parent path) of dirty nodes both searches reach.
+        stack = [(child_id, '') for child_id
+                 in sorted(dirty_children.get(0, ()), reverse=True)]
+        while stack:
+            (node_id, path) = stack.pop()
+            path = self.join_path(path, self.paths.name(node_id))
+            # None if off the tree, True for a batch, False to descend.
+            (old_in_tree, old_cnt, old_bytes) = before[node_id]
+            old = within_limits(old_cnt, old_bytes) if old_in_tree else None
+            new = (within_limits(total_plus_child_cnt[node_id],
+                                 total_bytes[node_id])
+                   if in_tree[node_id] else None)
+            if old is False and new is False:
+                stack.extend((child_id, path) for child_id
+                             in sorted(dirty_children.get(node_id, ()),
+                                       reverse=True))
+                continue
+            if old and new:
+                yield ('Updated', path, node_id)
+                continue
+            if old:
+                yield (DELTA_REMOVED, path, node_id)
+            elif old is False:
+                for (p, i) in self.old_batch_search(node_id, path):
+                    yield (DELTA_REMOVED, p, i)
+            if new:
+                yield (DELTA_ADDED, path, node_id)
+            elif new is False:
+                for (p, n) in self.batch_search(node_id, path):
+                    yield (DELTA_ADDED, p, n.id)
+    
+    def old_batch_search(self, node_id, path):
+        """Same as batch_search, on the tree before the delta.
+        
+        @param node_id: The node id on the path trie.
+        @param path: The path of the node.
+        @return: Generator of (path, node id) of the batches.
+        
+        """
+        before = self._delta_before
+        in_tree = self.paths.in_tree
+        total_plus_child_cnt = self.nodes.columns['total_plus_child_cnt']
+        total_bytes = self.nodes.columns['total_bytes']
+        first_child = self.paths.first_child
+        next_sibling = self.paths.next_sibling
+        # Stack of (node id, path, True if a batch).
+        stack = [(node_id, path, False)]
+        while stack:
+            (node_id, path, is_batch) = stack.pop()
+            if is_batch:
+                yield (path, node_id)
+                continue
+            children = []
+            child_id = first_child[node_id]
+            while child_id != -1:
+                (child_in_tree, cnt, size) = before.get(
+                    child_id, (in_tree[child_id],
+                               total_plus_child_cnt[child_id],
+                               total_bytes[child_id]))
+                if child_in_tree:
+                    children.append((child_id,
+                                     self.join_path(path, self.paths.name(child_id)),
+                                     self.within_limits(cnt, size)))
+                child_id = next_sibling[child_id]
+            children.reverse()
+            stack.extend(children)
+    
+    def write_delta_results(self):
+        """Writes the changes to the batch and outliers results.
+        
+        Each file has the columns of the full results file with a Change
+        column first.  Removed batches only have the Depth, File Limit and
+        Directory Path filled in.  Applying the changes to the results of
+        the loaded tree, by Directory Path, gives the results of the
+        updated tree.
+        
+        """
+        batch_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                  ('batch_delta',self.timestamp))
+        counts = self.delta_counts
+        for change in (DELTA_ADDED, DELTA_REMOVED, 'Updated'):
+            counts['batches_%s' % change.lower()] = 0
+        with open(batch_file,'w') as batch_fp:
+            batch_writer = csv.writer(batch_fp, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            header = self.get_batch_header()
+            self.writerow(batch_writer, ['Change'] + header)
+            for (change, path, node_id) in self.diff_batches():
+                node = self.nodes[node_id]
+                if change == DELTA_REMOVED:
+                    row = [change, node.depth, self.file_limit, path]
+                    row.extend([''] * (len(header) - 3))
+                else:
+                    row = [change] + self.batch_row(path, node)
+                self.writerow(batch_writer, row)
+                counts['batches_%s' % change.lower()] += 1
+        for (name, header, get_row, changes) in (
+                ('outliers1_delta', self.OUTLIERS1_HEADER, self.outlier1_row,
+                 self._delta_outliers1),
+                ('outliers2_delta', self.OUTLIERS2_HEADER, self.outlier2_row,
+                 self._delta_outliers2)):
+            outliers_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                         (name,self.timestamp))
+            with open(outliers_file,'w') as outliers_fp:
+                outliers_writer = csv.writer(outliers_fp, quoting=csv.QUOTE_ALL, lineterminator='\n')
+                self.writerow(outliers_writer, ['Change'] + header)
+                for (change, node_id, _file) in changes:
+                    self.writerow(outliers_writer,
+                                  [change] + get_row(node_id, _file))
+            counts[name] = len(changes)
+        message = 'Delta results saved to file: %s' % batch_file
         log('INFO', logfile, message, print_stdout=True)
-        file_gen = self.file_generator()
+    
+    def ingest(self):
+        """Reads the whole file in this process."""
+        raw = self.can_read_raw()
+        if raw:
+            file_gen = self.raw_line_generator()
+        else:
+            file_gen = self.file_generator()
         # Assume first line is the header.
         header = file_gen.next()
+        if raw:
+            header = header.decode(self.encoding)
         self._file_line_cnt += 1
         
+        parse_line = self.compile_line_parser(header, raw=raw)
         for line in file_gen:
-            item = self.get_line_item(line, header)
-            self.parse_item_path(item)
+            self.parse_item_path(*parse_line(line))
             self._file_line_cnt += 1
             if self._file_line_cnt % 100000 == 0:
                 message = 'Read lines: %s' % (self._file_line_cnt)
                 log('INFO', logfile, message, print_stdout=True)
-        message = 'Done reading %s lines.' % (self._file_line_cnt)
-        log('INFO', logfile, message, print_stdout=True)
-        # Update tree node attributes.
-        message = ['Number of nodes: %s' % (len(self.nodes_id))]
-        message.append('Updating parent node attributes lowest depth up...')
-        log('INFO', logfile, '\n'.join(message), print_stdout=True)
-        self.depth_first_reverse_update()
+    
+    def can_shard(self):
+        """Checks if the file can be split into byte ranges on newlines.
         
-        # Update child (folder) counters.
-        message = 'Updating child (folder) counters...'
-        log('INFO', logfile, message, print_stdout=True)
-        self.update_node_child_cnts()
-        message = 'Preparing results...'
+        This holds for ASCII compatible encodings (eg: utf-8, latin-1), but
+        not for the likes of utf-16.
+        
+        """
+        if u'\n'.encode(self.encoding) == '\n':
+            return True
+        message = ('WARNING: Cannot split %s encoded file, reading with '
+                   'a single process.' % self.encoding)
         log('INFO', logfile, message, print_stdout=True)
-        self.prepare_batch_results()
-        message = 'Finished processing.'
+        return False
+    
+    def shard_ranges(self, num_shards):
+        """Splits the file after the header into byte ranges that start
+        and end on line boundaries.
+        
+        @param num_shards: The number of ranges to split into.
+        @return: A tuple of the header line and a list of
+                (start, end) byte offsets.
+        
+        """
+        with open(self._file, 'rb') as f:
+            header = f.readline()
+            start = f.tell()
+            size = os.fstat(f.fileno()).st_size
+            step = max(1, (size - start) // num_shards)
+            bounds = [start]
+            for i in range(1, num_shards):
+                pos = start + i * step
+                if pos <= bounds[-1] or pos >= size:
+                    continue
+                # Move to the start of the next line.
+                f.seek(pos - 1)
+                f.readline()
+                bounds.append(f.tell())
+            bounds.append(size)
+        ranges = [(a, b) for (a, b) in zip(bounds, bounds[1:]) if a < b]
+        return (header.decode(self.encoding), ranges)
+    
+    def ingest_range(self, header, start, end):
+        """Reads the lines of a byte range of the file.
+        
+        @param header: The header line from the file.
+        @param start: Byte offset of the first line.
+        @param end: Byte offset after the last line.
+        
+        """
+        raw = self.can_read_raw()
+        parse_line = self.compile_line_parser(header, raw=raw)
+        for line in self.raw_line_generator(start, end):
+            if not raw:
+                line = line.decode(self.encoding)
+            self.parse_item_path(*parse_line(line))
+            self._file_line_cnt += 1
+    
+    def set_source(self, source):
+        """Makes a file the one read by ingest and friends.
+        
+        @param source: One of the files.
+        
+        """
+        self._file = source
+        self.encoding = self.encodings[source]
+    
+    def ingest_files(self):
+        """Reads the files into one tree, in order.
+        
+        With workers, each file that can be split is read in byte ranges
+        by a pool of worker processes.  The parts of every file are queued
+        at once, so files are read concurrently, and each worker parses a
+        byte range into a partial tree with its own node counters and
+        outliers.  The partial trees are merged into this Analyzer in file
+        order.  Files that cannot be split are read by this process, while
+        the workers read the others.
+        
+        The lines and outliers of each file are added to source_counts.
+        
+        """
+        pool = None
+        # {file index: [task, ...], ...}, then the AsyncResults of the tasks.
+        pending = {}
+        try:
+            if self.workers > 1:
+                for (i, source) in enumerate(self.files):
+                    self.set_source(source)
+                    if not self.can_shard():
+                        continue
+                    (header, ranges) = self.shard_ranges(self.workers)
+                    settings = {'_file':self._file,
+                                'encoding':self.encoding,
+                                'delimiter':self.delimiter,
+                                'path_sep':self.path_sep,
+                                'max_path_length':self.max_path_length,
+                                'max_parent_file_length':self.max_parent_file_length,
+                                'max_file_length':self.max_file_length,
+                                'size_column':self.size_column,
+                                'spill_dir':self.outliers1.directory,
+                                'debug':self._debug}
+                    pending[i] = [(settings, header, start, end)
+                                  for (start, end) in ranges]
+            if pending:
+                message = ('Reading %s byte ranges of %s file(s) with %s '
+                           'workers.' % (sum(len(tasks) for tasks in
+                                             pending.itervalues()),
+                                         len(pending), self.workers))
+                log('INFO', logfile, message, print_stdout=True)
+                # Workers must not inherit unwritten log lines.
+                _logger.flush()
+                pool = multiprocessing.Pool(self.workers, init_worker,
+                                            (logfile,))
+                # Queue the parts in file order.
+                for i in sorted(pending):
+                    pending[i] = [pool.apply_async(ingest_shard, (task,))
+                                  for task in pending[i]]
+            for (i, source) in enumerate(self.files):
+                self.set_source(source)
+                if len(self.files) > 1:
+                    message = 'Reading file %s...' % (source)
+                    log('INFO', logfile, message, print_stdout=True)
+                counts = (self._file_line_cnt, len(self.outliers1),
+                          len(self.outliers2))
+                if i in pending:
+                    # The header line.
+                    self._file_line_cnt += 1
+                    for result in pending.pop(i):
+                        self.merge_shard(result.get())
+                        message = 'Read lines: %s' % (self._file_line_cnt)
+                        log('INFO', logfile, message, print_stdout=True)
+                else:
+                    self.ingest()
+                self.source_counts.append(
+                    {'file':source,
+                     'encoding':self.encoding,
+                     'lines':self._file_line_cnt - counts[0],
+                     'outliers1':len(self.outliers1) - counts[1],
+                     'outliers2':len(self.outliers2) - counts[2]})
+            if pool is not None:
+                pool.close()
+        except Exception:
+            if pool is not None:
+                pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.join()
+            if self.files:
+                self.set_source(self.files[0])
+    
+    def merge_shard(self, shard):
+        """Merges a partial tree read by a worker into this Analyzer.
+        
+        @param shard: An Analyzer returned by ingest_shard.
+        
+        """
+        paths = shard.paths
+        nodes = shard.nodes
+        # Map the shard node ids to the ids in this tree.
+        # Parents always have lower ids than their children.
+        id_map = array('i', [0]) * len(paths.parent)
+        for shard_id in xrange(1, len(paths.parent)):
+            parent_id = id_map[paths.parent[shard_id]]
+            name = paths.name(shard_id)
+            node_id = self.paths.child(parent_id, name)
+            if node_id == -1:
+                node_id = self.insert_child_node(parent_id, name).id
+            id_map[shard_id] = node_id
+            if paths.in_tree[shard_id]:
+                self.paths.mark_tree(node_id)
+        if 0 in shard.nodes_depth:
+            self.insert_nodes([])
+        for shard_id in xrange(len(paths.parent)):
+            self.nodes.merge_row(id_map[shard_id], nodes, shard_id)
+        # Merge outliers.
+        self.outliers1.extend(shard.outliers1, id_map)
+        self.outliers2.extend(shard.outliers2, id_map)
+        shard.close_spills()
+        for v in shard.outliers3.itervalues():
+            node = self.nodes[id_map[v.node_id]]
+            if self.need_add_outlier3(node, v.shortened):
+                outlier = Outlier3(data={'node_id':node.id,
+                                         'shortened':v.shortened,
+                                         '_file':v._file})
+                self.outliers3[node.id] = outlier
+        self._file_line_cnt += shard._file_line_cnt
+    
+    def scan(self):
+        """Scans scan_dir, in this process or with a pool of worker
+        processes.
+        
+        Each worker scans a part of the directory tree into a partial tree,
+        as ingest_files does with byte ranges.  The parts are contiguous
+        runs of the single process scan order, and are merged in that order,
+        so the results do not depend on the number of workers.
+        
+        """
+        # Directories are listed by byte paths, so that every name can be
+        # listed, and the names are decoded with the encoding.
+        root = self.scan_dir
+        if isinstance(root, unicode):
+            root = root.encode(sys.getfilesystemencoding() or 'utf-8')
+        root = os.path.abspath(root)
+        if not os.path.isdir(root):
+            raise IOError('Not a directory: %s' % root)
+        if self.workers <= 1:
+            self.scan_tree(root, [], True)
+            return
+        tasks = self.split_scan(root, self.workers * SCAN_TASKS_PER_WORKER)
+        settings = {'_file':None,
+                    'encoding':self.encoding,
+                    'delimiter':self.delimiter,
+                    'path_sep':self.path_sep,
+                    'max_path_length':self.max_path_length,
+                    'max_parent_file_length':self.max_parent_file_length,
+                    'max_file_length':self.max_file_length,
+                    'size_column':self.size_column,
+                    'spill_dir':self.outliers1.directory,
+                    'debug':self._debug}
+        tasks = [(settings, dir_path, names, recursive)
+                 for (dir_path, names, recursive) in tasks]
+        message = 'Scanning %s directory trees with %s workers.' % (
+            len(tasks), self.workers)
         log('INFO', logfile, message, print_stdout=True)
+        # Workers must not inherit unwritten log lines.
+        _logger.flush()
+        pool = multiprocessing.Pool(self.workers, init_worker, (logfile,))
+        try:
+            for shard in pool.imap(scan_shard, tasks):
+                self.merge_shard(shard)
+                message = 'Scanned entries: %s' % (self._file_line_cnt)
+                log('INFO', logfile, message, print_stdout=True)
+            pool.close()
+        except Exception:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
+    def split_scan(self, root, num_tasks):
+        """Splits the scan of a directory into parts.
+        
+        Directories are split a level at a time, into a part with the
+        directory's own entries followed by a part per sub directory, until
+        there are num_tasks sub directory parts or SCAN_SPLIT_DEPTH is
+        reached.
+        
+        @param root: The directory to scan.
+        @param num_tasks: The number of sub directory parts to aim for.
+        @return: List of (dir_path, names, recursive) parts, in scan order.
+                names is the list of folder names from root to dir_path.
+        
+        """
+        tasks = [(root, [], True)]
+        for depth in xrange(SCAN_SPLIT_DEPTH):
+            if len(tasks) >= num_tasks:
+                break
+            split = []
+            for (dir_path, names, recursive) in tasks:
+                if not recursive or len(names) != depth:
+                    split.append((dir_path, names, recursive))
+                    continue
+                entries = self.list_dir(dir_path)
+                if entries is None:
+                    continue
+                split.append((dir_path, names, False))
+                for (name, entry_path) in entries[0]:
+                    split.append((entry_path, names + [name], True))
+            tasks = split
+        return tasks
+    
+    def list_dir(self, dir_path):
+        """Lists a directory, with entries sorted by name.
+        
+        Symbolic links are listed as files and are not followed.  The sizes
+        of the files are read if size_column is set.
+        
+        @param dir_path: The directory path, as a byte string.
+        @return: Tuple of the ([(name, path), ...] of the sub directories
+                and the [(name, size), ...] of the files, or None (with a
+                warning logged) if the directory cannot be read.  Names are
+                decoded, paths are byte strings, sizes are None if not read.
+        
+        """
+        dirs = []
+        files = []
+        sizes = bool(self.size_column)
+        try:
+            if scandir is not None:
+                for entry in scandir(dir_path):
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append((entry.name, entry.path))
+                    elif sizes:
+                        files.append((entry.name,
+                                      entry.stat(follow_symlinks=False).st_size))
+                    else:
+                        files.append((entry.name, None))
+            else:
+                for name in os.listdir(dir_path):
+                    entry_path = os.path.join(dir_path, name)
+                    if (os.path.isdir(entry_path) and
+                            not os.path.islink(entry_path)):
+                        dirs.append((name, entry_path))
+                    elif sizes:
+                        files.append((name, os.lstat(entry_path).st_size))
+                    else:
+                        files.append((name, None))
+        except OSError as e:
+            message = 'WARNING: Unable to list directory. %s' % e
+            log('INFO', logfile, message, print_stdout=True)
+            return None
+        encoding = self.encoding
+        dirs = sorted((name.decode(encoding, 'replace'), entry_path)
+                      for (name, entry_path) in dirs)
+        files = sorted((name.decode(encoding, 'replace'), size)
+                       for (name, size) in files)
+        return (dirs, files)
+    
+    def scan_tree(self, dir_path, names, recursive):
+        """Adds a directory and its files to the tree, and its sub
+        directories if recursive, in pre-order by name.
+        
+        @param dir_path: The directory path.
+        @param names: The list of folder names from the scan root to
+                dir_path.  The paths on the tree are relative to the root.
+        @param recursive: Scans the sub directories too.
+        
+        """
+        path_sep = self.path_sep
+        stack = [(dir_path, names)]
+        while stack:
+            (dir_path, names) = stack.pop()
+            entries = self.list_dir(dir_path)
+            if entries is None:
+                continue
+            (dirs, files) = entries
+            prefix = path_sep.join(names)
+            if names:
+                self.add_path(prefix, folder=True)
+                self._file_line_cnt += 1
+                prefix += path_sep
+            for (name, size) in files:
+                self.add_path(prefix + name, size=size)
+                self._file_line_cnt += 1
+                if self._file_line_cnt % 100000 == 0:
+                    message = 'Scanned entries: %s' % (self._file_line_cnt)
+                    log('INFO', logfile, message, print_stdout=True)
+            if recursive:
+                for (name, entry_path) in reversed(dirs):
+                    stack.append((entry_path, names + [name]))
     
     def get_line_item(self, line, header, use_cache_header=True):
         """Parses a line in a file and returns mapped data
@@ -450,12 +2790,7 @@ class Analyzer(object):
         
         """
         if not self._header or use_cache_header is False:
-            self._header = header.split(self.delimiter)
-            # Replace first field of header with 'id' if there is None.
-            if 'id' not in self._header and not self._header[0]:
-                self._header[0] = u'id'
-            # Clean header.
-            self._header = [re.sub(r'\s','_',x.strip()) for x in self._header]
+            self._header = self.parse_header(header)
         d_line = line.split(self.delimiter)
         # Clean d_line:
         d_line = [x.strip() for x in d_line]
@@ -463,84 +2798,162 @@ class Analyzer(object):
         data = dict(zip(self._header,d_line))
         return Item(data=data)
     
-    def parse_item_path(self, item):
+    def parse_header(self, header):
+        """Parses the header line into a list of field names.
+        
+        @param header: The header line from the file.
+        
+        """
+        fields = header.split(self.delimiter)
+        # Replace first field of header with 'id' if there is None.
+        if 'id' not in fields and not fields[0]:
+            fields[0] = u'id'
+        # Clean header.
+        return [re.sub(r'\s','_',x.strip()) for x in fields]
+    
+    def compile_line_parser(self, header, raw=False):
+        """Compiles a line parser for the columns used by the analysis.
+        
+        The returned function only splits a line up to the last needed
+        column, and returns a (Item_Path, Category, size) tuple of the
+        stripped fields.  Category is None if the column is missing, and
+        size is None unless size_column is set.
+        
+        @param header: The (decoded) header line from the file.
+        @keyword raw: Parse undecoded lines from raw_line_generator.
+                Only the Item_Path field gets decoded.
+        @return: The line parser function.
+        @raise ValueError: If the Item_Path or size_column column is not
+                found.
+        
+        """
+        fields = self.parse_header(header)
+        if 'Item_Path' not in fields:
+            raise ValueError('Item_Path column not found in header.')
+        path_index = fields.index('Item_Path')
+        category_index = fields.index('Category') if 'Category' in fields else -1
+        size_index = -1
+        if self.size_column:
+            if self.size_column not in fields:
+                raise ValueError('%s column not found in header.' %
+                                 self.size_column)
+            size_index = fields.index(self.size_column)
+        max_split = max(path_index, category_index, size_index) + 1
+        delimiter = self.delimiter
+        encoding = None
+        if raw:
+            delimiter = unicode(delimiter).encode(self.encoding)
+            encoding = self.encoding
+        parse_size = self.parse_size
+        
+        def parse_line(line):
+            d_line = line.split(delimiter, max_split)
+            if len(d_line) > path_index:
+                item_path = d_line[path_index]
+                if encoding:
+                    item_path = item_path.decode(encoding)
+                item_path = item_path.strip()
+            else:
+                item_path = u''
+            if len(d_line) > category_index >= 0:
+                category = d_line[category_index].strip()
+            else:
+                category = None
+            if size_index < 0:
+                size = None
+            elif len(d_line) > size_index:
+                size = parse_size(d_line[size_index].strip())
+            else:
+                size = 0
+            return (item_path, category, size)
+        
+        return parse_line
+    
+    def parse_size(self, size):
+        """Parses a size field into a number of bytes.
+        
+        @param size: The stripped size field.  Eg: u'1,048,576'
+        @return: The size, or 0 if the field is empty or not a number.
+        
+        """
+        try:
+            return int(size.replace(',', ''))
+        except ValueError:
+            return 0
+    
+    def parse_item_path(self, item_path, category=None, size=None):
         """Parses the Item_Path field.
         
-        Increments dir_file_cnt counters as well as adds to the dir_tree
+        Increments node counters as well as adds to the path trie
         to construct the file structure.
         
-        @attention: Pass in either item or item_path.
+        @param item_path: The Item_Path field.
+        @keyword category: The Category field.
+        @keyword size: The size of the file in bytes, if sizes are read.
+        
+        """
+        path = self.extract_path(item_path)
+        if not path:
+            return
+        self.add_path(path, category == 'Folder', size)
+    
+    def add_path(self, path, folder=False, size=None):
+        """Adds a file or folder path to the tree.
+        
+        @param path: The path, without the root folder.
+        @keyword folder: True if the path is a folder.
+        @keyword size: The size of the file in bytes, added to the byte
+                counters if the file is counted (not an outlier).
+        
+        """
+        ########### Process folder specifics. ##############
+        if folder:
+            self.insert_nodes(path.split(self.path_sep))
+            return
+        ####################################################
+        # Extract filename and parent directory.
+        (dir_path, sep, _file) = path.rpartition(self.path_sep)
+        # Listings are usually grouped by folder, so check the last
+        # directory seen before walking the trie.
+        (last_dir_path, node) = self._last_dir
+        if dir_path != last_dir_path:
+            dir_path_list = dir_path.split(self.path_sep) if sep else []
+            node = self.insert_nodes(dir_path_list)
+            # Add directory path to the tree.
+            self.paths.mark_tree(node.id)
+            self._last_dir = (dir_path, node)
+        # Update lengths.
+        _file_length = len(_file)
+        path_length = len(path)
+        if node.longest_fn_length < _file_length:
+            node.longest_fn_length = _file_length
+        if node.longest_fp_length < path_length:
+            node.longest_fp_length = path_length
+        # Find outliers.
+        if self.find_outliers(node, path) and size:
+            node.local_bytes += size
+            node.total_bytes += size
+    
+    def extract_path(self, item_path):
+        """Extracts the path from the Item_Path field.
         
-        @param item: The Item object.
+        @param item_path: The Item_Path field.
+        @return: The path, or None (with a warning logged) if not found.
         
         """
-        folder = False
-        if item.get('Category') == 'Folder':
-            folder = True
-        item_path = item.Item_Path
         path = None
         # Find Path.  It should always start after the first backslash.
         # The prefix "root folder" in the raw text is not really a
         # folder, but appears to be something prepended by Forensics software,
         # so we strip it in the regex below.
-        m = re.search(r'[^\\]+(.*)',item_path.strip())
+        m = _ROOT_FOLDER_RE.search(item_path.strip())
         if m:
             # Strip leading backslash.
             path = m.group(1).lstrip(self.path_sep)
         if not path:
             message = 'WARNING: Unable to find file path. Item_Path=\'%s\'' % item_path
             log('INFO', logfile, message, print_stdout=True)
-            return
-        ########### Process folder specifics. ##############
-        if folder:
-            dir_path = path
-            dir_path_list = path.split(self.path_sep)
-            if dir_path not in self.nodes_path:
-                # Create new node.
-                node = Node(data={'depth':len(dir_path_list),
-                                  'local_path_length':len(dir_path)})
-                self.nodes_path[dir_path] = node
-                self.nodes_id[node.id] = node
-                self.nodes_id_path_ptr[node.id] = id(dir_path)
-                self.insert_nodes_depth(node,dir_path)
-                self.insert_nodes(dir_path)
-            return
-        ####################################################
-        # Extract filename.
-        _file = path.split(self.path_sep)[-1]
-        # Extract parent directory.
-        dir_path_list = path.split(self.path_sep)[:-1]
-        # Add directory path to the tree.
-        self.add(self.dir_tree, dir_path_list)
-        # Construct node lookup tables.
-        # Check if a new node needs to be created.
-        dir_path = self.path_sep.join(dir_path_list)
-        # Calculate lengths.
-        _file_length = len(_file)
-        path_length = len(path)
-        try:
-            node = self.nodes_path[dir_path]
-            # Update lengths.
-            if node.longest_fn_length < _file_length:
-                node.update({'longest_fn_length':_file_length})
-            if node.longest_fp_length < path_length:
-                node.update({'longest_fp_length':path_length})
-        except KeyError:
-            # Create new node and initialize some attributes.
-            node = Node()
-            depth = len(dir_path_list)
-            node.update({'depth':depth,
-                         'local_path_length':len(dir_path),
-                         'longest_fn_length':_file_length,
-                         'longest_fp_length':path_length})
-            self.nodes_path[dir_path] = node
-            self.nodes_id[node.id] = node
-            self.nodes_id_path_ptr[node.id] = id(dir_path)
-            self.insert_nodes_depth(node,dir_path)
-            # Insert the rest of the parent nodes.
-            self.insert_nodes(dir_path)
-        # Find outliers.
-        self.find_outliers(node, path)
+        return path
     
     def find_outliers(self, node, path):
         """Find outliers.
@@ -549,48 +2962,52 @@ class Analyzer(object):
         
         @param node: A Node object.
         @param path: A string of the absolute file path.
+        @return: True if no outliers were found and the file is counted.
         
         """
         found_outlier1 = False
         found_outlier2 = False
         found_outlier3 = False
-        _file = path.split(self.path_sep)[-1]
-        parent_file = self.path_sep.join(path.split(self.path_sep)[-2:])
+        path_list = path.rsplit(self.path_sep, 2)
+        _file = path_list[-1]
+        parent_file = self.path_sep.join(path_list[-2:])
         # Outlier 1 - filename over max_file_length.
         if len(_file) > self.max_file_length:
             found_outlier1 = True
             if self._debug:
-                message = 'DEBUG: Found Outlier1: file=%s, max_file_length=%s' % (_file,self.max_file_length)
+                log('DEBUG', logfile,
+                    'DEBUG: Found Outlier1: file=%s, max_file_length=%s',
+                    print_stdout=False, args=(_file,self.max_file_length))
+            if len(self.outliers1) != 0 and len(self.outliers1) % 2000 == 0:
+                message = 'Outlier1 count: %s' % (len(self.outliers1))
                 log('INFO', logfile, message, print_stdout=True)
-            if Outlier1._COUNT != 0 and Outlier1._COUNT % 2000 == 0:
-                message = 'Outlier1 count: %s' % (Outlier1._COUNT)
-                log('INFO', logfile, message, print_stdout=True)
-            data = {'node_id':node.id,'filename':_file}
-            outlier = Outlier1(data=data)
-            self.outliers1.update({outlier.id:outlier})
+            self.outliers1.add(node.id, _file)
             node.update({'num_local_outliers1':node.num_local_outliers1 + 1,
                          'has_outliers1':True})
         # Outlier 2 - parent folder + filename over max_parent_file_length
         elif len(parent_file) > self.max_parent_file_length:
             found_outlier2 = True
             if self._debug:
-                message = 'DEBUG: Found Outlier2: parent_file=%s, max_parent_file_length=%s' % (parent_file,self.max_parent_file_length)
-                log('INFO', logfile, message, print_stdout=True)
-            if Outlier2._COUNT != 0 and Outlier2._COUNT % 1000 == 0:
-                message = 'Outlier2 count: %s' % (Outlier2._COUNT)
+                log('DEBUG', logfile,
+                    'DEBUG: Found Outlier2: parent_file=%s, max_parent_file_length=%s',
+                    print_stdout=False,
+                    args=(parent_file,self.max_parent_file_length))
+            if len(self.outliers2) != 0 and len(self.outliers2) % 1000 == 0:
+                message = 'Outlier2 count: %s' % (len(self.outliers2))
                 log('INFO', logfile, message, print_stdout=True)
-            data = {'node_id':node.id,'parent_file':parent_file}
-            outlier = Outlier2(data=data)
-            self.outliers2.update({outlier.id:outlier})
+            # Only the filename is spilled, the parent folder is the last
+            # component of the node path.
+            self.outliers2.add(node.id, _file)
             node.update({'num_local_outliers2':node.num_local_outliers2 + 1,
                          'has_outliers2':True})
         # Outlier 3 - Absolute filepath over max_path_length
         elif len(path) > self.max_path_length:
             found_outlier3 = True
             if self._debug:
-                message = 'DEBUG: Found Outlier3: path=%s, max_path_length=%s' % (path,self.max_path_length)
-                log('INFO', logfile, message, print_stdout=True)
-            shortened = self.shorten_path(path, self.max_path_length)
+                log('DEBUG', logfile,
+                    'DEBUG: Found Outlier3: path=%s, max_path_length=%s',
+                    print_stdout=False, args=(path,self.max_path_length))
+            (shortened, levels) = self.shorten_file_path(node, path, _file)
             unable_to_shorten = False
             if shortened == 'UNABLE_TO_SHORTEN':
                 unable_to_shorten = True
@@ -606,34 +3023,31 @@ class Analyzer(object):
                 # Set can_shorten to all nodes in shortened path.
                 # This is to help out with trimming the shortened path from
                 # the tree later.
-                dir_path = self.path_sep.join(path.split(self.path_sep)[:-1])
-                self.set_can_shorten(dir_path, shortened)
+                self.set_can_shorten(node, levels)
             node.update({'num_local_outliers3':node.num_local_outliers3 + 1,
                          'has_outliers3':True,
                          'shortened':True})
         
         # Update node local count - only if no outliers were found.
         if not any([found_outlier1,found_outlier2,found_outlier3]):
-            node.update({'local_cnt':node.local_cnt + 1,
-                         'total_cnt':node.total_cnt + 1})
+            node.local_cnt += 1
+            node.total_cnt += 1
+            return True
+        return False
     
     def update_node_attributes(self, node, has_outliers1=False,
                                has_outliers2=False, has_outliers3=False,
                                longest_fn_length=0, longest_fp_length=0,
-                               _update_subdir_cnt=False, _subdir_cnt=0,
-                               path=None):
+                               _update_subdir_cnt=False, _subdir_cnt=0):
         """Recursively updates nodes and it's parent node attributes.
         
         @param node: The node to update.
         @keyword update_subdir_cnt: Updates the sub-directory count.
                 This should be set to true when parents are updated.
                 Internal use only.
-        @keyword path: The path of the node. This is for efficiency purposes.
         
         """
         # TODO: Needs testing.
-        if not path:
-            path = self.get_node_path(node)
         # Update attributes.
         # Only update has_outliers if False.
         data = {'has_outliers1':node.has_outliers1 or has_outliers1,
@@ -648,11 +3062,9 @@ class Analyzer(object):
                          'total_cnt':node.total_cnt + _subdir_cnt})
         node.update(data)
         # Get parent.
-        parent_path_list = path.split(self.path_sep)[:-1]
-        if not parent_path_list:
+        parent_node = self.get_parent_node(node)
+        if parent_node is None:
             return
-        parent_path = self.path_sep.join(parent_path_list)
-        parent_node = self.nodes_path[parent_path]
         # Recurse.
         self.update_node_attributes(parent_node,
                                     has_outliers1=has_outliers1,
@@ -661,14 +3073,12 @@ class Analyzer(object):
                                     longest_fn_length=longest_fn_length,
                                     longest_fp_length=longest_fp_length,
                                     _update_subdir_cnt=True,
-                                    _subdir_cnt=_subdir_cnt,
-                                    path=parent_path)
+                                    _subdir_cnt=_subdir_cnt)
     
     def update_leaf_node_attributes(self, node, has_outliers1=False,
                                     has_outliers2=False, has_outliers3=False,
                                     longest_fn_length=0, longest_fp_length=0,
-                                    _update_subdir_cnt=False, _subdir_cnt=0,
-                                    path=None):
+                                    _update_subdir_cnt=False, _subdir_cnt=0):
         """Recursively updates nodes and it's parent node attributes.
         
         @attention: Should pass in leaf nodes only.
@@ -677,11 +3087,8 @@ class Analyzer(object):
         @keyword update_subdir_cnt: Updates the sub-directory count.
                 This should be set to true when parents are updated.
                 Internal use only.
-        @keyword path: The path of the node. This is for efficiency purposes.
         
         """
-        if not path:
-            path = self.get_node_path(node)
         # Update attributes.
         # Only update has_outliers if False.
         data = {'has_outliers1':node.has_outliers1 or has_outliers1,
@@ -696,11 +3103,9 @@ class Analyzer(object):
                          'total_cnt':node.total_cnt + _subdir_cnt})
         node.update(data)
         # Get parent.
-        parent_path_list = path.split(self.path_sep)[:-1]
-        if not parent_path_list:
+        parent_node = self.get_parent_node(node)
+        if parent_node is None:
             return
-        parent_path = self.path_sep.join(parent_path_list)
-        parent_node = self.nodes_path[parent_path]
         # Recurse.
         self.update_node_attributes(parent_node,
                                     has_outliers1=node.has_outliers1,
@@ -709,19 +3114,14 @@ class Analyzer(object):
                                     longest_fn_length=node.longest_fn_length,
                                     longest_fp_length=node.longest_fp_length,
                                     _update_subdir_cnt=True,
-                                    _subdir_cnt=node.total_cnt,
-                                    path=parent_path)
+                                    _subdir_cnt=node.total_cnt)
     
-    def update_parent_attributes(self, node, path=None):
+    def update_parent_attributes(self, node):
         """Updates only the parent node."""
-        if not path:
-            path = self.get_node_path(node)
         # Get parent.
-        parent_path_list = path.split(self.path_sep)[:-1]
-        if not parent_path_list:
+        parent_node = self.get_parent_node(node)
+        if parent_node is None:
             return
-        parent_path = self.path_sep.join(parent_path_list)
-        parent_node = self.nodes_path[parent_path]
         # Update parent.
         # Only update has_outliers if False.
         data = {'has_outliers1':parent_node.has_outliers1 or node.has_outliers1,
@@ -733,6 +3133,7 @@ class Analyzer(object):
             data.update({'longest_fp_length':node.longest_fp_length})
         data.update({'subdir_cnt':parent_node.subdir_cnt + node.total_cnt,
                      'total_cnt':parent_node.total_cnt + node.total_cnt,
+                     'total_bytes':parent_node.total_bytes + node.total_bytes,
                      'num_unable_to_shorten':(parent_node.num_unable_to_shorten +
                                               node.num_unable_to_shorten)})
         parent_node.update(data)
@@ -764,51 +3165,356 @@ class Analyzer(object):
         warnings_writer = csv.writer(warnings_fp, quoting=csv.QUOTE_ALL, lineterminator='\n')
         ############## Write to files. #################
         try:
-            # Prepare warnings file.
-            message = 'Writing warnings file...'
+            self.write_limit_results(batch_writer, outliers3_writer,
+                                     warnings_writer)
+            self.write_outlier_results(outliers1_writer, outliers2_writer)
+        except Exception:
+            raise
+        finally:
+            batch_fp.flush()
+            batch_fp.close()
+            outliers1_fp.flush()
+            outliers1_fp.close()
+            outliers2_fp.flush()
+            outliers2_fp.close()
+            outliers3_fp.flush()
+            outliers3_fp.close()
+            warnings_fp.flush()
+            warnings_fp.close()
+        message = 'Results saved to file: %s' % batch_file
+        log('INFO', logfile, message, print_stdout=True)
+        
+    def sweep_file_limits(self):
+        """Writes the batch results for each of the file_limits.
+        
+        The tree is only read once.  Each limit gets its own batch,
+        trimmed (shortened) and warnings files, the outliers files are
+        written once, and a sweep file summarizes the counters per limit.
+        
+        """
+        self.sweep_results = []
+        sweep_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                  ('sweep',self.timestamp))
+        for file_limit in self.file_limits:
+            message = 'Sweeping file limit %s...' % (file_limit)
             log('INFO', logfile, message, print_stdout=True)
-            warnings_header = ['TAG','Message','File Limit','Path',
-                               'Num Local Files','Num Sub-directory Files',
-                               'Total Files']
-            self.writerow(warnings_writer, warnings_header)
-            # Write unable to shorten results.
-            for (path, node) in self.search_unable_shorten(self.dir_tree, self.path_sep,
-                                                           csv_writer=warnings_writer):
-                outlier = self.outliers3[node.id]
+            self.reset_limit_results()
+            self.file_limit = file_limit
+            fps = [open(os.path.join(self.top_dir,'%s_%s_%s.csv' %
+                                     (name,file_limit,self.timestamp)),'w')
+                   for name in ('batch','shortened','warnings')]
+            try:
+                writers = [csv.writer(fp, quoting=csv.QUOTE_ALL,
+                                      lineterminator='\n') for fp in fps]
+                self.write_limit_results(*writers)
+            finally:
+                for fp in fps:
+                    fp.close()
+            self.sweep_results.append((file_limit,
+                                       self._dirs_within_limit,
+                                       self._trimmed,
+                                       self._dirs_over_limit,
+                                       self._unable_to_shorten))
+        outliers1_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                      ('outliers1',self.timestamp))
+        outliers2_file = os.path.join(self.top_dir,'%s_%s.csv' %
+                                      ('outliers2',self.timestamp))
+        with open(outliers1_file,'w') as outliers1_fp:
+            with open(outliers2_file,'w') as outliers2_fp:
+                self.write_outlier_results(
+                    csv.writer(outliers1_fp, quoting=csv.QUOTE_ALL, lineterminator='\n'),
+                    csv.writer(outliers2_fp, quoting=csv.QUOTE_ALL, lineterminator='\n'))
+        with open(sweep_file,'w') as sweep_fp:
+            sweep_writer = csv.writer(sweep_fp, quoting=csv.QUOTE_ALL, lineterminator='\n')
+            header = ['File Limit',
+                      'Num Batches',
+                      'Num Trimmed (Shortened) Paths',
+                      'Num Directories over file limit',
+                      'Num Paths over max path length but cannot shorten'
+                      ]
+            self.writerow(sweep_writer, header)
+            for row in self.sweep_results:
+                self.writerow(sweep_writer, list(row))
+        message = 'Sweep results saved to file: %s' % sweep_file
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def count_batches(self, file_limit):
+        """Counts the batches prepare_batch_results would write for a file
+        limit, without writing anything or changing the nodes.
+        
+        With search_local, the batchable and trimmable marks are worked
+        out by sweep_marks instead of being set on the nodes.
+        
+        @param file_limit: The file limit to count batches for.
+        @return: The number of batches.
+        
+        """
+        paths = self.paths
+        columns = self.nodes.columns
+        if not self.search_local:
+            total_plus_child_cnt = columns['total_plus_child_cnt']
+            total_bytes = columns['total_bytes']
+            within_limits = self.within_limits
+            cnt = 0
+            stack = [0]
+            while stack:
+                for child_id in paths.tree_children(stack.pop()):
+                    if within_limits(total_plus_child_cnt[child_id],
+                                     total_bytes[child_id], file_limit):
+                        cnt += 1
+                    else:
+                        stack.append(child_id)
+            return cnt
+        (batchable, trimmable) = self.sweep_marks(file_limit)
+        # The highest trimmable nodes are trimmed, and search_batchable
+        # does not go below a trimmed node.
+        cnt = 0
+        stack = [0]
+        while stack:
+            for child_id in paths.tree_children(stack.pop()):
+                if trimmable[child_id] == 1:
+                    continue
+                if batchable[child_id] == 1:
+                    cnt += 1
+                else:
+                    stack.append(child_id)
+        return cnt
+    
+    def tune_file_limit(self, target_batches):
+        """Searches the file limit for a target number of batches.
+        
+        The batch count only changes at the file counts of the nodes, so
+        those are the candidate limits.  The smallest limit giving at least
+        one and no more than target_batches batches is chosen.
+        
+        The batch count of the total file counts falls as the limit grows,
+        so the candidates are binary searched.  The search_local count does not:
+        the batchable marks of a folder depend on the marks below it, and
+        a higher limit can give fewer batches (eg: none at all once every
+        leaf is within the limit but its parents are not).  Its candidates
+        are all counted at once by count_local_batches.
+        
+        @param target_batches: The wanted number of batches.
+        @return: The chosen file limit.
+        
+        """
+        name = 'local_plus_child_cnt' if self.search_local else 'total_plus_child_cnt'
+        column = self.nodes.columns[name]
+        in_tree = self.paths.in_tree
+        limits = sorted(set(column[node_id] for node_id in xrange(1, len(column))
+                            if in_tree[node_id] and column[node_id] >= 0))
+        if not limits:
+            return self.file_limit
+        if self.search_local:
+            return self.scan_file_limits(limits, target_batches)
+        (lo, hi) = (0, len(limits) - 1)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cnt = self.count_batches(limits[mid])
+            if self._debug:
+                message = 'Probe file limit %s: %s batches' % (limits[mid], cnt)
+                log('DEBUG', logfile, message, print_stdout=False)
+            if cnt <= target_batches:
+                hi = mid
+            else:
+                lo = mid + 1
+        file_limit = limits[lo]
+        cnt = self.count_batches(file_limit)
+        if cnt > target_batches:
+            message = (' WARNING: NO FILE LIMIT GIVES %s BATCHES OR LESS, USING %s (%s batches)' %
+                       (target_batches, file_limit, cnt))
+        else:
+            message = ('Chose file limit %s for %s batches (target %s).' %
+                       (file_limit, cnt, target_batches))
+        log('INFO', logfile, message, print_stdout=True)
+        return file_limit
+    
+    def scan_file_limits(self, limits, target_batches):
+        """Counts the batches of every candidate limit, for tune_file_limit
+        with search_local.
+        
+        @param limits: The sorted candidate file limits.
+        @param target_batches: The wanted number of batches.
+        @return: The smallest limit giving at least one and no more than
+                target_batches batches.  If there is none, the limit giving
+                the fewest batches over none (or the highest limit if every
+                limit gives none), with a warning logged.
+        
+        """
+        message = 'Counting batches of %s file limits...' % (len(limits))
+        log('INFO', logfile, message, print_stdout=True)
+        # The fallback, as (batches, file limit).
+        fewest = None
+        for (file_limit, cnt) in zip(limits, self.count_local_batches(limits)):
+            if self._debug:
+                message = 'Probe file limit %s: %s batches' % (file_limit, cnt)
+                log('DEBUG', logfile, message, print_stdout=False)
+            if 0 < cnt <= target_batches:
+                message = ('Chose file limit %s for %s batches (target %s).' %
+                           (file_limit, cnt, target_batches))
+                log('INFO', logfile, message, print_stdout=True)
+                return file_limit
+            if cnt and (fewest is None or cnt < fewest[0]):
+                fewest = (cnt, file_limit)
+        (cnt, file_limit) = fewest if fewest else (0, limits[-1])
+        message = (' WARNING: NO FILE LIMIT GIVES 1 TO %s BATCHES, USING %s (%s batches)' %
+                   (target_batches, file_limit, cnt))
+        log('INFO', logfile, message, print_stdout=True)
+        return file_limit
+    
+    def count_local_batches(self, limits):
+        """Counts the search_local batches of every candidate file limit in
+        one post-order and one pre-order sweep.
+        
+        The marks of sweep_marks are only ever set as the limit grows: a
+        node is marked within the limit from the lowest limit at which the
+        walk up reaches it and its count is within, and that limit follows
+        from the limits of its children.  So a node is counted by
+        count_batches over a contiguous range of limits, from its batchable
+        limit up to its trimmable limit or the lowest limit at which the
+        walk down stops at one of its parents.  The ranges are summed with
+        a difference array over the candidates.
+        
+        @param limits: The sorted candidate file limits.
+        @return: List of the count_batches count of each limit.
+        
+        """
+        columns = self.nodes.columns
+        local_plus_child_cnt = columns['local_plus_child_cnt']
+        local_bytes = columns['local_bytes']
+        byte_limit = self.byte_limit
+        is_leaf = columns['is_leaf']
+        flags = self.nodes.flags
+        shortened = self.nodes.flag_mask('shortened')
+        can_shorten = self.nodes.flag_mask('can_shorten')
+        parent = self.paths.parent
+        in_tree = self.paths.in_tree
+        size = len(parent)
+        never = sys.maxint
+        # Lowest limits at which the walks up reach a node, then (once the
+        # node is swept) at which it is marked within the limit.  Skipped
+        # folders are never marked.
+        batch_at = array('l', [never]) * size
+        trim_at = array('l', [never]) * size
+        for node_id in xrange(size - 1, 0, -1):
+            if not in_tree[node_id]:
+                continue
+            if is_leaf[node_id] == 1:
+                batch_at[node_id] = trim_at[node_id] = 0
+            cnt = local_plus_child_cnt[node_id]
+            # Skip empty folders that are not shortened.
+            if cnt == 0 and not flags[node_id] & shortened:
+                batch_up = batch_at[node_id]
+                trim_up = trim_at[node_id]
+                batch_at[node_id] = trim_at[node_id] = never
+            else:
+                if byte_limit is None or local_bytes[node_id] <= byte_limit:
+                    batch_up = max(batch_at[node_id], cnt)
+                else:
+                    batch_up = never
+                if flags[node_id] & can_shorten:
+                    trim_up = max(trim_at[node_id], cnt)
+                else:
+                    trim_up = never
+                batch_at[node_id] = batch_up
+                trim_at[node_id] = trim_up
+            parent_id = parent[node_id]
+            if batch_up < batch_at[parent_id]:
+                batch_at[parent_id] = batch_up
+            if trim_up < trim_at[parent_id]:
+                trim_at[parent_id] = trim_up
+        # Lowest limit at which the walk down stops above a node.
+        stop_at = array('l', [never]) * size
+        diff = [0] * (len(limits) + 1)
+        for node_id in xrange(1, size):
+            if not in_tree[node_id]:
+                continue
+            parent_id = parent[node_id]
+            if parent_id:
+                stop_at[node_id] = min(stop_at[parent_id], batch_at[parent_id],
+                                       trim_at[parent_id])
+            start = batch_at[node_id]
+            end = min(trim_at[node_id], stop_at[node_id])
+            if start < end:
+                diff[bisect_left(limits, start)] += 1
+                diff[bisect_left(limits, end)] -= 1
+        counts = []
+        cnt = 0
+        for i in xrange(len(limits)):
+            cnt += diff[i]
+            counts.append(cnt)
+        return counts
+    
+    def reset_limit_results(self):
+        """Clears the node marks and counters set for a file_limit."""
+        self.nodes.reset('batchable', 'trimmable', 'trimmed',
+                         'wrote_over_limit')
+        self._dirs_within_limit = 0
+        self._dirs_over_limit = 0
+        self._trimmed = 0
+        self._unable_to_shorten = 0
+    
+    def write_limit_results(self, batch_writer, trimmed_writer,
+                            warnings_writer):
+        """Writes the results that depend on file_limit.
+        
+        @param batch_writer: CSV Writer for the batch file.
+        @param trimmed_writer: CSV Writer for the trimmed (shortened) file.
+        @param warnings_writer: CSV Writer for the warnings file.
+        
+        """
+        # Prepare warnings file.
+        warnings_header = ['TAG','Message','File Limit','Path',
+                           'Num Local Files','Num Sub-directory Files',
+                           'Total Files']
+        self.writerow(warnings_writer, warnings_header)
+        # Run analysis function first.
+        # This will set the trimmable and batchable attributes.
+        self.analyze_batchable_trimmable(csv_writer=warnings_writer,
+                                         batchable=self.search_local)
+        header = ['Depth',
+                  'File Limit',
+                  'Directory Path',
+                  'Trimmed Folder',
+                  'Num Warnings (Cannot Shorten)',
+                  'Num Local Files',
+                  'Num Sub-directory Files',
+                  'Total Files',
+                  'Local Path Length',
+                  'Longest Filename',
+                  'Longest Filepath',
+                  'Has Outliers 1',
+                  'Has Outliers 2',
+                  'Num Local Outliers 1',
+                  'Num Local Outliers 2'
+                  ]
+        self.writerow(trimmed_writer, header)
+        # Write the header for results file.
+        self.writerow(batch_writer, self.get_batch_header())
+        message = 'Writing warnings, trimmed and main batch files...'
+        log('INFO', logfile, message, print_stdout=True)
+        # Search for paths unable to shorten, highest trimmable and batches
+        # in one walk.  The trimmable search runs before the batch search,
+        # so the batch search sees the trimmed mark of a node.
+        if self.search_local:
+            batch = (self.visit_batchable, self.leaf_batchable)
+        else:
+            batch = (self.visit_batch, self.leaf_batch)
+        searches = [(self.visit_unable_shorten, None),
+                    (self.visit_trimmable, None),
+                    batch]
+        for (i, path, node) in self.walk_tree(searches,
+                                              csv_writer=warnings_writer):
+            if i == 0:
                 row = ['WARNING','Path cannot be shortened',
                        self.file_limit,
-                       self.path_sep.join([path,outlier._file]),
+                       self.path_sep.join([path,self.get_outlier3_file(node)]),
                        node.local_plus_child_cnt,
                        node.subdir_plus_child_cnt,
                        node.total_plus_child_cnt]
                 self.writerow(warnings_writer, row)
                 self._unable_to_shorten += 1
-            ################## Trimmed CSV File ####################
-            # Run analysis function first.
-            # This will set the trimmable attribute.
-            message = 'Writing trimmed file...'
-            log('INFO', logfile, message, print_stdout=True)
-            self.analyze_trimmable(csv_writer=warnings_writer)
-            header = ['Depth',
-                      'File Limit',
-                      'Directory Path',
-                      'Trimmed Folder',
-                      'Num Warnings (Cannot Shorten)',
-                      'Num Local Files',
-                      'Num Sub-directory Files',
-                      'Total Files',
-                      'Local Path Length',
-                      'Longest Filename',
-                      'Longest Filepath',
-                      'Has Outliers 1',
-                      'Has Outliers 2',
-                      'Num Local Outliers 1',
-                      'Num Local Outliers 2'
-                      ]
-            self.writerow(outliers3_writer, header)
-            # Walk tree and search for highest trimmable.
-            for (path, node) in self.search_trimmable(self.dir_tree, self.path_sep,
-                                                      csv_writer=warnings_writer):
+            elif i == 1:
                 row = [node.depth,
                        self.file_limit,
                        path,
@@ -822,98 +3528,90 @@ class Analyzer(object):
                        node.longest_fp_length,
                        node.has_outliers1,
                        node.has_outliers2,
-                       node.num_local_outliers1,
-                       node.num_local_outliers2
-                       ]
-                self.writerow(outliers3_writer, row)
-                # Mark node trimmed so the search batchable will not go
-                # beyond it.
-                node.update({'trimmed':True})
-                self._trimmed += 1
-            ################## Main Batch File ####################
-            message = 'Writing main batch file...'
-            log('INFO', logfile, message, print_stdout=True)
-            # Search for batches.
-            # Write the header for results file.
-            header = ['Depth',
-                      'File Limit',
-                      'Directory Path',
-                      'Num Local Files',
-                      'Num Sub-directory Files',
-                      'Total Files',
-                      'Local Path Length',
-                      'Longest Filename',
-                      'Longest Filepath',
-                      'Has Outliers 1',
-                      'Has Outliers 2',
-                      'Has Shortened Paths',
-                      'Num Local Outliers 1',
-                      'Num Local Outliers 2'
-                      ]
-            self.writerow(batch_writer, header)
-            # Set search function.
-            search_fn = self.batch_search
-            if self.search_local:
-                search_fn = self.search_batchable
-                # Run the analysis function first.
-                self.analyze_batchable()
-            for (path, node) in search_fn(self.dir_tree, self.path_sep,
-                                          csv_writer=warnings_writer):
-                row = [node.depth,
-                       self.file_limit,
-                       path,
-                       node.local_plus_child_cnt,
-                       node.subdir_plus_child_cnt,
-                       node.total_plus_child_cnt,
-                       node.local_path_length,
-                       node.longest_fn_length,
-                       node.longest_fp_length,
-                       node.has_outliers1,
-                       node.has_outliers2,
-                       node.has_outliers3,
-                       node.num_local_outliers1,
-                       node.num_local_outliers2
-                       ]
-                self.writerow(batch_writer, row)
-                self._dirs_within_limit += 1
-            ################## Outliers File ####################
-            message = 'Writing outlier files...'
-            log('INFO', logfile, message, print_stdout=True)
-            # Write Outliers 1.
-            header = ['Depth','Filename Length','Filename','Directory Path']
-            self.writerow(outliers1_writer, header)
-            for v in self.outliers1.values():
-                node = self.nodes_id[v.node_id]
-                path = self.get_node_path(node)
-                row = [node.depth,len(v.filename),v.filename,path]
-                self.writerow(outliers1_writer, row)
-            # Write Outliers 2.
-            header = ['Depth','Parent File Path Length','Parent File Path',
-                      'Directory Path']
-            self.writerow(outliers2_writer, header)
-            for v in self.outliers2.values():
-                node = self.nodes_id[v.node_id]
-                path = self.get_node_path(node)
-                row = [node.depth,len(v.parent_file),v.parent_file,path]
-                self.writerow(outliers2_writer, row)
-        except Exception:
-            raise
-        finally:
-            batch_fp.flush()
-            batch_fp.close()
-            outliers1_fp.flush()
-            outliers1_fp.close()
-            outliers2_fp.flush()
-            outliers2_fp.close()
-            outliers3_fp.flush()
-            outliers3_fp.close()
-            warnings_fp.flush()
-            warnings_fp.close()
-        message = 'Results saved to file: %s' % batch_file
-        log('INFO', logfile, message, print_stdout=True)
+                       node.num_local_outliers1,
+                       node.num_local_outliers2
+                       ]
+                self.writerow(trimmed_writer, row)
+                # Mark node trimmed so the search batchable will not go
+                # beyond it.
+                node.trimmed = True
+                self._trimmed += 1
+            else:
+                self.writerow(batch_writer, self.batch_row(path, node))
+                self._dirs_within_limit += 1
+    
+    def get_batch_header(self):
+        """Returns the batch results header, with the BYTES_HEADER columns
+        if sizes are read.
+        
+        """
+        if self.size_column:
+            return self.BATCH_HEADER + self.BYTES_HEADER
+        return self.BATCH_HEADER
+    
+    def batch_row(self, path, node):
+        """Returns the batch results row of a node.
+        
+        @param path: The path of the node.
+        @param node: The Node.
+        
+        """
+        row = [node.depth,
+               self.file_limit,
+               path,
+               node.local_plus_child_cnt,
+               node.subdir_plus_child_cnt,
+               node.total_plus_child_cnt,
+               node.local_path_length,
+               node.longest_fn_length,
+               node.longest_fp_length,
+               node.has_outliers1,
+               node.has_outliers2,
+               node.has_outliers3,
+               node.num_local_outliers1,
+               node.num_local_outliers2
+               ]
+        if self.size_column:
+            row.extend([self.byte_limit if self.byte_limit is not None else '',
+                        int(node.local_bytes),
+                        int(node.total_bytes - node.local_bytes),
+                        int(node.total_bytes)])
+        return row
+    
+    def write_outlier_results(self, outliers1_writer, outliers2_writer):
+        """Writes the outliers files.
+        
+        @param outliers1_writer: CSV Writer for the outliers 1 file.
+        @param outliers2_writer: CSV Writer for the outliers 2 file.
         
+        """
+        ################## Outliers File ####################
+        message = 'Writing outlier files...'
+        log('INFO', logfile, message, print_stdout=True)
+        # Write Outliers 1.
+        self.writerow(outliers1_writer, self.OUTLIERS1_HEADER)
+        for (node_id, _file) in self.outliers1:
+            self.writerow(outliers1_writer, self.outlier1_row(node_id, _file))
+        # Write Outliers 2.
+        self.writerow(outliers2_writer, self.OUTLIERS2_HEADER)
+        for (node_id, _file) in self.outliers2:
+            self.writerow(outliers2_writer, self.outlier2_row(node_id, _file))
+    
+    def outlier1_row(self, node_id, _file):
+        """Returns the outliers 1 results row of a spill record."""
+        node = self.nodes[node_id]
+        return [node.depth,len(_file),_file,self.get_node_path(node)]
+    
+    def outlier2_row(self, node_id, _file):
+        """Returns the outliers 2 results row of a spill record."""
+        node = self.nodes[node_id]
+        parent = self.paths.name(node_id) if node_id else ''
+        parent_file = self.join_path(parent, _file)
+        return [node.depth,len(parent_file),parent_file,self.get_node_path(node)]
+    
     def shorten_path(self, path, length, get_parent_path=True):
-        """Recursive function to shorten the path to the desired length.
+        """Shortens the path to the desired length by dropping leading
+        folders.
         
         @param path: The absolute pathname.
         @param length: The length to shorten to.
@@ -922,18 +3620,71 @@ class Analyzer(object):
         @return: The shortened path.
         
         """
-        if len(path) <= length:
-            if get_parent_path:
-                path_list = path.split(self.path_sep)
-                parent_path_list = path_list[:-1]
-                if not parent_path_list or len(path_list) == 1:
-                    return 'UNABLE_TO_SHORTEN'
-                else:
-                    return self.path_sep.join(parent_path_list)
-            else:
-                return path
-        return self.shorten_path(self.path_sep.join(path.split(self.path_sep)[1:]),
-                                 length)
+        while len(path) > length:
+            (head, sep, path) = path.partition(self.path_sep)
+        if get_parent_path:
+            (parent_path, sep, _file) = path.rpartition(self.path_sep)
+            if not sep:
+                return 'UNABLE_TO_SHORTEN'
+            return parent_path
+        return path
+    
+    def shorten_file_path(self, node, path, _file):
+        """Shortens the path of a file to max_path_length.
+        
+        Same result as shorten_path, but the number of leading folders to
+        drop is found with a bisect over the path offsets of the folders
+        above the file, instead of by splitting the path again for every
+        folder dropped.
+        
+        @param node: The Node of the file's directory.
+        @param path: The file path.
+        @param _file: The filename.
+        @return: Tuple of (shortened directory path, number of folders in
+                it).  The path is 'UNABLE_TO_SHORTEN' if even the filename
+                alone is over max_path_length.
+        
+        """
+        offsets = self.get_path_offsets(node)
+        sep_length = len(self.path_sep)
+        # Index of the last folder dropped.
+        i = bisect_left(offsets,
+                        len(path) - sep_length - self.max_path_length)
+        levels = len(offsets) - 1 - i
+        if levels <= 0:
+            return ('UNABLE_TO_SHORTEN', 0)
+        shortened = path[offsets[i] + sep_length:
+                         len(path) - len(_file) - sep_length]
+        return (shortened, levels)
+    
+    def get_path_offsets(self, node):
+        """Returns the path offsets of a directory.
+        
+        The offsets are the local_path_length of every folder on the
+        path, from the top level folder down to the node itself.  They are
+        cached for the last directory asked for.
+        
+        @param node: The Node of the directory.
+        @return: List of path lengths.
+        
+        """
+        (node_id, offsets, levels) = self._shorten_cache
+        if node_id == node.id:
+            return offsets
+        offsets = []
+        local_path_length = self.nodes.columns['local_path_length']
+        parent = self.paths.parent
+        node_id = node.id
+        while node_id > 0:
+            offsets.append(local_path_length[node_id])
+            node_id = parent[node_id]
+        offsets.reverse()
+        self._shorten_cache = (node.id, offsets, 0)
+        return offsets
+    
+    def get_outlier3_file(self, node):
+        """Returns the filename of the shortest shortened path of a node."""
+        return self.outliers3[node.id]._file
     
     def need_add_outlier3(self, node, shortened_path):
         """Checks if the shortened_path need to be added or updated to
@@ -950,85 +3701,120 @@ class Analyzer(object):
         if shortened_path < self.outliers3[node.id].shortened:
             return True
     
-    def set_can_shorten(self, path, shortened_path):
+    def set_can_shorten(self, node, levels):
         """Sets the can_shorten attribute to all nodes that can be trimmed.
         
         This is to help with the trimming algorithm.
         
-        @param path: The original absolute path of the node.
-        @param shortened_path: The shortened path that can be trimmed.
+        @param node: The Node of the original path.
+        @param levels: The number of folders in the shortened path, from
+                the node up.
         
         """
-        t_path = path.split(self.path_sep)
-        t_shortened = shortened_path.split(self.path_sep)
-        while t_shortened:
-            ts_folder = t_shortened.pop()
-            tp_folder = t_path.pop()
-            if ts_folder != tp_folder:
-                message = ('WARNING: can_shorten: Unexpected values %s != %s' %
-                       (ts_folder,tp_folder))
-                log('INFO', logfile, message, print_stdout=True)
-            tp_path = self.path_sep.join(t_path + [tp_folder])
-            if self._debug:
-                message = ('can_shorten: Updating node \'%s\' to can_shorten' %
-                       (tp_path))
-                log('INFO', logfile, message, print_stdout=True)
-            node = self.nodes_path[tp_path]
-            node.update({'can_shorten':True})
+        (node_id, offsets, marked) = self._shorten_cache
+        if node_id == node.id:
+            # The folders of an earlier file in the same directory are
+            # already marked.
+            if levels <= marked:
+                return
+            self._shorten_cache = (node_id, offsets, levels)
+        node_id = node.id
+        flags = self.nodes.flags
+        can_shorten = self.nodes.flag_mask('can_shorten')
+        if self._debug:
+            message = ('can_shorten: Updating %s folders up from \'%s\' to '
+                       'can_shorten' % (levels, self.get_node_path(node)))
+            log('DEBUG', logfile, message, print_stdout=False)
+        for i in xrange(levels):
+            flags[node_id] |= can_shorten
+            node_id = self.paths.parent[node_id]
     
     def get_node_path(self, node):
         """Looks up the node path.
         
+        Paths are rebuilt from the path trie and kept in the path_cache.
+        
         @param node: The Node to lookup.
         @return: The absolute path of the node.
         
         """
-        return di(self.nodes_id_path_ptr[node.id])
+        return self.path_cache.get(node.id)
+    
+    def get_parent_node(self, node):
+        """Looks up the parent of a node.
+        
+        @param node: The Node to lookup.
+        @return: The parent Node, or None for top level nodes.
+        
+        """
+        parent_id = self.paths.parent[node.id]
+        if parent_id <= 0:
+            return None
+        return self.nodes[parent_id]
     
-    def insert_nodes(self, dir_path):
-        """Recursively creates and inserts nodes and it's parents to the
+    def insert_nodes(self, dir_path_list):
+        """Creates and inserts nodes for a directory and it's parents to the
         lookup table if they do not already exist.
         
-        @param dir_path: The directory path to insert (without filename).
+        @param dir_path_list: A list of the directory path (without filename).
+        @return: The Node of the directory.
         
         """
-        if not dir_path:
-            return
-        dir_path_list = dir_path.split(self.path_sep)
-        if dir_path not in self.nodes_path:
-            node = Node(data={'depth':len(dir_path_list),
-                              'local_path_length':len(dir_path)})
-            self.nodes_path[dir_path] = node
-            self.nodes_id[node.id] = node
-            self.nodes_id_path_ptr[node.id] = id(dir_path)
-            self.insert_nodes_depth(node,dir_path)
-        self.insert_nodes(self.path_sep.join(dir_path_list[:-1]))
-    
-    def insert_nodes_depth(self, node, path):
-        """Inserts node ids into depth lookup table."""
+        node_id = 0
+        for name in dir_path_list:
+            child_id = self.paths.child(node_id, name)
+            if child_id == -1:
+                child_id = self.insert_child_node(node_id, name).id
+            node_id = child_id
+        node = self.nodes[node_id]
+        if node_id == 0 and 0 not in self.nodes_depth:
+            # Files without a directory hang off the root.
+            self.insert_nodes_depth(node)
+        return node
+    
+    def insert_child_node(self, parent_id, name):
+        """Creates a new node under an existing node.
+        
+        @param parent_id: The id of the parent node.
+        @param name: The folder name of the new node.
+        @return: The new Node.
+        
+        """
+        parent = self.nodes[parent_id]
+        path_length = len(name)
+        if parent_id:
+            path_length += parent.local_path_length + len(self.path_sep)
+        self.paths.add_child(parent_id, name)
+        node = self.nodes.add({'depth':parent.depth + 1,
+                               'local_path_length':path_length})
+        self.insert_nodes_depth(node)
+        return node
+    
+    def insert_nodes_depth(self, node):
+        """Inserts a new node id into depth lookup table."""
         if node.depth not in self.nodes_depth:
             self.nodes_depth[node.depth] = [node.id]
-        elif node.id not in self.nodes_depth[node.depth]:
+        else:
             self.nodes_depth[node.depth].append(node.id)
     
     def update_tree_leaf_node_attributes(self):
         """Walks the tree and recursively updates leaf node attributes and its
         parents.
         
+        @attention: update_node_child_cnts should be run first.
+        
         """
         cnt = 0
         leaf_node_cnt = 0
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt == 0:
+        for node_id in self.paths.walk():
+            if self.nodes[node_id].is_leaf:
                 leaf_node_cnt += 1
         message = 'Number of leaf nodes: %s' % (leaf_node_cnt)
         log('INFO', logfile, message, print_stdout=True)
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt != 0:
+        for node_id in self.paths.walk():
+            node = self.nodes[node_id]
+            if not node.is_leaf:
                 continue
-            node = self.nodes_path[dir_path.lstrip(self.path_sep)]
             self.update_leaf_node_attributes(node,
                                              has_outliers1=node.has_outliers1,
                                              has_outliers2=node.has_outliers2,
@@ -1048,22 +3834,21 @@ class Analyzer(object):
         """Walks the tree and updates leaf node attributes and its
         parents.
         
+        @attention: update_node_child_cnts should be run first.
+        
         """
         cnt = 0
         leaf_node_cnt = 0
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt == 0:
+        for node_id in self.paths.walk():
+            if self.nodes[node_id].is_leaf:
                 leaf_node_cnt += 1
         message = 'Number of leaf nodes: %s' % (leaf_node_cnt)
         log('INFO', logfile, message, print_stdout=True)
-        for (t_dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt != 0:
+        for node_id in self.paths.walk():
+            node = self.nodes[node_id]
+            if not node.is_leaf:
                 continue
-            dir_path = t_dir_path.lstrip(self.path_sep)
-            node = self.nodes_path[dir_path]
-            self.update_node_parent_attributes(node, path=dir_path)
+            self.update_node_parent_attributes(node)
             cnt += 1
             if cnt % 50000 == 0:
                 message = 'updated %s leaf nodes.' % (cnt)
@@ -1071,17 +3856,14 @@ class Analyzer(object):
         message = 'Finished updating %s leaf nodes.' % (cnt)
         log('INFO', logfile, message, print_stdout=True)
     
-    def update_node_parent_attributes(self, node, path=None):
+    def update_node_parent_attributes(self, node):
         """Update node's parent attributes.
         
         @warning: Flawed algorithm, don't use.
         
         @param node: The Node object.
-        @param path: The directory path of the node.
         
         """
-        if not path:
-            path = self.get_node_path(node)
         # Prepare data to update.
         has_outliers1 = node.has_outliers1
         has_outliers2 = node.has_outliers2
@@ -1090,10 +3872,8 @@ class Analyzer(object):
         longest_fp_length = node.longest_fp_length
         total_cnt = node.total_cnt
         # Update parent.
-        parent_path_list = path.split(self.path_sep)[:-1]
-        while parent_path_list:
-            parent_path = self.path_sep.join(parent_path_list)
-            parent_node = self.nodes_path[parent_path]
+        parent_node = self.get_parent_node(node)
+        while parent_node is not None:
             # Update data for parent.
             data = {'has_outliers1':parent_node.has_outliers1 or has_outliers1,
                     'has_outliers2':parent_node.has_outliers2 or has_outliers2,
@@ -1112,474 +3892,1228 @@ class Analyzer(object):
             longest_fn_length = parent_node.longest_fn_length
             longest_fp_length = parent_node.longest_fp_length
             total_cnt = parent_node.total_cnt
-            # Pop last element off list.
-            parent_path_list.pop()
+            parent_node = self.get_parent_node(parent_node)
     
     def update_node_child_cnts(self):
         """Updates the node child counters. This translates to folder and
         sub-folder counts.
         
+        Walks the tree once in post-order, so the sub-folder count of a node
+        is summed up from its already counted children.  Also stores the
+        direct_child_cnt and is_leaf attributes used by the later passes.
+        
         """
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            node = self.nodes_path[dir_path.lstrip(self.path_sep)]
+        # Stack of (node id, children_done).
+        stack = [(node_id, False) for node_id in self.paths.tree_children(0)]
+        while stack:
+            (node_id, children_done) = stack.pop()
+            if not children_done:
+                stack.append((node_id, True))
+                for child_id in self.paths.tree_children(node_id):
+                    stack.append((child_id, False))
+                continue
+            child_node_cnt = 0
+            direct_child_cnt = 0
+            for child_id in self.paths.tree_children(node_id):
+                child_node_cnt += self.nodes[child_id].child_node_cnt + 1
+                direct_child_cnt += 1
+            node = self.nodes[node_id]
             local_plus_child_cnt = node.local_cnt + child_node_cnt
             subdir_plus_child_cnt = node.subdir_cnt + child_node_cnt
             total_plus_child_cnt = local_plus_child_cnt + subdir_plus_child_cnt
             node.update({'child_node_cnt':child_node_cnt,
+                         'direct_child_cnt':direct_child_cnt,
+                         'is_leaf':direct_child_cnt == 0,
                          'local_plus_child_cnt':local_plus_child_cnt,
                          'subdir_plus_child_cnt':subdir_plus_child_cnt,
                          'total_plus_child_cnt':total_plus_child_cnt})
     
-    def writerow(self,csv_writer,row):
-        """Encode everything to utf-8 before writing to csv.
+    def writerow(self,csv_writer,row):
+        """Encode everything to utf-8 before writing to csv.
+        
+        @param csv_writer: The csv writer object, fetched from csv_writer().
+        @param row: The row to write.
+        
+        """
+        encoded_row = [x.encode('utf-8') if isinstance(x,str) or
+                       isinstance(x,unicode) else x for x in row]
+        try:
+            csv_writer.writerow(encoded_row)
+        except UnicodeEncodeError:
+            message = ' DEBUG: encoded_row=%s' % encoded_row
+            log('WARNING', logfile, message, print_stdout=True)
+            raise
+    
+    def can_read_raw(self):
+        """Checks if lines can be split into fields before decoding.
+        
+        This holds for encodings where the delimiter and newline bytes
+        cannot be part of another character (utf-8, ascii and latin-1).
+        
+        """
+        return codecs.lookup(self.encoding).name in _RAW_ENCODINGS
+    
+    def raw_line_generator(self, start=0, end=None):
+        """Generator of the undecoded lines of the memory-mapped file.
+        
+        Repeated runs on the same file are served from the page cache.
+        
+        @keyword start: Byte offset of the first line.
+        @keyword end: Byte offset to stop at. Defaults to end of file.
+        
+        """
+        with open(self._file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if end is None:
+                    end = size
+                mm.seek(start)
+                readline = mm.readline
+                while mm.tell() < end:
+                    yield readline()
+            finally:
+                mm.close()
+    
+    def file_generator(self):
+        """Generator object for file.
+        
+        Each call to next() yields one line of content from the file.
+        
+        """
+        with codecs.open(self._file, encoding=self.encoding) as f:
+            for line in f:
+                yield line
+    
+    def detect_encoding(self, N=20):
+        """Tries to detect the file's encoding.
+        
+        @attention: Defaults to UTF-8 if detection confidence is < 50%.
+        
+        @keyword N: The number of lines to read from a file to guess
+                the encoding type.
+        
+        """
+        try:
+            N = int(N)
+        except ValueError:
+            N = 20
+        _file = self._file
+        
+        unicode_regex = ('UTF|Big5|GB2312|EUC-TW|HZ-GB-2312|ISO-2022'
+                         'EUC-JP|SHIFT_JIS|EUC-KR|TIS-620')
+        
+        with open(_file) as f:
+            # Read N lines from file, and join them into a single
+            # string buffer that chardet will accept.
+            detect = chardet.detect(''.join(islice(f,N)))
+            self.detect = detect
+        
+        encoding = detect['encoding'] if detect['encoding'] else ''
+        m = re.search(unicode_regex, encoding, re.IGNORECASE)
+        
+        # If the confidence is better than or equal to 50%
+        if (m and detect['confidence'] >= 0.5):
+            self.encoding = encoding
+        else:
+            # Default to UTF-8
+            self.encoding = 'utf-8'
+    
+    def walk_tree(self, searches, node_id=0, path='', csv_writer=None):
+        """Depth First Search Tree Walk running several searches at once.
+        
+        Iterative, with an explicit stack, so deep trees do not hit the
+        recursion limit.  Each search is a (visit, leaf) pair of functions
+        taking (node, path, csv_writer).  visit is called for every node
+        the search reaches and returns EMIT, DESCEND or both (0 prunes).
+        leaf, if not None, is called for nodes the search descends into
+        that have no children.  The searches reaching a node are visited
+        in list order, so the marks a search sets on its results are seen
+        by the searches after it.
+        
+        @param searches: List of (visit, leaf) pairs.
+        @keyword node_id: The node id to search below.
+        @keyword path: The path of the node.
+        @keyword csv_writer: Passed on to the visit and leaf functions.
+        @return: Generator of (search index, path, node) for the nodes
+                emitted, in the order of a recursive pre-order search.
+        
+        """
+        paths = self.paths
+        nodes = self.nodes
+        searches = [(i, 1 << i, visit, leaf)
+                    for (i, (visit, leaf)) in enumerate(searches)]
+        (EMIT, DESCEND) = (self.EMIT, self.DESCEND)
+        # Stack of (node id, parent path, bit mask of the searches).
+        stack = []
+        node = None
+        (mask, descend_mask) = (0, (1 << len(searches)) - 1)
+        while True:
+            # Push the children of the node if any search descends into it.
+            if descend_mask:
+                children = list(paths.tree_children(node_id))
+                if children:
+                    children.reverse()
+                    stack.extend((child_id, path, descend_mask)
+                                 for child_id in children)
+                else:
+                    if node is None:
+                        node = nodes[node_id]
+                    for (i, bit, visit, leaf) in searches:
+                        if leaf is not None and descend_mask & bit:
+                            leaf(node, path, csv_writer)
+            if not stack:
+                return
+            (node_id, path, mask) = stack.pop()
+            path = self.join_path(path, paths.name(node_id))
+            node = Node(nodes, node_id)
+            descend_mask = 0
+            for (i, bit, visit, leaf) in searches:
+                if mask & bit:
+                    result = visit(node, path, csv_writer)
+                    if result & EMIT:
+                        yield (i, path, node)
+                    if result & DESCEND:
+                        descend_mask |= bit
+    
+    def batch_search(self, node_id, path, csv_writer=None):
+        """Depth First Search Tree Walk.
+        
+        Searches for the highest paths that satisfies the maximum files.
+        
+        @param node_id: The node id on the path trie.
+        @param path: The path of the node.
+        @keyword csv_writer: If provided will write to csv file.
+        
+        """
+        for (i, p, n) in self.walk_tree([(self.visit_batch, self.leaf_batch)],
+                                        node_id, path, csv_writer=csv_writer):
+            yield (p, n)
+    
+    def search_batchable(self, node_id, path, csv_writer=None):
+        """Depth First Search Tree Walk.
+        
+        Searches for a returns highest nodes that are marked batchable.
+        
+        @attention: analyze_batchable should be run first.
+        
+        @param node_id: The node id on the path trie.
+        @param path: The path of the node.
+        @keyword csv_writer: If provided will write to csv file.
+        
+        """
+        for (i, p, n) in self.walk_tree([(self.visit_batchable,
+                                          self.leaf_batchable)],
+                                        node_id, path, csv_writer=csv_writer):
+            yield (p, n)
+    
+    def search_trimmable(self, node_id, path, csv_writer=None):
+        """Depth First Search Tree Walk.
+        
+        Searches for and returns highest nodes that are marked trimmable
+        and also within the file limit.
+        
+        @param node_id: The node id on the path trie.
+        @param path: The path of the node.
+        @keyword csv_writer: If provided will write to csv file.
+        
+        """
+        for (i, p, n) in self.walk_tree([(self.visit_trimmable, None)],
+                                        node_id, path, csv_writer=csv_writer):
+            yield (p, n)
+    
+    def search_unable_shorten(self, node_id, path, csv_writer=None):
+        """Depth First Search Tree Walk.
+        
+        Searches for and returns highest nodes that are marked unable_to_shorten.
+        
+        @param node_id: The node id on the path trie.
+        @param path: The path of the node.
+        @keyword csv_writer: If provided will write to csv file.
+        
+        """
+        for (i, p, n) in self.walk_tree([(self.visit_unable_shorten, None)],
+                                        node_id, path, csv_writer=csv_writer):
+            yield (p, n)
+    
+    def within_limits(self, cnt, size, file_limit=None):
+        """Checks a file count against the file limit, and a size against
+        byte_limit if set.
+        
+        @param cnt: The file count.
+        @param size: The size in bytes.
+        @keyword file_limit: The file limit.  Defaults to file_limit.
+        
+        """
+        if file_limit is None:
+            file_limit = self.file_limit
+        return cnt <= file_limit and (self.byte_limit is None or
+                                      size <= self.byte_limit)
+    
+    def visit_batch(self, node, path, csv_writer=None):
+        """walk_tree visit function of batch_search."""
+        if self.search_local:
+            result = (self.EMIT if self.within_limits(node.local_plus_child_cnt,
+                                                      node.local_bytes) else 0)
+        else:
+            if self.within_limits(node.total_plus_child_cnt, node.total_bytes):
+                return self.EMIT
+            result = 0
+        if not self.within_limits(node.local_plus_child_cnt, node.local_bytes):
+            self.warn_over_limit(node, path, csv_writer)
+        return result | self.DESCEND
+    
+    def leaf_batch(self, node, path, csv_writer=None):
+        """walk_tree leaf function of batch_search."""
+        if not self.within_limits(node.local_plus_child_cnt, node.local_bytes):
+            self.warn_over_limit(node, path, csv_writer)
+    
+    def visit_batchable(self, node, path, csv_writer=None):
+        """walk_tree visit function of search_batchable."""
+        if node.trimmed:
+            # Skip going down this path if node is trimmed.
+            return 0
+        if node.batchable:
+            return self.EMIT
+        self.leaf_batchable(node, path, csv_writer)
+        return self.DESCEND
+    
+    def leaf_batchable(self, node, path, csv_writer=None):
+        """walk_tree leaf function of search_batchable."""
+        if node.batchable is False and node.wrote_over_limit is False:
+            self.warn_over_limit(node, path, csv_writer)
+            node.wrote_over_limit = True
+    
+    def visit_trimmable(self, node, path, csv_writer=None):
+        """walk_tree visit function of search_trimmable."""
+        return self.EMIT if node.trimmable else self.DESCEND
+    
+    def visit_unable_shorten(self, node, path, csv_writer=None):
+        """walk_tree visit function of search_unable_shorten."""
+        return self.EMIT if node.unable_to_shorten else self.DESCEND
+    
+    def warn_over_limit(self, node, path, csv_writer=None):
+        """Reports a directory with a local file count over file_limit, or
+        local size over byte_limit.
+        
+        @param node: The Node of the directory.
+        @param path: The path of the directory.
+        @keyword csv_writer: If provided will write to csv file.
+        
+        """
+        if node.local_plus_child_cnt <= self.file_limit and self.byte_limit is not None:
+            if csv_writer:
+                row = ['WARNING','Directory local size over byte limit',
+                       self.byte_limit,path,
+                       int(node.local_bytes),
+                       int(node.total_bytes - node.local_bytes),
+                       int(node.total_bytes)]
+                self.writerow(csv_writer, row)
+            else:
+                message = (' WARNING: DIRECTORY LOCAL SIZE OVER BYTE LIMIT (%s): %s, bytes: %s' %
+                       (self.byte_limit, path, int(node.local_bytes)))
+                log('INFO', logfile, message, print_stdout=True)
+        elif csv_writer:
+            row = ['WARNING','Directory local file count over limit',
+                   self.file_limit,path,
+                   node.local_plus_child_cnt,
+                   node.subdir_plus_child_cnt,
+                   node.total_plus_child_cnt]
+            self.writerow(csv_writer, row)
+        else:
+            message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
+                   (self.file_limit, path, node.local_plus_child_cnt))
+            log('INFO', logfile, message, print_stdout=True)
+        self._dirs_over_limit += 1
+    
+    def sweep_marks(self, file_limit, batchable=True, trimmable=True):
+        """Works out the batchable and trimmable marks for a file limit.
+        
+        A node is reached by the walk up from the leaf nodes if it is a
+        leaf, or one of its children is reached and either skipped (an
+        empty folder that is not shortened) or within the limit.  For
+        trimmable, children that cannot be shortened also stop the walk.
+        Reached nodes that are not skipped are marked within (1) or over
+        (2) the limit.  Batchable nodes must also have a local size within
+        byte_limit, if set.
+        
+        This is one sweep over the node ids from the highest down, as
+        parents always have lower ids than their children, instead of a
+        walk up from every leaf.  Nothing is changed on the nodes.
+        
+        @param file_limit: The file limit.
+        @keyword batchable: Works out the batchable marks.
+        @keyword trimmable: Works out the trimmable marks.
+        @return: Tuple of (batchable, trimmable) marks indexed by node id,
+                as bytearrays.  0 is unmarked, 1 within and 2 over the
+                limit.
+        
+        """
+        columns = self.nodes.columns
+        local_plus_child_cnt = columns['local_plus_child_cnt']
+        local_bytes = columns['local_bytes']
+        byte_limit = self.byte_limit
+        is_leaf = columns['is_leaf']
+        flags = self.nodes.flags
+        shortened = self.nodes.flag_mask('shortened')
+        can_shorten = self.nodes.flag_mask('can_shorten')
+        parent = self.paths.parent
+        in_tree = self.paths.in_tree
+        size = len(parent)
+        batch_marks = bytearray(size)
+        trim_marks = bytearray(size)
+        # Nodes reached by the walk up from a leaf.
+        batch_reached = bytearray(size)
+        trim_reached = bytearray(size)
+        for node_id in xrange(size - 1, 0, -1):
+            if not in_tree[node_id]:
+                continue
+            if is_leaf[node_id] == 1:
+                batch_reached[node_id] = batchable
+                trim_reached[node_id] = trimmable
+            cnt = local_plus_child_cnt[node_id]
+            # Skip empty folders that are not shortened.
+            if cnt == 0 and not flags[node_id] & shortened:
+                if batch_reached[node_id]:
+                    batch_reached[parent[node_id]] = 1
+                if trim_reached[node_id]:
+                    trim_reached[parent[node_id]] = 1
+                continue
+            if batch_reached[node_id]:
+                if cnt <= file_limit and (byte_limit is None or
+                                          local_bytes[node_id] <= byte_limit):
+                    batch_marks[node_id] = 1
+                    batch_reached[parent[node_id]] = 1
+                else:
+                    batch_marks[node_id] = 2
+            if trim_reached[node_id] and flags[node_id] & can_shorten:
+                if cnt <= file_limit:
+                    trim_marks[node_id] = 1
+                    trim_reached[parent[node_id]] = 1
+                else:
+                    trim_marks[node_id] = 2
+        return (batch_marks, trim_marks)
+    
+    def analyze_batchable(self):
+        """Marks node batchable True or False depending on the local file
+        count of the nodes above the leaf nodes.
+        
+        Ignores empty directories (unless shortened).
+        
+        @attention: update_node_child_cnts should be run first.
+        
+        """
+        self.analyze_batchable_trimmable(trimmable=False)
+    
+    def analyze_trimmable(self, csv_writer=None):
+        """Marks node trimmable True or False depending on the local file
+        count of the nodes above the leaf nodes.
+        
+        Ignores empty directories (unless shortened).
+        
+        @attention: update_node_child_cnts should be run first.
+        
+        @param csv_writer: CSV Writer for warnings file.
+        
+        """
+        self.analyze_batchable_trimmable(csv_writer=csv_writer,
+                                         batchable=False)
+    
+    def analyze_batchable_trimmable(self, csv_writer=None, batchable=True,
+                                    trimmable=True):
+        """Marks the batchable and trimmable nodes in one sweep.
+        
+        Writes a warning for each trimmable node over the file limit.
+        
+        @attention: update_node_child_cnts should be run first.
+        
+        @keyword csv_writer: CSV Writer for warnings file.
+        @keyword batchable: Marks the batchable attribute.
+        @keyword trimmable: Marks the trimmable attribute.
+        
+        """
+        message = 'Analyzing for%s%s nodes.' % (' batchable' if batchable else '',
+                                                ' trimmable' if trimmable else '')
+        log('INFO', logfile, message, print_stdout=True)
+        (batch_marks, trim_marks) = self.sweep_marks(self.file_limit,
+                                                     batchable=batchable,
+                                                     trimmable=trimmable)
+        batchable_column = self.nodes.columns['batchable']
+        flags = self.nodes.flags
+        trimmable_mask = self.nodes.flag_mask('trimmable')
+        wrote_over_limit = self.nodes.flag_mask('wrote_over_limit')
+        cnt = 0
+        for node_id in xrange(1, len(batch_marks)):
+            if batch_marks[node_id]:
+                batchable_column[node_id] = batch_marks[node_id] == 1
+                cnt += 1
+            if trim_marks[node_id] == 1:
+                flags[node_id] |= trimmable_mask
+                cnt += 1
+            elif trim_marks[node_id] == 2:
+                flags[node_id] &= ~trimmable_mask
+                cnt += 1
+                if not flags[node_id] & wrote_over_limit:
+                    node = self.nodes[node_id]
+                    self.warn_over_limit(node, self.get_node_path(node),
+                                         csv_writer)
+                    flags[node_id] |= wrote_over_limit
+        message = 'analyze_batchable_trimmable: Finished updating %s nodes.' % (cnt)
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def join_path(self, path, name):
+        """Appends a path component to a path.
+        
+        @param path: The parent path. Empty string for top level.
+        @param name: The path component to append.
+        
+        """
+        if not path:
+            return name
+        return self.path_sep.join([path,name])
+    
+    def depth_first_reverse_update(self):
+        """Rolls up node attributes into the parents, lowest depth first."""
+        if self.use_numpy:
+            self.depth_first_reverse_update_numpy()
+            return
+        cnt = 0
+        sorted_keys = sorted(self.nodes_depth.keys(), reverse=True)
+        message = 'Depth of nodes: %s' % (sorted_keys)
+        log('INFO', logfile, message, print_stdout=True)
+        for k in sorted_keys:
+            v = self.nodes_depth[k]
+            if self._debug:
+                message = 'len of depth %s: %s' % (k, len(v))
+                log('DEBUG', logfile, message, print_stdout=True)
+            for i in v:
+                node = self.nodes[i]
+                self.update_parent_attributes(node)
+                cnt += 1
+                if cnt % 50000 == 0:
+                    message = 'updated %s nodes.' % (cnt)
+                    log('INFO', logfile, message, print_stdout=True)
+        message = 'Finished updating %s nodes.' % (cnt)
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def depth_first_reverse_update_numpy(self):
+        """Vectorized depth_first_reverse_update.
         
-        @param csv_writer: The csv writer object, fetched from csv_writer().
-        @param row: The row to write.
+        Produces the same attributes as update_parent_attributes, but rolls
+        up a whole depth level at once with ufunc.at on NumPy views of the
+        node columns.
         
         """
-        encoded_row = [x.encode('utf-8') if isinstance(x,str) or
-                       isinstance(x,unicode) else x for x in row]
-        try:
-            csv_writer.writerow(encoded_row)
-        except UnicodeEncodeError:
-            message = ' DEBUG: encoded_row=%s' % encoded_row
-            log('WARNING', logfile, message, print_stdout=True)
-            raise
+        cnt = 0
+        sorted_keys = sorted(self.nodes_depth.keys(), reverse=True)
+        message = 'Depth of nodes: %s' % (sorted_keys)
+        log('INFO', logfile, message, print_stdout=True)
+        parent = np.frombuffer(self.paths.parent, dtype=self.paths.parent.typecode)
+        subdir_cnt = self.nodes.numpy_column('subdir_cnt')
+        total_cnt = self.nodes.numpy_column('total_cnt')
+        total_bytes = self.nodes.numpy_column('total_bytes')
+        num_unable_to_shorten = self.nodes.numpy_column('num_unable_to_shorten')
+        longest_fn_length = self.nodes.numpy_column('longest_fn_length')
+        longest_fp_length = self.nodes.numpy_column('longest_fp_length')
+        flags = self.nodes.numpy_column('flags')
+        outlier_flags = flags.dtype.type(self.nodes.flag_mask('has_outliers1',
+                                                              'has_outliers2',
+                                                              'has_outliers3'))
+        for k in sorted_keys:
+            ids = np.array(self.nodes_depth[k], dtype=np.intp)
+            cnt += len(ids)
+            if self._debug:
+                message = 'len of depth %s: %s' % (k, len(ids))
+                log('DEBUG', logfile, message, print_stdout=True)
+            # Top level nodes have no parent to update.
+            if k < 2:
+                continue
+            parent_ids = parent[ids]
+            node_total_cnt = total_cnt[ids]
+            np.add.at(subdir_cnt, parent_ids, node_total_cnt)
+            np.add.at(total_cnt, parent_ids, node_total_cnt)
+            np.add.at(total_bytes, parent_ids, total_bytes[ids])
+            np.add.at(num_unable_to_shorten, parent_ids,
+                      num_unable_to_shorten[ids])
+            np.maximum.at(longest_fn_length, parent_ids, longest_fn_length[ids])
+            np.maximum.at(longest_fp_length, parent_ids, longest_fp_length[ids])
+            np.bitwise_or.at(flags, parent_ids, flags[ids] & outlier_flags)
+        message = 'Finished updating %s nodes.' % (cnt)
+        log('INFO', logfile, message, print_stdout=True)
     
-    def file_generator(self):
-        """Generator object for file.
+    def set_debug(self, debug):
+        self._debug = debug
+
+
+class ExternalNode(object):
+    
+    """Tree node read back by ExternalAnalyzer.
+    
+    Holds the attributes used when writing the batch results, plus the
+    batchable and trimmable marks worked out for the file limit.
+    
+    """
+    
+    # Attributes stored in the node records, in order.
+    FIELDS = ('depth', 'is_leaf', 'local_plus_child_cnt',
+              'subdir_plus_child_cnt', 'total_plus_child_cnt',
+              'local_path_length', 'longest_fn_length', 'longest_fp_length',
+              'has_outliers1', 'has_outliers2', 'has_outliers3',
+              'num_local_outliers1', 'num_local_outliers2',
+              'num_unable_to_shorten', 'unable_to_shorten', 'batchable',
+              'trimmable', 'outlier3_file', 'local_bytes', 'total_bytes')
+    
+    __slots__ = ('path', 'trimmed', 'wrote_over_limit') + FIELDS
+    
+    def __init__(self, path, values):
+        """Constructs a node from a node record.
         
-        Each call to next() yields one line of content from the file.
+        @param path: The path of the node.
+        @param values: The FIELDS values.
         
         """
-        with codecs.open(self._file, encoding=self.encoding) as f:
-            for line in f:
-                yield line
+        self.path = path
+        for (name, value) in zip(self.FIELDS, values):
+            setattr(self, name, value)
+        self.trimmed = False
+        # Trimmable nodes over the limit are warned about before the walk.
+        self.wrote_over_limit = self.trimmable is False
     
-    def detect_encoding(self, N=20):
-        """Tries to detect the file's encoding.
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,self.path)
+
+
+class ExternalAnalyzer(Analyzer):
+    
+    """Analyzer for listings that do not fit in memory.
+    
+    The tree is not kept in memory.  Instead:
+    1. The counters of each directory are aggregated into (dir_path,
+       counters) records, sorted on disk with an ExternalSorter.
+    2. The merged records, in directory-sorted order, are rolled up with a
+       stack of the open directories.  A directory is complete when the
+       records move past it, so this is a post-order pass that writes the
+       node records, with the batchable and trimmable marks for file_limit.
+    3. The node records are sorted again into pre-order, and walk_tree
+       streams them to the searches of write_limit_results.
+    
+    Memory is bounded by the memory budget and the tree depth.  The output
+    files have the same rows as Analyzer, but directories come in sorted
+    order instead of listing order.  Outliers are spilled as (depth, file
+    path) records.
+    
+    """
+    
+    # Approximate bytes taken by a buffered directory record, plus
+    # RECORD_CHAR_BYTES per character of the path.
+    RECORD_BYTES = 400
+    RECORD_CHAR_BYTES = 8
+    # Fields of the directory records.
+    (LOCAL_CNT, LONGEST_FN, LONGEST_FP, NUM_OUTLIERS1, NUM_OUTLIERS2,
+     NUM_OUTLIERS3, FLAGS, REACH, SHORTENED, OUTLIER3_FILE,
+     LOCAL_BYTES) = range(11)
+    
+    def __init__(self, _file, memory_budget=None, **kwargs):
+        """Constructs a new ExternalAnalyzer object.
         
-        @attention: Defaults to UTF-8 if detection confidence is < 50%.
+        @param _file: The file path to analyze.
+        @keyword memory_budget: The approximate memory for buffered records
+                in megabytes, shared by the two sorts.
+                Defaults to 1024.
         
-        @keyword N: The number of lines to read from a file to guess
-                the encoding type.
+        Other keywords are as for Analyzer.  Workers, snapshots and file
+        limit sweeps are not supported.
         
         """
+        Analyzer.__init__(self, _file, **kwargs)
+        # Partial trees of workers cannot be merged into the records.
+        self.workers = 1
         try:
-            N = int(N)
-        except ValueError:
-            N = 20
-        _file = self._file
-        
-        unicode_regex = ('UTF|Big5|GB2312|EUC-TW|HZ-GB-2312|ISO-2022'
-                         'EUC-JP|SHIFT_JIS|EUC-KR|TIS-620')
+            self.memory_budget = int(memory_budget)
+        except (ValueError,TypeError):
+            self.memory_budget = 1024
+        budget = self.memory_budget * 1024 * 1024 // 2
+        directory = self.outliers1.directory
+        self.dir_records = ExternalSorter(budget, directory,
+                                          combine=self.combine_dir_records,
+                                          factory=self.new_dir_record)
+        self.node_records = ExternalSorter(budget, directory)
+        mask = self.nodes.flag_mask
+        self._outlier_flags = mask('has_outliers1', 'has_outliers2',
+                                   'has_outliers3')
+        self._flag_masks = dict((name, mask(name)) for name in NodeStore.FLAGS)
+    
+    def new_dir_record(self):
+        """Returns the counters of a directory with no files."""
+        return [0, 0, 0, 0, 0, 0, 0, 0, None, None, 0]
+    
+    def combine_dir_records(self, a, b):
+        """Adds the counters of directory record b to a.
         
-        with open(_file) as f:
-            # Read N lines from file, and join them into a single
-            # string buffer that chardet will accept.
-            detect = chardet.detect(''.join(islice(f,N)))
-            self.detect = detect
+        @return: The combined record a.
         
-        encoding = detect['encoding'] if detect['encoding'] else ''
-        m = re.search(unicode_regex, encoding, re.IGNORECASE)
+        """
+        for i in (self.LOCAL_CNT, self.NUM_OUTLIERS1, self.NUM_OUTLIERS2,
+                  self.NUM_OUTLIERS3, self.LOCAL_BYTES):
+            a[i] += b[i]
+        for i in (self.LONGEST_FN, self.LONGEST_FP, self.REACH):
+            if a[i] < b[i]:
+                a[i] = b[i]
+        a[self.FLAGS] |= b[self.FLAGS]
+        # Keep the shortest shortened path, the first one on ties.
+        if b[self.SHORTENED] is not None and (a[self.SHORTENED] is None or
+                                              b[self.SHORTENED] < a[self.SHORTENED]):
+            a[self.SHORTENED] = b[self.SHORTENED]
+            a[self.OUTLIER3_FILE] = b[self.OUTLIER3_FILE]
+        return a
+    
+    def close_spills(self):
+        """Removes the spill and run files."""
+        Analyzer.close_spills(self)
+        self.dir_records.close()
+        self.node_records.close()
+    
+    def get_run_counts(self):
+        """Returns the run wide counters, with the node records counted
+        as nodes.  Shortened paths are not kept per directory, so there is
+        no outliers3 count.
         
-        # If the confidence is better than or equal to 50%
-        if (m and detect['confidence'] >= 0.5):
-            self.encoding = encoding
-        else:
-            # Default to UTF-8
-            self.encoding = 'utf-8'
+        """
+        counts = Analyzer.get_run_counts(self)
+        counts['nodes'] = self.node_records.count
+        counts['outliers3'] = None
+        counts['memory_budget_mb'] = self.memory_budget
+        return counts
     
-    def search(self, node, path, csv_writer=None):
-        """Depth First Search Tree Walk.
+    def parse_item_path(self, item_path, category=None, size=None):
+        """Parses the Item_Path field into the directory records.
         
-        Searches for the highest paths that satisfies the maximum files.
+        Folder items are skipped, only directories leading to a file are
+        on the tree.
         
-        @keyword csv_writer: If provided will write to csv file.
+        @param item_path: The Item_Path field.
+        @keyword category: The Category field.
+        @keyword size: The size of the file in bytes, if sizes are read.
         
         """
-        if not node:
-            if (path in self.dir_file_cnts and
-                self.dir_file_cnts[path]['local_cnt'] > self.file_limit):
-                if csv_writer:
-                    v = self.dir_file_cnts[path]
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,path,
-                           v['local_cnt'],v['subdir_cnt'],v['total_cnt']]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit, path, self.dir_file_cnts[path]))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
+        if category == 'Folder':
             return
-        for k in node.keys():
-            # Check file count for path.
-            t_path = self.path_sep.join([path,k]).lstrip(self.path_sep)
-            if self.dir_file_cnts[t_path]['total_cnt'] <= self.file_limit:
-                yield t_path
-                continue
-            if self.dir_file_cnts[t_path]['local_cnt'] > self.file_limit:
-                if csv_writer:
-                    v = self.dir_file_cnts[t_path]
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,t_path,
-                           v['local_cnt'],v['subdir_cnt'],v['total_cnt']]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit,t_path, self.dir_file_cnts[t_path]))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
-            for n in self.search(node[k], t_path, csv_writer=csv_writer):
-                yield n
+        path = self.extract_path(item_path)
+        if not path:
+            return
+        self.add_path(path, size=size)
     
-    def batch_search(self, node, path, csv_writer=None):
-        """Depth First Search Tree Walk.
-        
-        Searches for the highest paths that satisfies the maximum files.
+    def add_path(self, path, folder=False, size=None):
+        """Adds a file path to the directory records.  Folders are
+        skipped.
         
-        @param node: The tree node.
-        @param path: The path of the node.
-        @keyword csv_writer: If provided will write to csv file.
+        @param path: The path, without the root folder.
+        @keyword folder: True if the path is a folder.
+        @keyword size: The size of the file in bytes, if sizes are read.
         
         """
-        if not node:
-            if path not in self.nodes_path:
-                return
-            node_obj = self.nodes_path[path]
-            if node_obj.local_plus_child_cnt > self.file_limit:
-                if csv_writer:
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,path,
-                           node_obj.local_plus_child_cnt,
-                           node_obj.subdir_plus_child_cnt,
-                           node_obj.total_plus_child_cnt]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit, path, node_obj.local_plus_child_cnt))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
+        if folder:
             return
-        for k in node.keys():
-            # Check file count for path.
-            t_path = self.path_sep.join([path,k]).lstrip(self.path_sep)
-            node_obj = self.nodes_path[t_path]
-            if self.search_local:
-                if node_obj.local_plus_child_cnt <= self.file_limit:
-                    yield (t_path, node_obj)
-            else:
-                if node_obj.total_plus_child_cnt <= self.file_limit:
-                    yield (t_path, node_obj)
-                    continue
-            if node_obj.local_plus_child_cnt > self.file_limit:
-                if csv_writer:
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,t_path,
-                           node_obj.local_plus_child_cnt,
-                           node_obj.subdir_plus_child_cnt,
-                           node_obj.total_plus_child_cnt]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit, t_path, node_obj.local_plus_child_cnt))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
-            for (p,n) in self.batch_search(node[k], t_path, csv_writer=csv_writer):
-                yield (p,n)
+        (dir_path, sep, _file) = path.rpartition(self.path_sep)
+        (last_dir_path, record) = self._last_dir
+        if dir_path != last_dir_path:
+            key = tuple(dir_path.split(self.path_sep)) if sep else ()
+            record_size = (self.RECORD_BYTES +
+                           self.RECORD_CHAR_BYTES * len(dir_path))
+            record = self.dir_records.setdefault(key, record_size)
+            self._last_dir = (dir_path, record)
+        _file_length = len(_file)
+        path_length = len(path)
+        if record[self.LONGEST_FN] < _file_length:
+            record[self.LONGEST_FN] = _file_length
+        if record[self.LONGEST_FP] < path_length:
+            record[self.LONGEST_FP] = path_length
+        if self.find_outliers(record, path) and size:
+            record[self.LOCAL_BYTES] += size
     
-    def search_batchable(self, node, path, csv_writer=None):
-        """Depth First Search Tree Walk.
-        
-        Searches for a returns highest nodes that are marked batchable.
-        
-        @attention: analyze_batchable should be run first.
+    def find_outliers(self, record, path):
+        """Finds outliers, as Analyzer.find_outliers does.
         
-        @param node: The tree node.
-        @param path: The path of the node.
-        @keyword csv_writer: If provided will write to csv file.
+        @param record: The directory record of the file.
+        @param path: A string of the absolute file path.
+        @return: True if no outliers were found and the file is counted.
         
         """
-        if not node:
-            if path not in self.nodes_path:
-                return
-            node_obj = self.nodes_path[path]
-            if node_obj.batchable is False and node_obj.wrote_over_limit is False:
-                if csv_writer:
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,path,
-                           node_obj.local_plus_child_cnt,
-                           node_obj.subdir_plus_child_cnt,
-                           node_obj.total_plus_child_cnt]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit, path, node_obj.local_plus_child_cnt))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
-                node_obj.update({'wrote_over_limit':True})
-            return
-        # Check if node was already trimmed.
-        if path and path != self.path_sep:
-            node_obj = self.nodes_path[path]
-            if node_obj.trimmed:
-                return
-        for k in node.keys():
-            # Check if node is batchable.
-            t_path = self.path_sep.join([path,k]).lstrip(self.path_sep)
-            node_obj = self.nodes_path[t_path]
-            if node_obj.trimmed:
-                # Skip going down this path if node_obj is trimmed.
-                continue
-            if node_obj.batchable:
-                yield (t_path, node_obj)
-                continue
-            if node_obj.batchable is False and node_obj.wrote_over_limit is False:
-                if csv_writer:
-                    row = ['WARNING','Directory local file count over limit',
-                           self.file_limit,t_path,
-                           node_obj.local_plus_child_cnt,
-                           node_obj.subdir_plus_child_cnt,
-                           node_obj.total_plus_child_cnt]
-                    self.writerow(csv_writer, row)
-                else:
-                    message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                           (self.file_limit, t_path, node_obj.local_plus_child_cnt))
-                    log('INFO', logfile, message, print_stdout=True)
-                self._dirs_over_limit += 1
-                node_obj.update({'wrote_over_limit':True})
-            for (p,n) in self.search_batchable(node[k], t_path, csv_writer=csv_writer):
-                yield (p,n)
+        path_list = path.rsplit(self.path_sep, 2)
+        _file = path_list[-1]
+        parent_file = self.path_sep.join(path_list[-2:])
+        masks = self._flag_masks
+        if len(_file) > self.max_file_length:
+            depth = path.count(self.path_sep)
+            self.outliers1.add(depth, path)
+            record[self.NUM_OUTLIERS1] += 1
+            record[self.FLAGS] |= masks['has_outliers1']
+        elif len(parent_file) > self.max_parent_file_length:
+            depth = path.count(self.path_sep)
+            self.outliers2.add(depth, path)
+            record[self.NUM_OUTLIERS2] += 1
+            record[self.FLAGS] |= masks['has_outliers2']
+        elif len(path) > self.max_path_length:
+            shortened = self.shorten_path(path, self.max_path_length)
+            if (record[self.SHORTENED] is None or
+                    shortened < record[self.SHORTENED]):
+                record[self.SHORTENED] = shortened
+                record[self.OUTLIER3_FILE] = _file
+            if shortened == 'UNABLE_TO_SHORTEN':
+                record[self.FLAGS] |= masks['unable_to_shorten']
+            else:
+                # Number of folders marked can_shorten from the directory up.
+                levels = shortened.count(self.path_sep) + 1
+                if record[self.REACH] < levels:
+                    record[self.REACH] = levels
+            record[self.NUM_OUTLIERS3] += 1
+            record[self.FLAGS] |= masks['has_outliers3'] | masks['shortened']
+        else:
+            record[self.LOCAL_CNT] += 1
+            return True
+        return False
     
-    def search_trimmable(self, node, path, csv_writer=None):
-        """Depth First Search Tree Walk.
+    def build_tree(self):
+        """Reads the file into sorted directory records and rolls them up
+        into the node records.
         
-        Searches for and returns highest nodes that are marked trimmable
-        and also within the file limit.
+        """
+        with self.metrics.phase('ingest') as phase:
+            if self.scan_dir:
+                self.scan()
+            else:
+                self.ingest_files()
+            phase['lines'] = self._file_line_cnt
+        message = ['Done reading %s lines.' % (self._file_line_cnt)]
+        message.append('Number of directory records: %s in %s runs' %
+                       (self.dir_records.count, len(self.dir_records.runs)))
+        message.append('Rolling up directory records...')
+        log('INFO', logfile, '\n'.join(message), print_stdout=True)
+        with self.metrics.phase('rollup'):
+            self.rollup()
+        self.dir_records.close()
+        message = ('Number of nodes: %s in %s runs' %
+                   (self.node_records.count, len(self.node_records.runs)))
+        log('INFO', logfile, message, print_stdout=True)
+    
+    def rollup(self):
+        """Rolls up the merged directory records, in one post-order pass.
         
-        @param node: The tree node.
-        @param path: The path of the node.
-        @keyword csv_writer: If provided will write to csv file.
+        Does the work of depth_first_reverse_update, update_node_child_cnts,
+        set_can_shorten and sweep_marks.  Directories without files of
+        their own are added for the folders in between.
         
         """
-        if not node:
-            return
-        for k in node.keys():
-            # Check if node is trimmable.
-            t_path = self.path_sep.join([path,k]).lstrip(self.path_sep)
-            node_obj = self.nodes_path[t_path]
-            if node_obj.trimmable:
-                yield (t_path, node_obj)
+        # Stack of frames of the open directories, from the top level down.
+        stack = []
+        for (key, record) in self.dir_records:
+            # Files without a directory are not on the tree.
+            if not key:
                 continue
-            for (p,n) in self.search_trimmable(node[k], t_path, csv_writer=csv_writer):
-                yield (p,n)
+            # Complete the directories that key is not under.
+            while stack and key[:len(stack[-1][0])] != stack[-1][0]:
+                self.complete_frame(stack)
+            depth = len(stack[-1][0]) if stack else 0
+            for i in xrange(depth + 1, len(key)):
+                stack.append(self.new_frame(key[:i], self.new_dir_record()))
+            stack.append(self.new_frame(key, record))
+        while stack:
+            self.complete_frame(stack)
     
-    def search_unable_shorten(self, node, path, csv_writer=None):
-        """Depth First Search Tree Walk.
-        
-        Searches for and returns highest nodes that are marked unable_to_shorten.
+    def new_frame(self, key, record):
+        """Returns a rollup stack frame of a directory.
         
-        @param node: The tree node.
-        @param path: The path of the node.
-        @keyword csv_writer: If provided will write to csv file.
+        A frame is the list of: key, the directory record, then the
+        counters rolled up from the children (child_node_cnt,
+        direct_child_cnt, subdir_cnt, longest_fn_length, longest_fp_length,
+        outlier flags, num_unable_to_shorten, can_shorten reach), if the
+        children reached the directory for the batchable and trimmable
+        marks, and the subdir bytes.
         
         """
-        if not node:
-            return
-        for k in node.keys():
-            t_path = self.path_sep.join([path,k]).lstrip(self.path_sep)
-            node_obj = self.nodes_path[t_path]
-            # Check if node is unable to be shortened.
-            if node_obj.unable_to_shorten:
-                yield (t_path, node_obj)
-                continue
-            for (p,n) in self.search_unable_shorten(node[k], t_path, csv_writer=csv_writer):
-                yield (p,n)
+        return [key, record, 0, 0, 0, 0, 0, 0, 0, 0, False, False, 0]
     
-    def analyze_batchable(self):
-        """Starts at leaf nodes and reverse search for local file count.
-        Marks node batchable True or False depending on findings.
+    def complete_frame(self, stack):
+        """Pops a completed directory, writes its node record and rolls it
+        up into its parent.
         
-        Ignores empty directories (unless shortened).
+        @param stack: The rollup stack.
         
         """
-        message = 'Analyzing for batchable nodes.'
-        log('INFO', logfile, message, print_stdout=True)
-        cnt = 0
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt != 0:
-                continue
-            # Loop through path list.
-            path_list = dir_path.lstrip(self.path_sep).split(self.path_sep)
-            while path_list:
-                path = self.path_sep.join(path_list)
-                node = self.nodes_path[path]
-                if node.local_plus_child_cnt == 0 and not node.shortened:
-                    # Skip empty folders that are not shortened.
-                    path_list.pop()
-                    continue
-                if node.batchable is False:
-                    # Stop with this leaf node here.
-                    break
-                else:
-                    if node.local_plus_child_cnt <= self.file_limit:
-                        node.update({'batchable':True})
-                    else:
-                        node.update({'batchable':False})
-                        break
-                # Pop last element off list.
-                path_list.pop()
-            cnt += 1
-            if cnt % 50000 == 0:
-                message = 'analyze_batchable: updated %s nodes.' % (cnt)
-                log('INFO', logfile, message, print_stdout=True)
-        message = 'analyze_batchable: Finished updating %s nodes.' % (cnt)
-        log('INFO', logfile, message, print_stdout=True)
+        (key, record, child_node_cnt, direct_child_cnt, subdir_cnt,
+         longest_fn, longest_fp, outlier_flags, num_unable, reach,
+         batch_reached, trim_reached, subdir_bytes) = stack.pop()
+        masks = self._flag_masks
+        flags = record[self.FLAGS]
+        local_cnt = record[self.LOCAL_CNT]
+        total_cnt = local_cnt + subdir_cnt
+        local_bytes = record[self.LOCAL_BYTES]
+        total_bytes = local_bytes + subdir_bytes
+        longest_fn = max(longest_fn, record[self.LONGEST_FN])
+        longest_fp = max(longest_fp, record[self.LONGEST_FP])
+        outlier_flags |= flags & self._outlier_flags
+        unable_to_shorten = bool(flags & masks['unable_to_shorten'])
+        num_unable += 1 if unable_to_shorten else 0
+        reach = max(reach - 1, record[self.REACH])
+        is_leaf = direct_child_cnt == 0
+        local_plus_child_cnt = local_cnt + child_node_cnt
+        subdir_plus_child_cnt = subdir_cnt + child_node_cnt
+        # Marks as in sweep_marks.
+        if is_leaf:
+            batch_reached = self.search_local
+            trim_reached = True
+        (batchable, trimmable) = (None, None)
+        (batch_up, trim_up) = (False, False)
+        cnt = local_plus_child_cnt
+        if cnt == 0 and not flags & masks['shortened']:
+            # Skip empty folders that are not shortened.
+            (batch_up, trim_up) = (batch_reached, trim_reached)
+        else:
+            if batch_reached:
+                batchable = self.within_limits(cnt, local_bytes)
+                batch_up = batchable
+            if trim_reached and reach >= 1:
+                trimmable = cnt <= self.file_limit
+                trim_up = trimmable
+        values = (len(key), is_leaf, local_plus_child_cnt,
+                  subdir_plus_child_cnt,
+                  local_plus_child_cnt + subdir_plus_child_cnt,
+                  len(self.path_sep.join(key)), longest_fn, longest_fp,
+                  bool(outlier_flags & masks['has_outliers1']),
+                  bool(outlier_flags & masks['has_outliers2']),
+                  bool(outlier_flags & masks['has_outliers3']),
+                  record[self.NUM_OUTLIERS1], record[self.NUM_OUTLIERS2],
+                  num_unable, unable_to_shorten, batchable, trimmable,
+                  record[self.OUTLIER3_FILE], local_bytes, total_bytes)
+        size = self.RECORD_BYTES + self.RECORD_CHAR_BYTES * values[5]
+        self.node_records.add(key, values, size)
+        if not stack:
+            return
+        parent = stack[-1]
+        parent[2] += child_node_cnt + 1
+        parent[3] += 1
+        parent[4] += total_cnt
+        parent[5] = max(parent[5], longest_fn)
+        parent[6] = max(parent[6], longest_fp)
+        parent[7] |= outlier_flags
+        parent[8] += num_unable
+        parent[9] = max(parent[9], reach)
+        parent[10] = parent[10] or batch_up
+        parent[11] = parent[11] or trim_up
+        parent[12] += total_bytes
     
-    def analyze_trimmable(self, csv_writer=None):
-        """Starts at leaf nodes and reverse search for local file count.
-        Marks node trimmable True or False depending on findings.
+    def get_outlier3_file(self, node):
+        """Returns the filename of the shortest shortened path of a node."""
+        return node.outlier3_file
+    
+    def iter_nodes(self):
+        """Generator of the ExternalNodes, in pre-order."""
+        path_sep = self.path_sep
+        for (key, values) in self.node_records:
+            yield ExternalNode(path_sep.join(key), values)
+    
+    def analyze_batchable_trimmable(self, csv_writer=None, batchable=True,
+                                    trimmable=True):
+        """Writes a warning for each trimmable node over the file limit.
         
-        Ignores empty directories (unless shortened).
+        The marks themselves are worked out by rollup.
         
-        @param csv_writer: CSV Writer for warnings file.
+        @keyword csv_writer: CSV Writer for warnings file.
         
         """
         message = 'Analyzing for trimmable nodes.'
         log('INFO', logfile, message, print_stdout=True)
         cnt = 0
-        leaf_node_cnt = 0
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt == 0:
-                leaf_node_cnt += 1
-        message = 'Number of leaf nodes: %s' % (leaf_node_cnt)
-        log('INFO', logfile, message, print_stdout=True)
-        for (dir_path, tree_node) in self.walk_paths(self.dir_tree, ''):
-            child_node_cnt = self.count_child_nodes(tree_node)
-            if child_node_cnt != 0:
-                continue
-            # Loop through path list.
-            path_list = dir_path.lstrip(self.path_sep).split(self.path_sep)
-            while path_list:
-                path = self.path_sep.join(path_list)
-                node = self.nodes_path[path]
-                if node.local_plus_child_cnt == 0 and not node.shortened:
-                    # Skip empty folders that are not shortened.
-                    path_list.pop()
-                    continue
-                if node.can_shorten is False:
-                    # Stop with this leaf node here.
-                    break
-                else:
-                    if node.local_plus_child_cnt <= self.file_limit:
-                        node.update({'trimmable':True})
-                    else:
-                        node.update({'trimmable':False})
-                        if node.wrote_over_limit is False:
-                            if csv_writer:
-                                row = ['WARNING','Directory local file count over limit',
-                                       self.file_limit,path,
-                                       node.local_plus_child_cnt,
-                                       node.subdir_plus_child_cnt,
-                                       node.total_plus_child_cnt]
-                                self.writerow(csv_writer, row)
-                            else:
-                                message = (' WARNING: DIRECTORY LOCAL FILE COUNT OVER LIMIT (%s): %s, files: %s' %
-                                       (self.file_limit, path, node.local_plus_child_cnt))
-                                log('INFO', logfile, message, print_stdout=True)
-                            self._dirs_over_limit += 1
-                            node.update({'wrote_over_limit':True})
-                        break
-                # Pop last element off list.
-                path_list.pop()
-            cnt += 1
-            if cnt % 50000 == 0:
-                message = 'analyze_trimmable: updated %s nodes.' % (cnt)
-                log('INFO', logfile, message, print_stdout=True)
-        message = 'analyze_trimmable: Finished updating %s nodes.' % (cnt)
+        for node in self.iter_nodes():
+            if node.trimmable is False:
+                self.warn_over_limit(node, node.path, csv_writer)
+                cnt += 1
+        message = 'analyze_batchable_trimmable: Found %s nodes over limit.' % (cnt)
         log('INFO', logfile, message, print_stdout=True)
     
-    def add(self, t, path):
-        """Adds a path to the tree.
+    def walk_tree(self, searches, node_id=0, path='', csv_writer=None):
+        """Streams the node records through the searches, as
+        Analyzer.walk_tree does for the path trie.
+        
+        Only whole tree walks are supported, node_id and path are ignored.
+        Every node record is read, the nodes no search descends to are
+        skipped.
+        
+        """
+        searches = [(i, 1 << i, visit, leaf)
+                    for (i, (visit, leaf)) in enumerate(searches)]
+        (EMIT, DESCEND) = (self.EMIT, self.DESCEND)
+        all_searches = (1 << len(searches)) - 1
+        # Descend masks of the ancestors of the node, by depth.
+        masks = []
+        for node in self.iter_nodes():
+            del masks[node.depth - 1:]
+            mask = masks[-1] if masks else all_searches
+            descend_mask = 0
+            for (i, bit, visit, leaf) in searches:
+                if mask & bit:
+                    result = visit(node, node.path, csv_writer)
+                    if result & EMIT:
+                        yield (i, node.path, node)
+                    if result & DESCEND:
+                        descend_mask |= bit
+            if descend_mask and node.is_leaf:
+                for (i, bit, visit, leaf) in searches:
+                    if leaf is not None and descend_mask & bit:
+                        leaf(node, node.path, csv_writer)
+            masks.append(descend_mask)
+    
+    def write_outlier_results(self, outliers1_writer, outliers2_writer):
+        """Writes the outliers files from the (depth, file path) spills.
         
-        @param t: The tree.
-        @param path: A list of the path structure.
+        @param outliers1_writer: CSV Writer for the outliers 1 file.
+        @param outliers2_writer: CSV Writer for the outliers 2 file.
         
         """
-        for node in path:
-            t = t[node]
+        message = 'Writing outlier files...'
+        log('INFO', logfile, message, print_stdout=True)
+        self.writerow(outliers1_writer, self.OUTLIERS1_HEADER)
+        for (depth, path) in self.outliers1:
+            (dir_path, sep, _file) = path.rpartition(self.path_sep)
+            row = [depth,len(_file),_file,dir_path]
+            self.writerow(outliers1_writer, row)
+        self.writerow(outliers2_writer, self.OUTLIERS2_HEADER)
+        for (depth, path) in self.outliers2:
+            dir_path = path.rpartition(self.path_sep)[0]
+            parent_file = self.path_sep.join(path.rsplit(self.path_sep, 2)[-2:])
+            row = [depth,len(parent_file),parent_file,dir_path]
+            self.writerow(outliers2_writer, row)
+
+
+def init_worker(log_path):
+    """Worker process initializer of the Analyzer pools.
     
-    def count_nodes(self, node):
-        """Counts the number of nodes including top level node."""
-        count = 1
-        for child in node.values():
-            count += self.count_nodes(child)
-        return count
+    Processes that are not forked (eg: on Windows) do not inherit the
+    logfile set by main(), so it is passed in.  Also starts the logger
+    thread of the worker.
     
-    def count_child_nodes(self, node):
-        """Counts the number of child nodes for a given node."""
-        return self.count_nodes(node) - 1
+    @param log_path: The log file of the main process.
     
-    def walk_paths(self, node, path):
-        """Depth First Search tree walk that returns path and corresponding
-        tree node in a tuple.
-        
-        @attention: node here is not Node object!
+    """
+    global logfile
+    logfile = log_path
+    _logger.start()
+
+
+def ingest_shard(args):
+    """Worker process entry point of Analyzer.ingest_files.
+    
+    @param args: Tuple of (settings, header, start, end).
+    @return: The worker Analyzer holding the partial tree.
+    
+    """
+    (settings, header, start, end) = args
+    settings = dict(settings)
+    debug = settings.pop('debug')
+    analyzer = Analyzer(worker=True, **settings)
+    analyzer.set_debug(debug)
+    if debug:
+        _logger.set_level('DEBUG')
+    analyzer.ingest_range(header, start, end)
+    # Only the tree, counters and outliers are sent back.
+    analyzer._last_dir = (None, None)
+    analyzer._shorten_cache = (None, None, 0)
+    analyzer.path_cache.clear()
+    # Worker processes exit without running atexit.
+    _logger.flush()
+    return analyzer
+
+
+def scan_shard(args):
+    """Worker process entry point of Analyzer.scan.
+    
+    @param args: Tuple of (settings, dir_path, names, recursive).
+    @return: The worker Analyzer holding the partial tree.
+    
+    """
+    (settings, dir_path, names, recursive) = args
+    settings = dict(settings)
+    debug = settings.pop('debug')
+    analyzer = Analyzer(worker=True, **settings)
+    analyzer.set_debug(debug)
+    if debug:
+        _logger.set_level('DEBUG')
+    analyzer.scan_tree(dir_path, names, recursive)
+    # Only the tree, counters and outliers are sent back.
+    analyzer._last_dir = (None, None)
+    analyzer._shorten_cache = (None, None, 0)
+    analyzer.path_cache.clear()
+    # Worker processes exit without running atexit.
+    _logger.flush()
+    return analyzer
+
+
+class Logger(object):
+    
+    """Log writer running in a background thread.
+    
+    log() only appends the message, its format arguments and its time to
+    a deque, so logging does not block the caller on formatting, file or
+    terminal output.  The thread keeps the log files open and writes the
+    lines in batches, with one write call when the deque runs empty or a
+    batch is over BATCH_SIZE.  Whole lines are written, so lines of worker
+    processes sharing a log file do not mix.  Messages below the logger
+    level are dropped before they are queued.
+    
+    """
+    
+    LEVELS = {'DEBUG':10, 'INFO':20, 'WARNING':30, 'ERROR':40}
+    # Bytes of lines to write at once.
+    BATCH_SIZE = 65536
+    # Seconds the thread sleeps when there is nothing to write.
+    POLL_INTERVAL = 0.05
+    
+    def __init__(self, level='INFO'):
+        self.set_level(level)
+        self._pid = None
+        self._thread = None
+        self._records = deque()
+        self._queued = 0
+        self._written = 0
+        self._closing = False
+        self._files = {}
+        self._batches = {}
+        # (millisecond, logtype, line prefix) of the last message.
+        self._prefix = (None, None, None)
+    
+    def set_level(self, level):
+        """Sets the lowest level logged. Eg: 'DEBUG'"""
+        self.level = self.LEVELS[level]
+    
+    def start(self):
+        """Starts the writer thread of this process.
         
-        @param node: The Tree() node.
-        @param path: The current path. Usually start with an empty string.
+        A worker process gets its own thread and file handles, started by
+        init_worker.  The parent should flush before forking, so no
+        buffered lines are inherited.
         
         """
-        if not node:
+        self._pid = os.getpid()
+        self._records = deque()
+        self._queued = 0
+        self._written = 0
+        self._closing = False
+        self._files = {}
+        self._batches = {}
+        self._prefix = (None, None, None)
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def log(self, logtype, logfile, message, print_stdout=True, TAG=None,
+            args=None):
+        """Queues a message, see log()."""
+        if self.LEVELS.get(logtype, 20) < self.level:
             return
-        for k in node.keys():
-            # Check
-            yield (path + '\\' + k, node[k])
-            for (p,n) in self.walk_paths(node[k], path + '\\' + k):
-                yield (p,n)
+        if self._thread is None:
+            self.start()
+        self._queued += 1
+        self._records.append((time.time(), logtype, logfile, message,
+                              print_stdout, TAG, args))
     
-    def depth_first_reverse_update(self):
-        cnt = 0
-        sorted_keys = sorted(self.nodes_depth.keys(), reverse=True)
-        message = 'Depth of nodes: %s' % (sorted_keys)
-        log('INFO', logfile, message, print_stdout=True)
-        for k in sorted_keys:
-            v = self.nodes_depth[k]
-            if self._debug:
-                message = 'len of depth %s: %s' % (k, len(v))
-                log('INFO', logfile, message, print_stdout=True)
-            for i in v:
-                node = self.nodes_id[i]
-                self.update_parent_attributes(node)
-                cnt += 1
-                if cnt % 50000 == 0:
-                    message = 'updated %s nodes.' % (cnt)
-                    log('INFO', logfile, message, print_stdout=True)
-        message = 'Finished updating %s nodes.' % (cnt)
-        log('INFO', logfile, message, print_stdout=True)
+    def run(self):
+        """Writes the queued messages until closed."""
+        records = self._records
+        while True:
+            if not records:
+                self.flush_files()
+                if self._closing:
+                    return
+                time.sleep(self.POLL_INTERVAL)
+                continue
+            try:
+                self.write(*records.popleft())
+            except Exception as e:
+                print >>sys.stderr, 'ERROR: Unable to write log: %s' % e
+            self._written += 1
     
-    def set_debug(self, debug):
-        self._debug = debug
-
-
-def Tree():
-    """Tree Data Structure implementation."""
-    return defaultdict(Tree)
+    def write(self, ct, logtype, logfile, message, print_stdout, TAG, args):
+        """Formats and writes a message."""
+        if args is not None:
+            message = message % args
+        # Messages are often logged many to a millisecond.
+        ms = long(ct * 1000)
+        if self._prefix[0] != ms or self._prefix[1] != logtype:
+            self._prefix = (ms, logtype, '%s,%03d %s PID[%s]: ' % (
+                time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ct)),
+                ms % 1000, logtype, self._pid))
+        prefix = self._prefix[2]
+        # Clean message
+        logtxt = message.strip()
+        # Add TAG if necessary.
+        if TAG:
+            logtxt = '%s: %s' % (TAG, logtxt)
+        # Add prefix to start of every line.
+        if '\n' in logtxt or '\r' in logtxt:
+            logtxt = os.linesep.join(prefix + line for line in logtxt.splitlines())
+        else:
+            logtxt = prefix + logtxt
+        if isinstance(logtxt, unicode):
+            logtxt = logtxt.encode('utf-8')
+        batch = self._batches.get(logfile)
+        if batch is None:
+            batch = self._batches[logfile] = [0]
+        batch.append(logtxt.rstrip() + os.linesep)
+        batch[0] += len(batch[-1])
+        if batch[0] > self.BATCH_SIZE:
+            self.write_batch(logfile)
+        if print_stdout:
+            if logtype == 'ERROR':
+                print >>sys.stderr, message
+            else:
+                print message
+    
+    def write_batch(self, logfile):
+        """Writes the batched lines of a log file."""
+        batch = self._batches.pop(logfile)
+        f = self._files.get(logfile)
+        if f is None:
+            # Unbuffered, so a batch is one write call.
+            f = self._files[logfile] = open(logfile, 'a', 0)
+        f.write(''.join(batch[1:]))
+    
+    def flush_files(self):
+        for logfile in self._batches.keys():
+            self.write_batch(logfile)
+        sys.stdout.flush()
+    
+    def flush(self):
+        """Waits until the queued messages are written."""
+        if self._pid != os.getpid():
+            return
+        while self._written < self._queued or self._batches:
+            time.sleep(0.001)
+    
+    def close(self):
+        """Writes the queued messages and stops the writer thread."""
+        if self._pid != os.getpid():
+            return
+        self._closing = True
+        self._thread.join()
+        for f in self._files.itervalues():
+            f.close()
+        self._pid = None
 
 
-def di(obj_id):
-    """Reverse of id() function."""
-    return _ctypes.PyObj_FromPtr(obj_id)
+_logger = Logger()
+atexit.register(_logger.close)
 
 
-def log(logtype, logfile, message, print_stdout=True, TAG=None):
+def log(logtype, logfile, message, print_stdout=True, TAG=None, args=None):
     """Log message to a log file.
     
-    @param logtype: [INFO|ERROR] The message type.
+    The message is written by the background Logger thread.  Frequent
+    messages (eg: DEBUG traces) should pass their format arguments in args,
+    so the formatting is done by the thread too.
+    
+    @param logtype: [DEBUG|INFO|WARNING|ERROR] The message type.
     @param logfile: The logfile to print to.
     @param message: A string to print to the log.
     @keyword print_stdout: If True, message will be printed to stdout,
@@ -1587,35 +5121,11 @@ def log(logtype, logfile, message, print_stdout=True, TAG=None):
             to stderr (default=True).
     @keyword TAG: TAG directly prefixed to message, but after standard
             headers.
+    @keyword args: Tuple of format arguments.  If given, message is a
+            format string, formatted with % when written.
     
     """
-    ct = time.time()
-    msecs = (ct - long(ct)) * 1000
-    t = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-    date = "%s,%03d" % (t, msecs)
-    
-    prefix = '%s %s PID[%s]: ' % \
-        (date, logtype, os.getpid())
-    
-    # Clean message
-    logtxt = message.strip()
-    # Add TAG if necessary.
-    if TAG:
-        logtxt = re.sub('^', str(TAG) + ': ', logtxt)
-    # Add prefix to start of message.
-    logtxt = re.sub('^', str(prefix), logtxt)
-    logtxt = re.sub('\r\n', os.linesep + str(prefix), logtxt)
-    logtxt = re.sub('\n', os.linesep + str(prefix), logtxt)
-    logtxt = re.sub('\r', '\r' + str(prefix), logtxt)
-    
-    with open(logfile, 'a') as f:
-        f.write(logtxt.rstrip() + os.linesep)
-    
-    if print_stdout:
-        if logtype == 'ERROR':
-            print >>sys.stderr, message
-        else:
-            print message
+    _logger.log(logtype, logfile, message, print_stdout, TAG, args)
 
 
 ###############################################################################
@@ -1629,6 +5139,11 @@ def usage():
     Required argument(s):
       -f <FILE_PATH>, --file=<FILE_PATH>
             The file to analyze.
+            Give more than once to analyze several listings (eg: one per
+            custodian) as one tree.  With --workers they are read
+            concurrently, and a sources file has the counters of each.
+            Eg: -f custodian1.txt -f custodian2.txt
+            Not required with --load-snapshot or --scan.
     
     Optional argument(s):
       -e <ENCODING>, --encoding=<ENCODING>
@@ -1655,8 +5170,79 @@ def usage():
       -p <MAX_PARENT_FILE_LENGTH>, --max-pf-length=<MAX_PARENT_FILE_LENGTH>
             The max character length of the file and it's parent folder.
             Defaults to 250.
+      --file-limits=<FILE_LIMIT>,<FILE_LIMIT>...
+            Sweeps several file limits on one read of the file, writing a
+            batch file per limit and a sweep summary file.
+            Eg: --file-limits=10000,20000,30000,50000
+      --target-batches=<NUM_BATCHES>
+            Picks the smallest file limit that gives at most NUM_BATCHES
+            batches (and at least one), instead of using FILE_LIMIT.
+            With --search-local every candidate limit is counted, as the
+            local batch count does not always fall as the limit grows.
+      --byte-limit=<BYTE_LIMIT>
+            The search limit in bytes, eg: the size of an extraction window.
+            Batches must satisfy both FILE_LIMIT and BYTE_LIMIT.  The file
+            sizes are read from SIZE_COLUMN, and the batch file gets byte
+            total columns.
+            Eg: --byte-limit=500000000000
+      --size-column=<SIZE_COLUMN>
+            The column of the file sizes in bytes.  Reads and rolls up the
+            sizes even without --byte-limit.  With --scan, any value reads
+            the sizes from the file system.
+            Defaults to Logical_Size with --byte-limit, or to the column
+            the loaded snapshot was built with.
       --search-local
             Searches the local file counts instead of total count for FILE_LIMIT.
+      --numpy
+            Aggregates sub-directory totals with NumPy (must be installed).
+      -w <WORKERS>, --workers=<WORKERS>
+            The number of processes that read the file (or scan the
+            directory) in parallel.
+            Defaults to 1.
+      --scan=<DIR_PATH>
+            Scans a directory, eg: a mounted image, instead of reading a
+            listing file.  Symbolic links are not followed.  The path
+            separator defaults to the system one, the encoding of the
+            names to the file system encoding, and the results are saved
+            under the current directory.  Cannot be used with --file or
+            --load-snapshot.
+      --external-memory=<MEMORY_BUDGET>
+            Analyzes listings too large for memory by sorting directory
+            records on disk, buffering about MEMORY_BUDGET megabytes.
+            Directories are written in sorted order.  Cannot be used with
+            --workers, the snapshot options, --file-limits,
+            --target-batches or --database.
+            Eg: --external-memory=2048
+      --database=<DB_PATH>
+            Writes the nodes and outliers to a SQLite database, and rolls
+            up the counters there.  The database is kept for queries.
+            Cannot be used with --load-snapshot.
+      --profile
+            Runs each phase (reading, aggregating, writing results) under
+            cProfile, and writes a profile_<PHASE>_<TIMESTAMP>.pstats file
+            per phase to the output directory.
+      --profile-memory
+            Writes a memory snapshot at the end of each phase to the output
+            directory: a tracemalloc snapshot if tracemalloc is available,
+            otherwise a JSON census of live objects by type.
+      --save-snapshot=<SNAPSHOT_PATH>
+            Saves the tree to a snapshot file after reading the file.
+      --load-snapshot=<SNAPSHOT_PATH>
+            Loads the tree from a snapshot file instead of reading the file.
+            The path separator and max lengths must match the snapshot,
+            and default to the values it was built with.
+      --delta=<DELTA_PATH>
+            Applies a delta listing of added and removed paths to the tree
+            loaded with --load-snapshot.  The delta listing has a Change
+            column of Added or Removed, and a removed folder removes all
+            the files below it.  Only the folders above the changed paths
+            are updated.  Writes batch_delta, outliers1_delta and
+            outliers2_delta files of the changed results rows (for the
+            same FILE_LIMIT as the loaded results), and saves the updated
+            tree with --save-snapshot.  Requires --load-snapshot, cannot be
+            used with --search-local, --file-limits or --target-batches.
+            Eg: --load-snapshot=day1.snap --delta=day2_changes.txt
+                --save-snapshot=day2.snap
       -h, --help
             Displays this help screen.
     '''))
@@ -1668,12 +5254,18 @@ def handle_args():
     global script_args
     
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'f:e:d:s:l:m:n:p:h',
+        opts, args = getopt.getopt(sys.argv[1:], 'f:e:d:s:l:m:n:p:w:h',
                                    ['file=','encoding=','delimiter=',
                                     'path-separator=','file-limit=',
                                     'max-path-length=','max-file-length=',
-                                    'max-pf-length=','search-local',
-                                    'help','debug'])
+                                    'max-pf-length=','file-limits=',
+                                    'target-batches=','search-local',
+                                    'numpy','workers=','external-memory=',
+                                    'database=','profile','profile-memory',
+                                    'scan=','delta=','byte-limit=',
+                                    'size-column=',
+                                    'save-snapshot=',
+                                    'load-snapshot=','help','debug'])
     except getopt.GetoptError as e:
         # Print usage info and exit.
         print str(e)
@@ -1682,7 +5274,7 @@ def handle_args():
     
     for o, a in opts:
         if o == '-f' or o == '--file':
-            script_args['file'] = a
+            script_args.setdefault('file', []).append(a)
         elif o == '-e' or o == '--encoding':
             script_args['encoding'] = a
         elif o == '-d' or o == '--delimiter':
@@ -1697,8 +5289,36 @@ def handle_args():
             script_args['max-file-length'] = a
         elif o == '-p' or o == '--max-pf-length':
             script_args['max-pf-length'] = a
+        elif o == '--file-limits':
+            script_args['file-limits'] = a
+        elif o == '--target-batches':
+            script_args['target-batches'] = a
         elif o == '--search-local':
             script_args['search-local'] = True
+        elif o == '--numpy':
+            script_args['numpy'] = True
+        elif o == '-w' or o == '--workers':
+            script_args['workers'] = a
+        elif o == '--database':
+            script_args['database'] = a
+        elif o == '--scan':
+            script_args['scan'] = a
+        elif o == '--profile':
+            script_args['profile'] = True
+        elif o == '--profile-memory':
+            script_args['profile-memory'] = True
+        elif o == '--external-memory':
+            script_args['external-memory'] = a
+        elif o == '--save-snapshot':
+            script_args['save-snapshot'] = a
+        elif o == '--load-snapshot':
+            script_args['load-snapshot'] = a
+        elif o == '--delta':
+            script_args['delta'] = a
+        elif o == '--byte-limit':
+            script_args['byte-limit'] = a
+        elif o == '--size-column':
+            script_args['size-column'] = a
         elif o == '-h' or o == '--help':
             script_args['help'] = a
         elif o == '--debug':
@@ -1711,52 +5331,177 @@ def handle_args():
         usage()
         sys.exit(0)
     # Check if required arguments are set.
-    if 'file' not in script_args:
+    if ('file' not in script_args and 'load-snapshot' not in script_args and
+            'scan' not in script_args):
         print >>sys.stderr, 'ERROR: Missing argument(s).'
         usage()
         sys.exit(2)
+    if 'scan' in script_args:
+        for name in ('file', 'load-snapshot'):
+            if name in script_args:
+                print >>sys.stderr, 'ERROR: --scan cannot be used with --%s.' % name
+                sys.exit(2)
+        if not os.path.isdir(script_args['scan']):
+            print >>sys.stderr, 'ERROR: --scan must be a directory.'
+            sys.exit(2)
+    if 'file-limits' in script_args:
+        try:
+            script_args['file-limits'] = [int(a) for a in
+                                          script_args['file-limits'].split(',')]
+        except ValueError:
+            print >>sys.stderr, 'ERROR: --file-limits must be a list of integers.'
+            sys.exit(2)
+    if 'target-batches' in script_args:
+        if 'file-limits' in script_args:
+            print >>sys.stderr, 'ERROR: --target-batches cannot be used with --file-limits.'
+            sys.exit(2)
+        try:
+            script_args['target-batches'] = int(script_args['target-batches'])
+        except ValueError:
+            print >>sys.stderr, 'ERROR: --target-batches must be an integer.'
+            sys.exit(2)
+    if 'byte-limit' in script_args:
+        try:
+            script_args['byte-limit'] = int(script_args['byte-limit'])
+        except ValueError:
+            print >>sys.stderr, 'ERROR: --byte-limit must be an integer.'
+            sys.exit(2)
+    if 'external-memory' in script_args:
+        if 'file' not in script_args and 'scan' not in script_args:
+            print >>sys.stderr, 'ERROR: --external-memory requires --file or --scan.'
+            sys.exit(2)
+        for name in ('workers', 'load-snapshot', 'save-snapshot',
+                     'file-limits', 'target-batches', 'database'):
+            if name in script_args:
+                print >>sys.stderr, 'ERROR: --external-memory cannot be used with --%s.' % name
+                sys.exit(2)
+        try:
+            script_args['external-memory'] = int(script_args['external-memory'])
+        except ValueError:
+            print >>sys.stderr, 'ERROR: --external-memory must be an integer.'
+            sys.exit(2)
+    if 'delta' in script_args:
+        if 'load-snapshot' not in script_args:
+            print >>sys.stderr, 'ERROR: --delta requires --load-snapshot.'
+            sys.exit(2)
+        for name in ('file', 'search-local', 'file-limits', 'target-batches'):
+            if name in script_args:
+                print >>sys.stderr, 'ERROR: --delta cannot be used with --%s.' % name
+                sys.exit(2)
+    if 'database' in script_args and 'load-snapshot' in script_args:
+        print >>sys.stderr, 'ERROR: --database cannot be used with --load-snapshot.'
+        sys.exit(2)
+    if 'numpy' in script_args and np is None:
+        print >>sys.stderr, 'ERROR: --numpy requires the numpy package.'
+        sys.exit(2)
 
 
 def main():
     global script_args
     handle_args()
     
-    analyzer = Analyzer(_file=script_args['file'],
-                        encoding=script_args.get('encoding'),
-                        delimiter=script_args.get('delimiter'),
-                        path_sep=script_args.get('path-separator'),
-                        file_limit=script_args.get('file-limit'),
-                        max_path_length=script_args.get('max-path-length'),
-                        max_parent_file_length=script_args.get('max-pf-length'),
-                        max_file_length=script_args.get('max-file-length'),
-                        search_local=script_args.get('search-local',False)
-                        )
+    kwargs = dict(_file=script_args.get('file'),
+                  encoding=script_args.get('encoding'),
+                  delimiter=script_args.get('delimiter'),
+                  path_sep=script_args.get('path-separator'),
+                  file_limit=script_args.get('file-limit'),
+                  max_path_length=script_args.get('max-path-length'),
+                  max_parent_file_length=script_args.get('max-pf-length'),
+                  max_file_length=script_args.get('max-file-length'),
+                  search_local=script_args.get('search-local',False),
+                  use_numpy=script_args.get('numpy',False),
+                  workers=script_args.get('workers'),
+                  load_snapshot=script_args.get('load-snapshot'),
+                  save_snapshot=script_args.get('save-snapshot'),
+                  file_limits=script_args.get('file-limits'),
+                  target_batches=script_args.get('target-batches'),
+                  database=script_args.get('database'),
+                  profile=script_args.get('profile',False),
+                  profile_memory=script_args.get('profile-memory',False),
+                  scan_dir=script_args.get('scan'),
+                  delta=script_args.get('delta'),
+                  byte_limit=script_args.get('byte-limit'),
+                  size_column=script_args.get('size-column')
+                  )
+    if 'external-memory' in script_args:
+        analyzer = ExternalAnalyzer(memory_budget=script_args['external-memory'],
+                                    **kwargs)
+    else:
+        analyzer = Analyzer(**kwargs)
     global logfile
     logfile = os.path.join(analyzer.top_dir,'%s_%s.txt' %
                                   ('log',analyzer.timestamp))
+    if 'debug' in script_args:
+        analyzer.set_debug(True)
+        _logger.set_level('DEBUG')
     message = ' '.join(sys.argv)
     log('INFO', logfile, message, print_stdout=False)
     analyzer.process()
     
     message = ['\nInfo:']
     message.append('========')
-    message.append('File: %s' % script_args['file'])
+    if analyzer.scan_dir:
+        message.append('Scanned Directory: %s' % analyzer.scan_dir)
+    elif len(analyzer.files) > 1:
+        message.append('Files: %s' % ', '.join(analyzer.files))
+    else:
+        message.append('File: %s' % analyzer._file)
+    if analyzer.load_snapshot:
+        message.append('Snapshot: %s' % analyzer.load_snapshot)
+    if analyzer.delta:
+        message.append('Delta: %s' % analyzer.delta)
+        message.append('Delta Encoding: %s' % analyzer.delta_encoding)
     message.append('Encoding: %s' % analyzer.encoding)
     message.append("Delimiter: '%s'" % analyzer.delimiter)
     message.append("Path Separator: '%s'" % analyzer.path_sep)
-    message.append('File Limit: %s' % analyzer.file_limit)
+    if analyzer.file_limits:
+        message.append('File Limits: %s' %
+                       ', '.join(str(l) for l in analyzer.file_limits))
+    else:
+        message.append('File Limit: %s' % analyzer.file_limit)
+    if analyzer.byte_limit is not None:
+        message.append('Byte Limit: %s' % analyzer.byte_limit)
+    if analyzer.size_column:
+        message.append('Size Column: %s' % analyzer.size_column)
+    if analyzer.target_batches is not None:
+        message.append('Target Batches: %s' % analyzer.target_batches)
     message.append('Max Path Length: %s' % analyzer.max_path_length)
     message.append('Max Parent File Length: %s' % analyzer.max_parent_file_length)
     message.append('Max File Length: %s' % analyzer.max_file_length)
+    if isinstance(analyzer, ExternalAnalyzer):
+        message.append('Memory Budget: %s MB' % analyzer.memory_budget)
     message.append('\nResults:')
     message.append('========')
     message.append('Processed %s lines.' % analyzer._file_line_cnt)
-    message.append('Num Batches: %s' % analyzer._dirs_within_limit)
+    if len(analyzer.source_counts) > 1:
+        for counts in analyzer.source_counts:
+            message.append('  %s: %s lines, %s outliers 1, %s outliers 2' %
+                           (counts['file'], counts['lines'],
+                            counts['outliers1'], counts['outliers2']))
+    if analyzer.delta:
+        counts = analyzer.delta_counts
+        message.append('Delta: %s added, %s removed, %s not found paths' %
+                       (counts['added'], counts['removed'], counts['missing']))
+        message.append('Batches: %s added, %s removed, %s updated' %
+                       (counts['batches_added'], counts['batches_removed'],
+                        counts['batches_updated']))
+        message.append('Outliers 1: %s changed, Outliers 2: %s changed' %
+                       (counts['outliers1_delta'], counts['outliers2_delta']))
+    elif analyzer.file_limits:
+        for (file_limit, batches, trimmed, over_limit,
+             unable_to_shorten) in analyzer.sweep_results:
+            message.append('File Limit %s: %s batches, %s trimmed, '
+                           '%s directories over file limit' %
+                           (file_limit, batches, trimmed, over_limit))
+    else:
+        message.append('Num Batches: %s' % analyzer._dirs_within_limit)
     message.append('Num Outliers 1: %s' % len(analyzer.outliers1))
     message.append('Num Outliers 2: %s' % len(analyzer.outliers2))
-    message.append('Num Trimmed (Shortened) Paths: %s' % analyzer._trimmed)
-    message.append('Num Directories over file limit: %s' % analyzer._dirs_over_limit)
-    message.append('Num Paths over max path length but cannot shorten: %s' % analyzer._unable_to_shorten)
+    if not analyzer.file_limits and not analyzer.delta:
+        message.append('Num Trimmed (Shortened) Paths: %s' % analyzer._trimmed)
+        message.append('Num Directories over file limit: %s' % analyzer._dirs_over_limit)
+    if not analyzer.delta:
+        message.append('Num Paths over max path length but cannot shorten: %s' % analyzer._unable_to_shorten)
     log('INFO', logfile, '\n'.join(message), print_stdout=True)
 
 if __name__ == '__main__':
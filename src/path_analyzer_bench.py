@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+
+"""Path Analyzer Benchmark.
+
+path_analyzer_bench times path_analyzer on synthetic listings written by
+listing_generator, at one or more listing sizes.
+
+Each size is analyzed by a separate path_analyzer process, and the figures
+are read from the metrics file it writes: wall time per phase, lines per
+second and peak RSS.  The results are saved as JSON, and can be stored as
+a baseline or compared with one.  The script exits with status 1 if a
+figure regresses beyond the tolerance, so it can gate a build.
+
+"""
+
+from datetime import datetime
+import getopt
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+from textwrap import dedent
+
+from listing_generator import ListingGenerator
+
+__author__ = "Danny Cheun"
+__credits__ = ["Danny Cheun"]
+__version__ = "1.0.0"
+__maintainer__ = "Danny Cheun"
+__email__ = "dcheun@gmail.com"
+
+
+# Export on *
+__all__ = []
+
+# Globals
+# Store script_args passed to script.
+script_args = {}
+# The script being measured, next to this one.
+ANALYZER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'path_analyzer.py')
+# Line in the output of path_analyzer with the path of the metrics file.
+_METRICS_RE = re.compile(r'^Metrics saved to file: (.*)$', re.M)
+# Default listing sizes, in lines.
+DEFAULT_SIZES = [1000000, 10000000, 50000000]
+# Default allowed regression, as a fraction of the baseline.
+DEFAULT_TOLERANCE = 0.2
+# Phases faster than this in the baseline are too noisy to compare.
+MIN_PHASE_SECONDS = 1.0
+
+
+class Benchmark(object):
+
+    """Runs path_analyzer on synthetic listings and compares the results."""
+
+    def __init__(self, work_dir, sizes=None, analyzer_args=None, seed=None,
+                 keep_listings=False):
+        """Constructs a new Benchmark object.
+
+        @param work_dir: The directory of the listings and the results.
+        @keyword sizes: List of listing sizes, in lines.
+                Defaults to DEFAULT_SIZES.
+        @keyword analyzer_args: List of extra path_analyzer arguments.
+                Eg: ['-w', '4']
+        @keyword seed: The seed of the generated listings.
+        @keyword keep_listings: Keeps the generated listings for the next
+                run, which reuses listings of the same size and seed.
+
+        """
+        self.work_dir = work_dir
+        self.sizes = sizes if sizes else DEFAULT_SIZES
+        self.analyzer_args = analyzer_args if analyzer_args else []
+        self.seed = seed if seed is not None else 0
+        self.keep_listings = keep_listings
+        if not os.path.exists(self.work_dir):
+            os.makedirs(self.work_dir)
+
+    def run(self):
+        """Runs every size.
+
+        @return: Dict of the results, keyed by size (as a string, as JSON
+                keys are).
+
+        """
+        results = {}
+        for lines in self.sizes:
+            results[str(lines)] = self.run_size(lines)
+        return {'analyzer_args':self.analyzer_args,
+                'seed':self.seed,
+                'timestamp':datetime.now().isoformat(),
+                'sizes':results}
+
+    def run_size(self, lines):
+        """Analyzes a listing of the given size.
+
+        @param lines: The number of lines of the listing.
+        @return: Dict of the figures of the run.
+
+        """
+        listing = self.get_listing(lines)
+        print 'Analyzing %s lines...' % lines
+        command = ([sys.executable, ANALYZER_SCRIPT, '-f', listing,
+                    '-e', 'utf-8'] + self.analyzer_args)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise RuntimeError('path_analyzer exited with status %s: %s' %
+                               (process.returncode, ' '.join(command)))
+        m = _METRICS_RE.search(output)
+        if not m:
+            raise RuntimeError('No metrics file in path_analyzer output.')
+        metrics_file = m.group(1).strip()
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+        # Drop the results, only the figures are kept.
+        shutil.rmtree(os.path.dirname(metrics_file))
+        if not self.keep_listings:
+            os.remove(listing)
+        peak_rss = [metrics[name] for name in ('peak_rss_kb',
+                                               'children_peak_rss_kb')
+                    if metrics.get(name) is not None]
+        ingest = [phase for phase in metrics['phases']
+                  if phase['name'] == 'ingest']
+        return {'lines':metrics['lines'],
+                'nodes':metrics['nodes'],
+                'wall_seconds':metrics['wall_seconds'],
+                'lines_per_second':(ingest[0].get('lines_per_second')
+                                    if ingest else None),
+                'peak_rss_kb':max(peak_rss) if peak_rss else None,
+                'phases':dict((phase['name'], phase['wall_seconds'])
+                              for phase in metrics['phases'])}
+
+    def get_listing(self, lines):
+        """Returns the path of a listing of the given size, generating it
+        if it is not there.
+
+        """
+        listing = os.path.join(self.work_dir, 'listing_%s_seed%s.txt' %
+                               (lines, self.seed))
+        if os.path.exists(listing):
+            return listing
+        print 'Generating %s lines...' % lines
+        generator = ListingGenerator(lines, seed=self.seed)
+        with open(listing + '.part', 'wb') as f:
+            generator.generate(f)
+        os.rename(listing + '.part', listing)
+        return listing
+
+    @staticmethod
+    def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+        """Compares results with a baseline.
+
+        Wall times and peak RSS regress when they are higher than the
+        baseline by more than tolerance, lines per second when it is lower.
+        Phases under MIN_PHASE_SECONDS in the baseline are not compared.
+        Sizes missing from either side are skipped.
+
+        @param results: The results of Benchmark.run.
+        @param baseline: The results of an earlier run.
+        @keyword tolerance: The allowed regression, as a fraction.
+        @return: List of messages, one per regression.
+
+        """
+        regressions = []
+        def check(size, name, value, base, higher_is_worse=True):
+            if value is None or not base:
+                return
+            change = float(value - base) / base
+            if not higher_is_worse:
+                change = -change
+            if change > tolerance:
+                regressions.append('%s lines: %s %s -> %s (%+.1f%%)' %
+                                   (size, name, base, value,
+                                    100.0 * (value - base) / base))
+        for (size, base) in sorted(baseline['sizes'].iteritems(),
+                                   key=lambda item: int(item[0])):
+            result = results['sizes'].get(size)
+            if result is None:
+                continue
+            check(size, 'wall_seconds', result['wall_seconds'],
+                  base['wall_seconds'])
+            check(size, 'lines_per_second', result['lines_per_second'],
+                  base['lines_per_second'], higher_is_worse=False)
+            check(size, 'peak_rss_kb', result['peak_rss_kb'],
+                  base['peak_rss_kb'])
+            for (name, seconds) in sorted(base['phases'].iteritems()):
+                if seconds >= MIN_PHASE_SECONDS and name in result['phases']:
+                    check(size, '%s wall_seconds' % name,
+                          result['phases'][name], seconds)
+        return regressions
+
+
+def usage():
+    """Print usage info."""
+    program_name = sys.argv[0].split('/')[-1]
+    message = ['Usage: %s <options>...' % program_name]
+    message.append(dedent('''
+    Optional argument(s):
+      --sizes=<LINES>,<LINES>...
+            The listing sizes to run.
+            Defaults to 1000000,10000000,50000000.
+      --work-dir=<DIR_PATH>
+            The directory of the listings and results.
+            Defaults to path_analyzer_bench under the current directory.
+      --analyzer-args=<ARGS>
+            Extra arguments passed to path_analyzer.
+            Eg: --analyzer-args="-w 4 -l 20000"
+      --seed=<SEED>
+            The seed of the generated listings.
+            Defaults to 0.
+      --keep-listings
+            Keeps the generated listings for the next run.
+      -b <BASELINE_PATH>, --baseline=<BASELINE_PATH>
+            Compares the results with a baseline file, and exits with
+            status 1 if any regressed beyond the tolerance.
+      --save-baseline
+            Saves the results to BASELINE_PATH instead of comparing.
+      -t <TOLERANCE>, --tolerance=<TOLERANCE>
+            The allowed regression, as a fraction of the baseline.
+            Defaults to 0.2.
+      -h, --help
+            Displays this help screen.
+    '''))
+    print '\n'.join(message)
+
+
+def handle_args():
+    """Handle script's command line script_args."""
+    global script_args
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'b:t:h',
+                                   ['sizes=','work-dir=','analyzer-args=',
+                                    'seed=','keep-listings','baseline=',
+                                    'save-baseline','tolerance=','help'])
+    except getopt.GetoptError as e:
+        # Print usage info and exit.
+        print str(e)
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '--sizes':
+            script_args['sizes'] = a
+        elif o == '--work-dir':
+            script_args['work-dir'] = a
+        elif o == '--analyzer-args':
+            script_args['analyzer-args'] = shlex.split(a)
+        elif o == '--seed':
+            script_args['seed'] = a
+        elif o == '--keep-listings':
+            script_args['keep-listings'] = True
+        elif o == '-b' or o == '--baseline':
+            script_args['baseline'] = a
+        elif o == '--save-baseline':
+            script_args['save-baseline'] = True
+        elif o == '-t' or o == '--tolerance':
+            script_args['tolerance'] = a
+        elif o == '-h' or o == '--help':
+            script_args['help'] = a
+        else:
+            assert False, 'Unhandled option %s' % o
+
+    # Check for help.
+    if 'help' in script_args:
+        usage()
+        sys.exit(0)
+    if 'save-baseline' in script_args and 'baseline' not in script_args:
+        print >>sys.stderr, 'ERROR: --save-baseline requires --baseline.'
+        sys.exit(2)
+    try:
+        if 'sizes' in script_args:
+            script_args['sizes'] = [int(a) for a in
+                                    script_args['sizes'].split(',')]
+        if 'seed' in script_args:
+            script_args['seed'] = int(script_args['seed'])
+        if 'tolerance' in script_args:
+            script_args['tolerance'] = float(script_args['tolerance'])
+    except ValueError as e:
+        print >>sys.stderr, 'ERROR: %s' % e
+        sys.exit(2)
+
+
+def main():
+    global script_args
+    handle_args()
+
+    work_dir = script_args.get('work-dir',
+                               os.path.join(os.getcwd(), 'path_analyzer_bench'))
+    benchmark = Benchmark(os.path.abspath(work_dir),
+                          sizes=script_args.get('sizes'),
+                          analyzer_args=script_args.get('analyzer-args'),
+                          seed=script_args.get('seed'),
+                          keep_listings=script_args.get('keep-listings', False))
+    results = benchmark.run()
+    results_file = os.path.join(benchmark.work_dir, 'bench_%s.json' %
+                                datetime.now().strftime('ts%Y%m%dT%H%M%S'))
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+    message = ['\nResults:']
+    message.append('========')
+    for lines in benchmark.sizes:
+        result = results['sizes'][str(lines)]
+        message.append('%s lines: %.1fs, %s lines/sec, peak RSS %s KB' %
+                       (lines, result['wall_seconds'],
+                        result['lines_per_second'], result['peak_rss_kb']))
+        for (name, seconds) in sorted(result['phases'].iteritems(),
+                                      key=lambda item: -item[1]):
+            message.append('    %s: %.1fs' % (name, seconds))
+    message.append('Results saved to file: %s' % results_file)
+    print '\n'.join(message)
+
+    baseline_file = script_args.get('baseline')
+    if baseline_file is None:
+        return
+    if script_args.get('save-baseline'):
+        shutil.copyfile(results_file, baseline_file)
+        print 'Baseline saved to file: %s' % baseline_file
+        return
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    regressions = Benchmark.compare(results, baseline,
+                                    script_args.get('tolerance',
+                                                    DEFAULT_TOLERANCE))
+    if regressions:
+        print >>sys.stderr, 'Regressions against %s:' % baseline_file
+        for message in regressions:
+            print >>sys.stderr, '  %s' % message
+        sys.exit(1)
+    print 'No regressions against %s.' % baseline_file
+
+if __name__ == '__main__':
+    main()